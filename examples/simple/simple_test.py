@@ -25,6 +25,13 @@ class SimpleTest(TrfmTestCase):
         vm1.execute_cmd('echo -e "foo\nbar" > /root/some_file')
         vm1.execute_cmd('cat /root/some_file | grep ba')
 
+        # Executing several commands in a single round trip
+        vm1.execute_batch(['test -f /root/some_file',
+                           {'cmd': 'wc -l < /root/some_file',
+                            'output': '^2$'},
+                           {'cmd': 'grep qux /root/some_file',
+                            'retcode': 1}])
+
         # Transfering a file from a VM
         out_file = Path(self.env.workdir) / 'resolv.conf'
         vm1.transfer_file(remote_file_path='/etc/resolv.conf',
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Admission control
+
+Before deploying an environment, its footprint (RAM and vCPUs of all its
+domains) is estimated from the .tf file and its variables. The environment
+is only deployed when the host has enough room for it, taking into account
+what the other live qatrfm environments have reserved. Otherwise, it waits
+until some of them are removed.
+"""
+
+import fcntl
+import os
+
+from pathlib import Path
+
+from qatrfm import placement
+from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import libutils
+from qatrfm.utils import registry
+from qatrfm.utils import tf_utils
+from qatrfm.utils import virsh_utils as vu
+
+# Defaults of the libvirt terraform provider
+DEFAULT_MEMORY = 512
+DEFAULT_VCPU = 1
+
+
+def estimate_footprint(tf_file, tf_vars):
+    """
+    Return the RAM (MiB) and vCPUs needed by all the domains of a .tf file:
+        {'ram': 2048, 'cores': 2}
+    """
+    variables = tf_utils.get_effective_vars(tf_file, tf_vars)
+    text = Path(tf_file).read_text()
+    footprint = {'ram': 0, 'cores': 0}
+    for domain in tf_utils.get_resources(text, 'libvirt_domain'):
+        count = tf_utils.resolve(domain.get('count'), variables, 1)
+        footprint['ram'] += count * tf_utils.resolve(
+            domain.get('memory'), variables, DEFAULT_MEMORY)
+        footprint['cores'] += count * tf_utils.resolve(
+            domain.get('vcpu'), variables, DEFAULT_VCPU)
+    return footprint
+
+
+def host_capacity():
+    """ Return the total RAM (MiB) and CPUs of the host """
+    ram = 0
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                ram = int(line.split()[1]) // 1024
+    return {'ram': ram, 'cores': os.cpu_count()}
+
+
+class AdmissionController(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, mem_overcommit=1.0, cpu_overcommit=4.0,
+                 timeout=3600, pin_cpus=False):
+        """
+        Initialize AdmissionController object. If 'pin_cpus' is True, the
+        environments get dedicated host CPUs when there are enough free ones
+        (see qatrfm.placement).
+        """
+        self.mem_overcommit = mem_overcommit
+        self.cpu_overcommit = cpu_overcommit
+        self.timeout = timeout
+        self.pin_cpus = pin_cpus
+
+    def live_entries(self):
+        """
+        Registry entries of the environments using host resources.
+
+        Orphan environments are only taken into account while their domains
+        still exist, since they keep using the host resources until they are
+        reaped.
+        """
+        existing = set()
+        for name in vu.get_names(libutils.execute_bash_cmd(
+                vu.generate_domain_list_str())):
+            existing.add(vu.get_basename(name))
+        return [entry for entry in registry.list_entries()
+                if not registry.is_orphan(entry) or
+                entry['basename'] in existing]
+
+    def reserved(self, entries=None):
+        """ Sum the footprints reserved by the environments of the host """
+        if entries is None:
+            entries = self.live_entries()
+        reserved = {'ram': 0, 'cores': 0}
+        for entry in entries:
+            reservation = entry.get('reservation', {})
+            reserved['ram'] += reservation.get('ram', 0)
+            reserved['cores'] += reservation.get('cores', 0)
+        return reserved
+
+    def fits(self, footprint, reserved, capacity):
+        if reserved['ram'] == 0 and reserved['cores'] == 0:
+            # Nothing else is running, waiting wouldn't help
+            return True
+        return (reserved['ram'] + footprint['ram'] <=
+                capacity['ram'] * self.mem_overcommit and
+                reserved['cores'] + footprint['cores'] <=
+                capacity['cores'] * self.cpu_overcommit)
+
+    def place(self, env, cores, entries):
+        """
+        Pin the vCPUs of each domain of the environment to free host CPUs if
+        the .tf file supports it. Changing the CPUs of a domain recreates
+        it, so the domains which already exist keep theirs and only the new
+        ones get CPUs, if the environment is pinned and there are enough
+        free ones. Returns its placement, None if it runs unpinned.
+        """
+        num_domains = env.num_domains()
+        if (not self.pin_cpus or not num_domains or
+                not tf_utils.declares_variable(env.tf_file, 'cpuset')):
+            return None
+        topology = placement.host_topology()
+        cpusets = env.get_cpusets()[:num_domains]
+        added = num_domains - len(cpusets)
+        if (added > 0 and (not cpusets or any(cpusets))):
+            held = [cpu for entry in entries
+                    for cpu in (entry.get('placement') or {}).get('cpus', [])]
+            held += [cpu for cpus in cpusets for cpu in cpus]
+            per_domain = cores // num_domains
+            result = placement.allocate(added * per_domain, topology, held)
+            if result is None:
+                self.logger.warning("Not enough free CPUs to pin {} domains "
+                                    "of environment {}, they will run "
+                                    "unpinned".format(added, env.basename))
+                cpusets += [[]] * added
+            else:
+                cpus = result['cpus']
+                cpusets += [cpus[i:i + per_domain]
+                            for i in range(0, len(cpus), per_domain)]
+        else:
+            cpusets += [[]] * added
+        env.set_placement(cpusets, [placement.node_of(cpus, topology)
+                                    for cpus in cpusets])
+        cpus = [cpu for domain_cpus in cpusets for cpu in domain_cpus]
+        if not cpus:
+            return None
+        self.logger.info("Environment {} pinned to CPUs {}".format(
+            env.basename, ' '.join(placement.format_cpulist(c) or '-'
+                                   for c in cpusets)))
+        return {'node': placement.node_of(cpus, topology), 'cpus': cpus}
+
+    def _wait_for_room(self, env, footprint, reserve):
+        """
+        Wait until the footprint fits next to the reservations of the other
+        environments and call reserve(entries) with their registry entries,
+        holding the admission lock so that nobody else takes the room.
+        """
+        capacity = host_capacity()
+        Path(registry.LOCKS_DIR).mkdir(exist_ok=True)
+        lock_path = '{}/admission.lock'.format(registry.LOCKS_DIR)
+
+        def try_reserve():
+            with open(lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = [e for e in self.live_entries()
+                           if e['basename'] != env.basename]
+                reserved = self.reserved(entries)
+                if not self.fits(footprint, reserved, capacity):
+                    self.logger.debug(
+                        "Not enough room for {}: {} MiB / {} vCPUs reserved".
+                        format(env.basename, reserved['ram'],
+                               reserved['cores']))
+                    return False
+                reserve(entries)
+                return True
+
+        if not libutils.wait_for(try_reserve, self.timeout, interval=5,
+                                 max_interval=60):
+            raise libutils.TrfmDeployError(
+                "There is not enough room in the host for the environment "
+                "{} after {} seconds".format(env.basename, self.timeout))
+
+    def admit(self, env):
+        """
+        Wait until the host has room for the environment and register it
+        along with its reservation.
+        """
+        footprint = estimate_footprint(env.tf_file, env.vars)
+        self.logger.info("Environment {} needs {} MiB of RAM and {} vCPUs".
+                         format(env.basename, footprint['ram'],
+                                footprint['cores']))
+
+        def register(entries):
+            registry.register(
+                env.basename, reservation=footprint,
+                placement=self.place(env, footprint['cores'], entries),
+                **env.registry_info())
+
+        self._wait_for_room(env, footprint, register)
+
+    def resize(self, env):
+        """
+        Wait until the host has room for the new footprint of an admitted
+        environment (e.g. after changing its number of domains) and update
+        its reservation. Only its new domains get CPUs (see place).
+        """
+        footprint = estimate_footprint(env.tf_file, env.vars)
+        self.logger.info("Environment {} now needs {} MiB of RAM and {} vCPUs".
+                         format(env.basename, footprint['ram'],
+                                footprint['cores']))
+
+        def update(entries):
+            registry.update(
+                env.basename, reservation=footprint,
+                placement=self.place(env, footprint['cores'], entries))
+
+        self._wait_for_room(env, footprint, update)
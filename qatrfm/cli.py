@@ -18,15 +18,25 @@ import fcntl
 import importlib.util
 import inspect
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from qatrfm import hooks
+from qatrfm import journal
+from qatrfm.admission import AdmissionController
 from qatrfm.environment import TerraformEnv
+from qatrfm.harvest import HarvestPlugin
+from qatrfm.layers import LayerCache
+from qatrfm.lease import DomainPool
+from qatrfm.nspawn import NspawnEnv
+from qatrfm.profiler import ProfilerPlugin
+from qatrfm.results import CACHE_DIR, ResultCache
+from qatrfm.teardown import TeardownWorker, reap as reap_environments
 from qatrfm.utils.logger import QaTrfmLogger, init_logging
 from qatrfm.utils import libutils
+from qatrfm.utils import registry
 from qatrfm.testcase import TrfmTestCase
 
-file_lock = None
-
 
 def print_version(ctx, param, value):
     if not value or ctx.resilient_parsing:
@@ -100,38 +110,231 @@ def get_network_octet():
     where X will be calculated dynamically according to the existing
     networks on the system, starting from X=0, this offers 255 possible
     isolated environments running at the same time.
+
+    Returns X and the lock file which keeps it taken, which must be stored
+    in the environment (see BaseEnv.release_octet).
     """
-    global file_lock
-    locks_dir = '/tmp/qatrfm'
+    locks_dir = registry.LOCKS_DIR
     Path(locks_dir).mkdir(exist_ok=True)
     x = 0
     while x < 255:
+        file_lock = open('{}/{}'.format(locks_dir, x), 'a')
         try:
-            file_lock = open('{}/{}'.format(locks_dir, x), 'a')
             output = libutils.execute_bash_cmd(
                 'ip a|grep 10.{}||true'.format(x))
             if output == '':
                 fcntl.flock(file_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                return x
+                return x, file_lock
         except IOError:
             pass
+        file_lock.close()
         x += 1
     raise Exception("Cannot find available network range")
 
 
+def lock_network_octet(x):
+    """
+    Take the lock of a network octet. Returns the lock file, or None if
+    somebody else has it.
+    """
+    Path(registry.LOCKS_DIR).mkdir(exist_ok=True)
+    lock = open('{}/{}'.format(registry.LOCKS_DIR, x), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        return None
+    return lock
+
+
+def reuse_environment(tf_file, tf_vars, snapshots, fast_clean,
+                      setup_steps=None):
+    """
+    Find a live environment deployed by a previous run with the same .tf file,
+    variables and setup steps and attach to it. Returns None if there is none.
+    """
+    fingerprint = TerraformEnv.compute_fingerprint(tf_file, tf_vars,
+                                                   setup_steps)
+    for entry in TerraformEnv.find_reusable(fingerprint):
+        lock = lock_network_octet(entry['net_octet'])
+        if lock is None:
+            continue
+        env = TerraformEnv.attach(entry, tf_vars, tf_file, snapshots,
+                                  fast_clean, setup_steps)
+        if env is not None:
+            env.octet_lock = lock
+            return env
+        lock.close()
+    return None
+
+
+def resume_environment(event, tf_file, tf_vars, snapshots, fast_clean,
+                       setup_steps=None):
+    """
+    Attach to the environment a previous run recorded in its journal, if it
+    is still alive. Returns None otherwise.
+    """
+    entry = registry.get_entry(event['basename']) or dict(event)
+    lock = lock_network_octet(entry['net_octet'])
+    if lock is None:
+        return None
+    env = TerraformEnv.attach(entry, tf_vars, tf_file, snapshots, fast_clean,
+                              setup_steps)
+    if env is None:
+        lock.close()
+    else:
+        env.octet_lock = lock
+    return env
+
+
+def release_live_environment(event, tf_file, tf_vars, fast_clean, clean,
+                             run_journal, teardown):
+    """
+    Remove (or just release if 'clean' is False) an environment of the
+    previous run whose tests all passed, so that neither its domains nor
+    its network octet leak.
+    """
+    # Its domains are removed, there is no need to revert their snapshots
+    env = resume_environment(event, tf_file, tf_vars, False, fast_clean)
+    if (env is None):
+        return
+    env.snapshots = bool(event.get('snapshots'))
+    if (clean):
+        run_journal.env_released(env)
+        teardown.submit(env)
+    else:
+        env.release_octet()
+
+
+def common_setup_steps(tests):
+    """
+    Setup steps shared by all the tests which declare some: the longest
+    common prefix of their 'setup_steps'.
+    """
+    setups = [t.setup_steps for t in tests if t.setup_steps]
+    if not setups:
+        return []
+    common = []
+    for steps in zip(*setups):
+        if any(step != steps[0] for step in steps):
+            break
+        common.append(steps[0])
+    return common
+
+
+def own_setup_steps(test, env):
+    """ Setup steps of a test not shared with the rest of the environment """
+    if not test.setup_steps:
+        return []
+    return test.setup_steps[len(env.setup_steps):]
+
+
+def run_testcase(t, results_dir, telemetry_interval=0):
+    """
+    Run a test case instance, log its result and return its exit code.
+
+    The setup steps of the test which are not shared with the environment
+    are run right before it. They must be reverted afterwards, so such a
+    test fails if the environment has no snapshots.
+    """
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+    logger.info("Running test case '{}'".format(t.name))
+    logger.info("\tfrom module '{}' ".
+                format(sys.modules[type(t).__module__].__file__))
+
+    env = t.env
+    steps = own_setup_steps(t, env)
+    if (steps and not env.snapshots):
+        logger.error("The test '{}' has its own setup steps, which can only "
+                     "be reverted with --snapshots".format(t.name))
+        return TrfmTestCase.EX_FAILURE
+    env.apply_setup(steps)
+    if (telemetry_interval > 0):
+        env.start_telemetry(telemetry_interval)
+    hooks.call('before_test', t)
+    exit_code = None
+    try:
+        exit_code = t.run()
+    finally:
+        hooks.call('after_test', t, exit_code)
+        telemetry = env.stop_telemetry(
+            Path(results_dir) / 'telemetry' / '{}.json'.format(t.name))
+    if (exit_code == TrfmTestCase.EX_OK):
+        logger.success("The test '{}' finished successfuly".format(t.name))
+    else:
+        logger.error("The test '{}' finished with error code={}".
+                     format(t.name, exit_code))
+    if (telemetry):
+        logger.info("Resource usage of '{}':\n{}".format(
+            t.name, "\n".join(["\t{}".format(line) for line in telemetry])))
+    return exit_code
+
+
+def run_testcases(env, tests, results_dir, telemetry_interval=0,
+                  run_journal=None):
+    """
+    Run the test cases of an environment and return the names of the ones
+    which failed. Their results are recorded in 'run_journal' if given.
+
+    The tests declaring 'domains_required' run concurrently, each one with
+    its own subset of the domains. Then, the tests needing the whole
+    environment run one after another.
+    """
+    failed_tests = []
+    leasable = [t for t in tests if t.domains_required is not None and
+                t.domains_required <= len(env.domains)]
+    exclusive = [t for t in tests if t not in leasable]
+
+    def run(test, env):
+        t = test(env, test.__name__)
+        exit_code = run_testcase(t, results_dir, telemetry_interval)
+        if (run_journal is not None):
+            run_journal.test_finished(env.tf_file, test, exit_code)
+        return exit_code
+
+    def run_leased(test):
+        leased = pool.acquire(test.domains_required)
+        try:
+            return run(test, leased)
+        finally:
+            pool.release(leased)
+
+    if (leasable):
+        pool = DomainPool(env)
+        with ThreadPoolExecutor(max_workers=len(env.domains)) as executor:
+            futures = [(test, executor.submit(run_leased, test))
+                       for test in leasable]
+            for test, future in futures:
+                if (future.result() != TrfmTestCase.EX_OK):
+                    failed_tests.append(test.__name__)
+
+    for test in exclusive:
+        if (run(test, env) != TrfmTestCase.EX_OK):
+            failed_tests.append(test.__name__)
+        if (own_setup_steps(test, env) and env.snapshots):
+            # The leased domains are reverted when they are released
+            env.reset()
+    return failed_tests
+
+
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'],
                         max_content_width=200)
 
 
-@click.command(context_settings=CONTEXT_SETTINGS)
+@click.group(context_settings=CONTEXT_SETTINGS, invoke_without_command=True)
 @click.option('--version', '-v', is_flag=True, callback=print_version,
               expose_value=False, is_eager=True)
-@click.option('--test', '-t', required=True,
+@click.option('--test', '-t',
               help='Path where the tests are located.')
 @click.option('--tfvar', type=str, multiple=True, help='Variable to '
               'insert to the .tf file. It can be used multiple times '
               'for each single variable. At least tfvar "image" should be '
               'provided for the default .tf file.')
+@click.option('--backend', type=click.Choice(['libvirt', 'nspawn']),
+              default='libvirt', show_default=True, help="Run the tests in "
+              "libvirt domains deployed by terraform or in systemd-nspawn "
+              "containers (tfvar 'image' must then be a root file system "
+              "directory).")
 @click.option('--snapshots', is_flag=True,
               help='Create snapshots of the domains at the beginning. '
               'This is useful to allow the test revert the domains to their '
@@ -139,70 +342,228 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'],
 @click.option('--no-clean', 'no_clean', is_flag=True,
               help="Don't clean the environment when the tests finish. "
               "This is useful for debug and troubleshooting.")
+@click.option('--reuse', is_flag=True,
+              help="Reuse a live environment left by a previous run with the "
+              "same .tf file and tfvars instead of deploying a new one. The "
+              "environment is not cleaned at the end so that the next run can "
+              "reuse it too.")
+@click.option('--templates', is_flag=True,
+              help="Save the state of the domains of the first environment "
+              "of each .tf file and tfvars once they are ready, and restore "
+              "it in the next environments instead of booting them.")
+@click.option('--layers', is_flag=True,
+              help="Cache the disk of the domains after each setup step of "
+              "the tests, so that the next environments boot from the "
+              "longest cached prefix of their setup steps.")
+@click.option('--layers-budget', 'layers_budget', type=click.IntRange(1),
+              default=50, show_default=True, help="Maximum size in GiB of "
+              "the layer cache. The least recently used layers are removed.")
+@click.option('--fast-clean', 'fast_clean', is_flag=True,
+              help="Remove the libvirt resources of the environments directly "
+              "and in parallel instead of using 'terraform destroy', which "
+              "is only used if that fails.")
+@click.option('--clean-workers', 'clean_workers', type=click.IntRange(1),
+              default=2, help="Maximum number of environments removed in "
+              "background at the same time.")
+@click.option('--mem-overcommit', 'mem_overcommit', type=float, default=1.0,
+              show_default=True, help="Ratio of the host RAM that the "
+              "environments can reserve. Deploys wait until there is room.")
+@click.option('--cpu-overcommit', 'cpu_overcommit', type=float, default=4.0,
+              show_default=True, help="Ratio of the host CPUs that the "
+              "environments can reserve as vCPUs.")
+@click.option('--pin-cpus', 'pin_cpus', is_flag=True,
+              help="Pin the vCPUs of each environment to host CPUs not used "
+              "by other environments, in a single NUMA node when possible. "
+              "Environments run unpinned when there are not enough free "
+              "CPUs.")
+@click.option('--admission-timeout', 'admission_timeout', type=int,
+              default=3600, show_default=True, help="Seconds to wait for "
+              "enough host resources before giving up a deploy.")
+@click.option('--resume', is_flag=True,
+              help="Resume the previous run from the journal of the results "
+              "directory: skip the tests which passed and reuse its "
+              "environments which are still alive.")
+@click.option('--incremental', is_flag=True,
+              help="Skip the tests which already passed with the same test "
+              "sources, .tf file, tfvars and referenced files, and only "
+              "deploy the environments which still have tests to run.")
+@click.option('--cache-dir', 'cache_dir', default=CACHE_DIR,
+              show_default=True, help="Directory where the results used by "
+              "--incremental are stored.")
+@click.option('--results-dir', 'results_dir', default='qatrfm-results',
+              show_default=True, help="Directory where the artifacts of the "
+              "run (telemetry, profiles, ...) are stored.")
+@click.option('--telemetry-interval', 'telemetry_interval', type=float,
+              default=0, help="Sample the resource usage of the domains and "
+              "the host every X seconds while the tests run. Disabled by "
+              "default.")
+@click.option('--profile', is_flag=True,
+              help="Profile the tests and store a cProfile file and "
+              "flamegraph-compatible stacks of each one in "
+              "<results-dir>/profile.")
+@click.option('--harvest', type=str, multiple=True, help="Path or glob of "
+              "files of the domains to collect into "
+              "<results-dir>/artifacts/<test>.tar.gz after each test. They "
+              "are read from the disks of the paused domains. It can be "
+              "used multiple times.")
 @click.option('--loglevel', 'loglevel', type=click.Choice([
               'CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']),
               default='DEBUG', help="Specify default log level")
 @click.option('--log-colors', 'logcolors', is_flag=True, help="Show different "
               "loglevels in different colors", envvar='LOG_COLORS')
-def cli(test, tfvar, snapshots, no_clean, loglevel, logcolors):
+@click.pass_context
+def cli(ctx, test, tfvar, backend, snapshots, no_clean, reuse, templates,
+        layers, layers_budget, fast_clean, clean_workers, mem_overcommit,
+        cpu_overcommit, pin_cpus, admission_timeout, resume, incremental,
+        cache_dir, results_dir, telemetry_interval, profile, harvest,
+        loglevel, logcolors):
     """ Create a terraform environment and run the test(s)"""
 
     init_logging(loglevel, logcolors)
+    if ctx.invoked_subcommand is not None:
+        return
+    if test is None:
+        raise click.UsageError("Missing option '--test' / '-t'.")
     logger = QaTrfmLogger.getQatrfmLogger(__name__)
 
+    if (profile):
+        hooks.register_plugin(
+            ProfilerPlugin(Path(results_dir) / 'profile'))
+    teardown = TeardownWorker(max_workers=clean_workers)
+    admission = AdmissionController(mem_overcommit=mem_overcommit,
+                                    cpu_overcommit=cpu_overcommit,
+                                    timeout=admission_timeout,
+                                    pin_cpus=pin_cpus)
+    layer_cache = None
+    if (layers):
+        layer_cache = LayerCache(budget=layers_budget * 2**30)
+    journal_path = Path(results_dir) / 'journal.jsonl'
+    events = journal.load(journal_path) if resume else []
+    passed = journal.passed_tests(events)
+    live = journal.live_environments(events)
+    run_journal = journal.RunJournal(journal_path, append=resume)
+    ctx.call_on_close(run_journal.close)
+    result_cache = ResultCache(cache_dir)
     testcases = find_testcases(Path(test))
+    if (backend == 'libvirt' and
+            (harvest or any(t.artifacts for tests in testcases.values()
+                            for t in tests))):
+        # The files are read from the disks of the libvirt domains
+        hooks.register_plugin(
+            HarvestPlugin(Path(results_dir) / 'artifacts', harvest))
     for tf_file in testcases.keys():
-        net_octet = get_network_octet()
-        env = TerraformEnv(net_octet=net_octet,
-                           tf_vars=tfvar,
-                           tf_file=tf_file,
-                           snapshots=snapshots)
+        tests = [t for t in testcases[tf_file]
+                 if journal.test_id(t) not in passed]
+        if (len(tests) < len(testcases[tf_file])):
+            logger.info("Skipping {} tests of {} which passed in the "
+                        "previous run".format(
+                            len(testcases[tf_file]) - len(tests), tf_file))
+        # The environment (and so the setup steps) doesn't depend on which
+        # tests are skipped, so the keys don't change between runs.
+        setup_steps = common_setup_steps(testcases[tf_file])
+        keys = {t: ResultCache.key(t, tf_file, tfvar, backend, setup_steps)
+                for t in tests}
+        if (incremental):
+            cached = [t for t in tests if result_cache.passed(keys[t])]
+            if (cached):
+                logger.info("Skipping tests whose inputs didn't change: "
+                            "{}".format(",".join([t.__name__
+                                                  for t in cached])))
+            tests = [t for t in tests if t not in cached]
+        clean = not no_clean and not reuse
+        if (not tests):
+            if (str(tf_file) in live and backend == 'libvirt'):
+                release_live_environment(live[str(tf_file)], tf_file, tfvar,
+                                         fast_clean, clean, run_journal,
+                                         teardown)
+            continue
+        env = None
+        if (str(tf_file) in live and backend == 'libvirt'):
+            env = resume_environment(live[str(tf_file)], tf_file, tfvar,
+                                     snapshots, fast_clean, setup_steps)
+        if (env is None and reuse and backend == 'libvirt'):
+            env = reuse_environment(tf_file, tfvar, snapshots, fast_clean,
+                                    setup_steps)
+        reused = env is not None
+        if (not reused and backend == 'nspawn'):
+            net_octet, octet_lock = get_network_octet()
+            env = NspawnEnv(net_octet=net_octet,
+                            tf_vars=tfvar,
+                            tf_file=tf_file,
+                            snapshots=snapshots,
+                            setup_steps=setup_steps)
+            env.octet_lock = octet_lock
+        elif (not reused):
+            net_octet, octet_lock = get_network_octet()
+            env = TerraformEnv(net_octet=net_octet,
+                               tf_vars=tfvar,
+                               tf_file=tf_file,
+                               snapshots=snapshots,
+                               admission=admission,
+                               fast=fast_clean,
+                               templates=templates,
+                               setup_steps=setup_steps,
+                               layer_cache=layer_cache)
+            env.octet_lock = octet_lock
         logger.info(("Test case information:\n"
                      "\tTF_file      : {}\n"
                      "\tTests        : {}\n"
                      "\tWorking dir. : {}\n"
                      "\tNetwork      : 10.{}.0.0/24\n"
+                     "\tReused       : {}\n"
                      "\tClean        : {}\n"
                      "\tSnapshots    : {}\n"
                      "\tTF variables : \n"
                      "{}").format(
                           str(tf_file),
-                          ",".join([t.__name__ for t in testcases[tf_file]]),
-                          env.workdir, net_octet, not no_clean, snapshots,
+                          ",".join([t.__name__ for t in tests]),
+                          env.workdir, env.net_octet, reused, clean,
+                          snapshots,
                           "\n".join(["\t\t{}".format(v) for v in tfvar])
                    ))
 
         try:
-            failed_tests = []
-            env.deploy()
-            for test in testcases[tf_file]:
-                logger.info("Running test case '{}'".format(test.__name__))
-                logger.info("\tfrom module '{}' ".
-                            format(sys.modules[test.__module__].__file__))
-
-                t = test(env, test.__name__)
-                exit_code = t.run()
-                if (exit_code == TrfmTestCase.EX_OK):
-                    logger.success("The test '{}' finished successfuly".
-                                   format(t.name))
-                else:
-                    failed_tests.append(t.name)
-                    logger.error("The test '{}' finished with error code={}".
-                                 format(t.name, exit_code))
+            if (not reused):
+                env.deploy()
+            run_journal.env_deployed(tf_file, env)
+            failed_tests = run_testcases(env, tests, results_dir,
+                                         telemetry_interval, run_journal)
+            for t in tests:
+                if (t.__name__ not in failed_tests):
+                    result_cache.store(keys[t], t)
 
         except Exception as e:
             logger.error("Something went wrong:\n{}".format(e))
-            if (not no_clean):
-                env.clean()
+            if (clean):
+                run_journal.env_released(env)
+                teardown.submit(env)
+            teardown.wait()
             raise(e)
 
-        if (not no_clean):
-            env.clean()
+        if (clean):
+            run_journal.env_released(env)
+            teardown.submit(env)
 
-        if (len(testcases[tf_file]) > 1 and len(failed_tests) > 0):
+        if (len(tests) > 1 and len(failed_tests) > 0):
             logger.error("The following tests failed: {}".
                          format(",".join(failed_tests)))
+            teardown.wait()
             sys.exit(TrfmTestCase.EX_FAILURE)
 
+    if (teardown.wait()):
+        logger.warning("Some environments couldn't be removed, "
+                       "use 'qatrfm reap' to remove them.")
     logger.success("All tests passed")
     sys.exit(TrfmTestCase.EX_OK)
+
+
+@cli.command()
+@click.option('--workers', type=click.IntRange(1), default=4,
+              help="Number of environments removed at the same time.")
+@click.option('--dry-run', 'dry_run', is_flag=True,
+              help="Only show the orphan environments, don't remove them.")
+def reap(workers, dry_run):
+    """ Remove the environments whose owner or working dir is gone """
+    failed = reap_environments(max_workers=workers, dry_run=dry_run)
+    if failed:
+        sys.exit(TrfmTestCase.EX_FAILURE)
@@ -19,6 +19,29 @@ variable "cores" {
     default = "1"
 }
 
+# Set to false by qatrfm to restore the domains from a template
+variable "running" {
+    default = "true"
+}
+
+# Static IP of each domain, calculated by qatrfm from net_octet
+variable "domain_ips" {
+    type = "list"
+    default = []
+}
+
+# Host CPUs and NUMA node of each domain, set by qatrfm with --pin-cpus.
+# Empty values leave the domains unpinned.
+variable "cpuset" {
+    type = "list"
+    default = []
+}
+
+variable "numa_node" {
+    type = "list"
+    default = []
+}
+
 provider "libvirt" {
      uri = "qemu:///system"
 }
@@ -44,10 +67,13 @@ resource "libvirt_domain" "domain-sle" {
   memory = "${var.ram}"
   vcpu = "${var.cores}"
   count = "${var.num_domains}"
+  running = "${var.running}"
 
   network_interface {
     network_id = "${libvirt_network.my_net.id}"
-    wait_for_lease = true
+    # No address (DHCP) when domain_ips is not set
+    addresses = ["${compact(list(element(concat(var.domain_ips, list("")), count.index)))}"]
+    wait_for_lease = false
   }
 
   disk {
@@ -71,6 +97,40 @@ resource "libvirt_domain" "domain-sle" {
     listen_type = "address"
     autoport = "true"
   }
+
+  xml {
+    xslt = <<EOF
+<?xml version="1.0" ?>
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:output omit-xml-declaration="yes" indent="yes"/>
+  <xsl:template match="node()|@*">
+    <xsl:copy>
+      <xsl:apply-templates select="node()|@*"/>
+    </xsl:copy>
+  </xsl:template>
+  <xsl:template match="/domain/vcpu">
+    <xsl:copy>
+      <xsl:apply-templates select="@*"/>
+      <xsl:if test="'${element(concat(var.cpuset, list("")), count.index)}' != ''">
+        <xsl:attribute name="placement">static</xsl:attribute>
+        <xsl:attribute name="cpuset">${element(concat(var.cpuset, list("")), count.index)}</xsl:attribute>
+      </xsl:if>
+      <xsl:apply-templates select="node()"/>
+    </xsl:copy>
+  </xsl:template>
+  <xsl:template match="/domain">
+    <xsl:copy>
+      <xsl:apply-templates select="node()|@*"/>
+      <xsl:if test="'${element(concat(var.numa_node, list("")), count.index)}' != ''">
+        <numatune>
+          <memory mode="preferred" nodeset="${element(concat(var.numa_node, list("")), count.index)}"/>
+        </numatune>
+      </xsl:if>
+    </xsl:copy>
+  </xsl:template>
+</xsl:stylesheet>
+EOF
+  }
 }
 
 output "domain_ips" {
@@ -15,17 +15,26 @@ utilities to interact with it.
 
 """
 
+import contextlib
+import math
 import paramiko
+import re
 import time
+import uuid
 
+from qatrfm.executor import GuestExecutor
 from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import batch_utils
 from qatrfm.utils import libutils
 from qatrfm.utils import qemu_agent_utils as qau
+from qatrfm.utils import virsh_utils as vu
 
 
 class Domain(object):
 
     logger = QaTrfmLogger.getQatrfmLogger(__name__)
+    # Runs the commands of execute_cmd_async, None if overridden
+    executor_class = GuestExecutor
 
     def __init__(self, name, ip=None, user='root', pwd='nots3cr3t'):
         """Initialize Domain object."""
@@ -37,6 +46,9 @@ class Domain(object):
         # Future: inject ssh keys into VMs from host.
         self.ssh = paramiko.SSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
+        self.executor = None
+        if self.executor_class is not None:
+            self.executor = self.executor_class(self)
 
     def _print_log(self, cmd, retcode=None, output=None, type='Qemu agent'):
         self.logger.debug("{} command status:\n"
@@ -94,6 +106,150 @@ class Domain(object):
         if (exit_on_failure):
             raise libutils.TrfmCommandTimeout
 
+    def execute_cmd_async(self, cmd, timeout=300):
+        """
+        Start a command through the qemu agent without waiting for it.
+
+        Returns a GuestProcess handle: handle.result() waits for the command
+        and returns [retcode, output], handle.cancel() kills it. All the
+        commands running in the domain are polled by a single thread, so
+        many of them can run at the same time (e.g. a service, a log tail
+        and a client) without a polling loop per command.
+        """
+        return self.executor.submit(cmd, timeout)
+
+    def _read_guest_file(self, handle):
+        """ Read what is available in an open file of the domain """
+        data = b''
+        while True:
+            chunk, eof = qau.get_file_data(libutils.execute_bash_cmd(
+                qau.generate_guest_file_read_str(self.name, handle)))
+            data += chunk
+            if eof or not chunk:
+                return data
+
+    def _follow(self, cmd, timeout=300, interval=0.2, max_interval=2):
+        """
+        Run 'cmd' in the background with its output redirected to a
+        temporary file of the domain and yield the new lines of that file as
+        they are written. The file is read incrementally through the qemu
+        agent, which costs a single call per poll; the polls are more
+        frequent while there is new output.
+
+        Raises TrfmDomainTimeout after 'timeout' seconds. The command is
+        killed and the file removed when the generator is closed.
+        """
+        path = '/tmp/qatrfm-follow-{}'.format(uuid.uuid4().hex)
+        process = self.execute_cmd_async(
+            '{} > {} 2>&1'.format(cmd, path), timeout + 60)
+        handle = None
+        pending = b''
+        deadline = time.monotonic() + timeout
+        wait = interval
+        try:
+            while True:
+                exited = process.done()
+                data = b''
+                if handle is None:
+                    try:
+                        handle = qau.get_file_handle(
+                            libutils.execute_bash_cmd(
+                                qau.generate_guest_file_open_str(self.name,
+                                                                 path)))
+                    except libutils.TrfmCommandFailed:
+                        # The file is not created yet
+                        pass
+                if handle is not None:
+                    data = self._read_guest_file(handle)
+                if data:
+                    lines = (pending + data).split(b'\n')
+                    pending = lines.pop()
+                    wait = interval
+                    if lines:
+                        yield [line.decode('utf-8', 'replace')
+                               for line in lines]
+                elif exited:
+                    if pending:
+                        yield [pending.decode('utf-8', 'replace')]
+                    return
+                else:
+                    wait = min(wait * 2, max_interval)
+                if time.monotonic() > deadline:
+                    raise libutils.TrfmDomainTimeout(
+                        "Timeout following '{}' on domain {}".format(
+                            cmd, self.name))
+                time.sleep(wait)
+        finally:
+            if handle is not None:
+                libutils.execute_bash_cmd(
+                    qau.generate_guest_file_close_str(self.name, handle),
+                    exit_on_failure=False)
+            process.cancel()
+            self.execute_cmd_async('rm -f {}'.format(path), 30)
+
+    def wait_for_pattern(self, source, pattern, timeout=300,
+                         from_start=False):
+        """
+        Wait until a line matching the regular expression 'pattern' is
+        written to 'source', which is either a file of the domain (absolute
+        path) or a systemd unit whose journal is followed. Only the lines
+        written after the call are matched, unless 'from_start' is True.
+
+        A single 'tail -F' (or 'journalctl -f') runs in the domain while the
+        lines are matched here. Returns the match object, or raises
+        TrfmDomainTimeout if no line matched within 'timeout' seconds.
+        """
+        if source.startswith('/'):
+            cmd = 'exec tail -n {} -F {}'.format(
+                '+1' if from_start else '0', source)
+        else:
+            cmd = 'exec journalctl --no-pager -o cat -n {} -f -u {}'.format(
+                'all' if from_start else '0', source)
+        regex = re.compile(pattern)
+        with contextlib.closing(self._follow(cmd, timeout)) as follow:
+            for lines in follow:
+                for line in lines:
+                    match = regex.search(line)
+                    if match:
+                        return match
+        raise libutils.TrfmDomainTimeout(
+            "'{}' stopped before '{}' matched".format(cmd, pattern))
+
+    def wait_for_condition(self, cmd, predicate=None, timeout=300,
+                           interval=1):
+        """
+        Wait until the result of a command meets a condition.
+
+        The command is run every 'interval' seconds by a loop in the domain
+        and its results are streamed back, instead of calling execute_cmd()
+        repeatedly. 'predicate' is called with the exit code and the output
+        (stdout and stderr) of each run, by default the condition is that
+        the command succeeds. Returns [retcode, output] of the run meeting
+        the condition, or raises TrfmDomainTimeout.
+        """
+        if predicate is None:
+            def predicate(retcode, output):
+                return retcode == 0
+        marker = '@@QATRFM-CONDITION@@'
+        loop = 'while true; do ( {} ); echo {} $?; sleep {}; done'.format(
+            cmd, marker, interval)
+        output = []
+        with contextlib.closing(self._follow(loop, timeout)) as follow:
+            for lines in follow:
+                for line in lines:
+                    if not line.startswith(marker):
+                        output.append(line)
+                        continue
+                    retcode = int(line.split()[1])
+                    result = '\n'.join(output)
+                    output = []
+                    if predicate(retcode, result):
+                        self._print_log(cmd, retcode, result,
+                                        type='Condition')
+                        return [retcode, result]
+        raise libutils.TrfmDomainTimeout(
+            "The condition loop of '{}' stopped".format(cmd))
+
     def execute_ssh_cmd(self, cmd, timeout=300, exit_on_failure=True):
         """
         Execute SSH command.
@@ -149,6 +305,45 @@ class Domain(object):
             self.logger.error("The domain failed to execute the command.")
             raise(e)
 
+    def execute_batch(self, steps, stop_on_failure=True, timeout=300,
+                      exit_on_failure=True, ssh=False):
+        """
+        Execute a list of commands in one round trip.
+
+        Instead of calling execute_cmd() once per command, a runner script
+        with all the steps is shipped to the domain and executed with a
+        single 'guest-exec' (or SSH command if 'ssh' is True). Each step is
+        a command string or a dict with the keys 'cmd', 'retcode' (expected
+        exit code, 0 by default) and 'output' (optional extended regex the
+        output must match). Every step runs in its own bash process.
+
+        Returns a list with a dict per executed step containing 'cmd',
+        'retcode', 'output', 'duration' and 'ok'. If 'stop_on_failure' is
+        True, the steps after the first one not meeting its expectations are
+        not executed. If any step failed and 'exit_on_failure' is True,
+        TrfmCommandFailed is raised.
+        """
+        cmd = batch_utils.generate_runner_cmd(steps, stop_on_failure)
+        self.logger.debug("execute batch of {} commands".format(len(steps)))
+        if ssh:
+            ret = self.execute_ssh_cmd(cmd, timeout, exit_on_failure)
+        else:
+            ret = self.execute_cmd(cmd, timeout, exit_on_failure)
+        if ret is None:
+            # Timed out without exit_on_failure
+            return []
+        results = batch_utils.parse_runner_output(ret[1], steps)
+        for r in results:
+            self._print_log(r['cmd'], r['retcode'], r['output'],
+                            type='Batch ({:.2f}s)'.format(r['duration']))
+        failed = [r for r in results if not r['ok']]
+        if failed and exit_on_failure:
+            raise libutils.TrfmCommandFailed(
+                "Step '{}' failed with exit code {}:\n{}".format(
+                    failed[0]['cmd'], failed[0]['retcode'],
+                    failed[0]['output']))
+        return results
+
     def check_qemu_agent(self):
         str = qau.generate_guest_ping_str(self.name)
         try:
@@ -157,21 +352,88 @@ class Domain(object):
         except libutils.TrfmCommandFailed:
             return False
 
+    def is_running(self):
+        output = libutils.execute_bash_cmd(
+            vu.generate_domstate_str(self.name), exit_on_failure=False)
+        return output.strip() == 'running'
+
+    def exists(self):
+        try:
+            libutils.execute_bash_cmd(vu.generate_domstate_str(self.name))
+            return True
+        except libutils.TrfmCommandFailed:
+            return False
+
+    def has_network(self):
+        """ True if the domain has network interfaces """
+        output = libutils.execute_bash_cmd(
+            vu.generate_dumpxml_str(self.name), exit_on_failure=False)
+        return '<interface ' in output
+
+    def get_disk_path(self):
+        """ Return the path of the first disk of the domain """
+        output = libutils.execute_bash_cmd(
+            vu.generate_domblklist_str(self.name))
+        return vu.get_disk_paths(output)[0]
+
+    def _wait_for_agent_event(self, seconds):
+        """
+        Block until the qemu agent of the domain connects/disconnects or
+        'seconds' pass, whatever happens first.
+        """
+        cmd = vu.generate_event_wait_str(self.name, 'agent-lifecycle',
+                                         max(1, math.ceil(seconds)))
+        libutils.execute_bash_cmd(cmd, timeout=seconds + 10,
+                                  exit_on_failure=False)
+
     def wait_for_qemu_agent_ready(self, timeout=300):
         """
         Waits for qemu agent available in the domain by running a simple
         command and check that it doesn't fail.
+
+        Instead of sleeping between checks, it listens for the libvirt
+        'agent-lifecycle' event, so the agent is detected as soon as it
+        connects.
         """
-        i = 0
-        while (i < int(timeout / 10)):
-            if self.check_qemu_agent():
-                return
-            else:
-                i += 1
-                time.sleep(10)
+        if libutils.wait_for(self.check_qemu_agent, timeout,
+                             waiter=self._wait_for_agent_event):
+            return
         raise libutils.TrfmDomainTimeout("Qemu-agent is not available on the "
                                          "domain {}.".format(self.name))
 
+    def get_lease_ip(self):
+        """
+        Return the first IPv4 address leased to the domain by the DHCP server
+        of its libvirt network or None if there is no lease yet.
+        """
+        output = libutils.execute_bash_cmd(
+            vu.generate_domifaddr_str(self.name), exit_on_failure=False)
+        ips = vu.get_ipv4_addresses(output)
+        if ips:
+            return ips[0]
+        return None
+
+    def wait_for_ip_lease(self, timeout=300):
+        """
+        Waits until the DHCP server of the environment network has leased an
+        IP to the domain and stores it in 'self.ip'.
+        """
+        def has_lease():
+            self.ip = self.get_lease_ip()
+            return self.ip is not None
+
+        if not libutils.wait_for(has_lease, timeout):
+            raise libutils.TrfmDomainTimeout(
+                "The domain {} didn't get any DHCP lease.".format(self.name))
+        self.logger.debug("Domain '{}' got IP '{}'".format(self.name, self.ip))
+
+    def _ping(self):
+        try:
+            libutils.execute_bash_cmd("ping -c 1 -W 1 {}".format(self.ip))
+            return True
+        except libutils.TrfmCommandFailed:
+            return False
+
     def wait_for_ip_ready(self, timeout=300):
         """
         Waits until domain's ip is pingable.
@@ -179,17 +441,9 @@ class Domain(object):
         The user is responsible to use an image which allows ingress ICMP
         traffic.
         """
-        i = 0
-        while (i < int(timeout / 10)):
-            try:
-                cmd = "ping -c 1 {}".format(self.ip)
-                libutils.execute_bash_cmd(cmd)
-                self.logger.debug("IP '{}' reachable".format(self.ip))
-                return
-            except libutils.TrfmCommandFailed:
-                i += 1
-                time.sleep(10)
-        raise libutils.TrfmDomainTimeout
+        if not libutils.wait_for(self._ping, timeout):
+            raise libutils.TrfmDomainTimeout
+        self.logger.debug("IP '{}' reachable".format(self.ip))
 
     def wait_for_ssh_ready(self, timeout=300):
         """
@@ -198,18 +452,42 @@ class Domain(object):
         The user is responsible to use an image which allows ingress traffic in
         port 22 TCP. Any firewall rules must be disabled beforehand.
         """
-        i = 0
-        while (i < int(timeout / 10)):
-            try:
-                cmd = "nc -vz -w 1 {} 22".format(self.ip)
-                libutils.execute_bash_cmd(cmd)
-                self.logger.debug("SSH on port 22 reachable")
-                return
-            except libutils.TrfmCommandFailed:
-                i += 1
-                time.sleep(10)
+        if libutils.wait_for(lambda: libutils.tcp_port_is_open(self.ip, 22),
+                             timeout):
+            self.logger.debug("SSH on port 22 reachable")
+            return
         self.logger.warning("SSH is not available on the domain.")
 
+    def wait_for_ready(self, timeout=300):
+        """
+        Waits until the domain can be used by the tests.
+
+        Domains with network interfaces but without a static IP get one from
+        the DHCP server while they boot, so the lease is polled until it
+        exists. Only if there is no lease by the timeout (or the domain has
+        no network) is the domain used through its qemu agent alone.
+        Domains with an IP must answer to ping and SSH.
+        """
+        deadline = time.monotonic() + timeout
+        if (self.ip is None and self.has_network()):
+            def has_lease():
+                self.ip = self.get_lease_ip()
+                return self.ip is not None
+
+            if not libutils.wait_for(has_lease, timeout):
+                self.logger.warning("The domain {} got no DHCP lease".
+                                    format(self.name))
+        if (self.ip is None):
+            if not libutils.wait_for(self.check_qemu_agent,
+                                     max(0, deadline - time.monotonic()),
+                                     waiter=self._wait_for_agent_event):
+                raise libutils.TrfmDomainTimeout(
+                    "The domain {} got no DHCP lease and its qemu agent is "
+                    "not available.".format(self.name))
+            return
+        self.wait_for_ip_ready(timeout)
+        self.wait_for_ssh_ready(timeout)
+
     def snapshot(self, action):
         """
         Create a snapshot of the domain
@@ -25,25 +25,38 @@ import random
 import tempfile
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from qatrfm import hooks
+from qatrfm import layers
+from qatrfm import placement
+from qatrfm import teardown
 from qatrfm.domain import Domain
+from qatrfm.telemetry import TelemetrySampler
+from qatrfm.template import TemplateStore
 from qatrfm.utils.logger import QaTrfmLogger
 from qatrfm.utils import libutils
+from qatrfm.utils import registry
+from qatrfm.utils import tf_utils
 
 
 class TerraformCmd:
 
     logger = QaTrfmLogger.getQatrfmLogger(__name__)
 
-    def __init__(self, tf_file, tf_vars=None):
+    def __init__(self, tf_file, tf_vars=None, workdir=None):
         self.tf_file = tf_file
         self.logger.info("Terraform TF file: {}".format(self.tf_file))
-        if tf_vars:
-            self.tf_vars = TerraformCmd.vars_to_string(tf_vars)
-        self.workdir = tempfile.mkdtemp()
+        self.vars = list(tf_vars or [])
+        self.tf_vars = TerraformCmd.vars_to_string(self.vars)
+        if workdir:
+            # Working directory of an already deployed environment
+            self.workdir = workdir
+        else:
+            self.workdir = tempfile.mkdtemp()
+            shutil.copy(self.tf_file, self.workdir + '/env.tf')
         self.logger.debug("Using working directory {}".format(self.workdir))
-        shutil.copy(self.tf_file, self.workdir + '/env.tf')
 
     @staticmethod
     def vars_to_string(vars):
@@ -55,6 +68,12 @@ class TerraformCmd:
             s += "-var '{}={}' ".format(kv[0], kv[1])
         return s
 
+    def set_var(self, key, value):
+        """ Set (or replace) a variable for the next terraform commands """
+        self.vars = [v for v in self.vars if v.split('=', 1)[0] != key]
+        self.vars.append('{}={}'.format(key, value))
+        self.tf_vars = TerraformCmd.vars_to_string(self.vars)
+
     def deploy(self):
         """ Deploy Environment
 
@@ -74,16 +93,20 @@ class TerraformCmd:
             sys.exit(-1)
 
         try:
-            cmd = "terraform apply -input=false -auto-approve {}".format(
-                self.tf_vars)
-            if ('LOG_COLORS' not in os.environ):
-                cmd = ("{} -no-color".format(cmd))
-            libutils.execute_bash_cmd(cmd, timeout=1000, cwd=self.workdir)
+            self.apply()
         except (libutils.TrfmCommandFailed, libutils.TrfmCommandTimeout) as e:
             self.logger.error(e)
             self.clean()
             sys.exit(-1)
 
+    def apply(self):
+        """ Apply the .tf file with the current variables """
+        cmd = "terraform apply -input=false -auto-approve {}".format(
+            self.tf_vars)
+        if ('LOG_COLORS' not in os.environ):
+            cmd = ("{} -no-color".format(cmd))
+        libutils.execute_bash_cmd(cmd, timeout=1000, cwd=self.workdir)
+
     def clean(self):
         """ Destroys the Terraform environment """
         self.logger.info("Removing Terraform Environment...")
@@ -108,18 +131,303 @@ class TerraformCmd:
         return json.loads(output)[variable]['value'][0]
 
 
-class TerraformEnv(TerraformCmd):
+class BaseEnv(object):
+    """
+    Behaviour shared by all the environments (terraform, containers and
+    leased subsets): they have 'domains', a .tf file with its variables,
+    'setup_steps' and optionally snapshots. The setup steps are only cached
+    as layers (see 'layer_keys') by TerraformEnv.
+    """
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+    layer_keys = None
+    # Lock file keeping the network octet of the environment taken
+    octet_lock = None
+
+    def release_octet(self):
+        """ Let other environments use the network octet once removed """
+        if (self.octet_lock is not None):
+            self.octet_lock.close()
+            self.octet_lock = None
+
+    def num_domains(self):
+        """ Number of domains of the .tf file with the current variables """
+        variables = tf_utils.get_effective_vars(self.tf_file, self.vars)
+        domains = tf_utils.get_resources(Path(self.tf_file).read_text(),
+                                         'libvirt_domain')
+        if not domains:
+            return 0
+        return tf_utils.resolve(domains[0].get('count'), variables, 1)
+
+    def apply_setup(self, steps, domains=None):
+        """
+        Run setup steps on all the domains (or the given ones) at the same
+        time
+        """
+        if domains is None:
+            domains = self.domains
+
+        def run(domain):
+            batch = []
+            for step in steps:
+                if (isinstance(step, dict) and 'put' in step):
+                    if (batch):
+                        domain.execute_batch(batch, timeout=1000)
+                        batch = []
+                    domain.transfer_file(step['path'], step['put'],
+                                         type='put')
+                else:
+                    batch.append(step)
+            if (batch):
+                domain.execute_batch(batch, timeout=1000)
+
+        if not domains or not steps:
+            return
+        with ThreadPoolExecutor(max_workers=len(domains)) as executor:
+            for future in [executor.submit(run, d) for d in domains]:
+                future.result()
+
+    def run_setup(self, first=0):
+        """
+        Run the setup steps from 'first' on, capturing a layer after each
+        one if the layer cache is used.
+        """
+        if (first < len(self.setup_steps)):
+            self.logger.info("Running {} setup steps...".format(
+                len(self.setup_steps) - first))
+        for i in range(first, len(self.setup_steps)):
+            self.apply_setup([self.setup_steps[i]])
+            if (self.layer_keys is None):
+                continue
+            try:
+                self.layer_cache.capture(self.layer_keys[i], self.domains[0])
+            except libutils.TrfmCommandFailed as e:
+                self.logger.warning("Failed to capture layer, the next "
+                                    "setup steps won't be cached:\n{}".
+                                    format(e))
+                self.layer_keys = None
+
+    def start_telemetry(self, interval=5):
+        """ Start sampling the resource usage of the domains and the host """
+        self.sampler = TelemetrySampler(self.domains, interval)
+        self.sampler.start()
+
+    def stop_telemetry(self, path=None):
+        """
+        Stop the telemetry sampler, store the samples in 'path' if given
+        and return a summary of them as a list of lines.
+        """
+        if self.sampler is None:
+            return []
+        self.sampler.stop()
+        if path is not None:
+            self.sampler.save(path)
+        summary = self.sampler.summary()
+        self.sampler = None
+        return summary
+
+    def reset(self):
+        """
+        Reverts the domains to their initial snapshots. If that fails, the
+        error is raised and the owner of the environment removes it: other
+        tests may be using its other domains (see qatrfm.lease).
+        """
 
-    def __init__(self, net_octet, tf_vars, tf_file, snapshots=False):
-        """Initialize Terraform Environment object."""
+        self.logger.info("Reseting the Terraform Environment...")
+        if (not self.snapshots):
+            # Nothing to reset
+            return
+        hooks.call('before_reset', self)
+        for domain in self.domains:
+            domain.snapshot(action='revert')
+            time.sleep(5)
+        hooks.call('after_reset', self)
+
+
+class TerraformEnv(TerraformCmd, BaseEnv):
+
+    # Variables which qatrfm may change after the deployment. Some of them
+    # are ForceNew for the domains, so they are kept in the registry.
+    STATE_VARS = ('num_domains', 'image', 'running', 'domain_ips', 'cpuset',
+                  'numa_node')
+
+    def __init__(self, net_octet, tf_vars, tf_file, snapshots=False,
+                 admission=None, basename=None, workdir=None, fast=False,
+                 templates=False, setup_steps=None, layer_cache=None):
+        """
+        Initialize Terraform Environment object.
+
+        'basename' and 'workdir' are only given to attach to an environment
+        which is already deployed (see TerraformEnv.attach).
+        If 'fast' is True, clean() removes the resources directly through
+        libvirt and only uses 'terraform destroy' if that fails.
+        If 'templates' is True, the domains are restored from the template
+        of the environment fingerprint, or a template is created from them.
+        'setup_steps' are run on all the domains once they are ready (see
+        qatrfm.layers), caching them in 'layer_cache' (a LayerCache) if given.
+        """
         self.snapshots = snapshots
-        letters = string.ascii_lowercase
-        self.basename = ''.join(random.choice(letters) for i in range(10))
+        self.fast = fast
+        self.templates = templates
+        self.template = None
+        self.restored = []
+        self.admission = admission
+        self.setup_steps = list(setup_steps or [])
+        self.layer_cache = layer_cache
+        self.layer_keys = None
+        self.cached_steps = 0
+        if basename is None:
+            letters = string.ascii_lowercase
+            basename = ''.join(random.choice(letters) for i in range(10))
+        self.basename = basename
         self.domains = []
         self.net_octet = net_octet
-        tf_vars.add('basename=' + self.basename)
-        tf_vars.add('net_octet={}'.format(self.net_octet))
-        super().__init__(tf_file, tf_vars)
+        self.sampler = None
+        tf_vars = list(tf_vars)
+        self.user_vars = list(tf_vars)
+        tf_vars.append('basename=' + self.basename)
+        tf_vars.append('net_octet={}'.format(self.net_octet))
+        super().__init__(tf_file, tf_vars, workdir)
+
+    @staticmethod
+    def static_ip(net_octet, index):
+        """ Address of the domain 'index' in the network 10.X.0.0/24 """
+        return '10.{}.0.{}'.format(net_octet, 10 + index)
+
+    def use_cached_layers(self):
+        """
+        Boot the domains from the layer of the longest cached prefix of the
+        setup steps. Returns the number of steps which are already applied.
+        """
+        if (not self.setup_steps or self.layer_cache is None or
+                not tf_utils.declares_variable(self.tf_file, 'image')):
+            return 0
+        image = tf_utils.get_effective_vars(self.tf_file,
+                                            self.vars).get('image')
+        self.layer_keys = layers.chain_keys(image, self.setup_steps)
+        cached = self.layer_cache.lookup(self.layer_keys)
+        if (cached):
+            self.logger.info("Using cached layer of {}/{} setup steps".format(
+                cached, len(self.setup_steps)))
+            self.set_var('image',
+                         self.layer_cache.path(self.layer_keys[cached - 1]))
+        return cached
+
+    def set_static_ips(self):
+        """
+        Give each domain a fixed address calculated from the network octet,
+        if the .tf file supports it (variable 'domain_ips'). Thus, terraform
+        doesn't need to wait for the DHCP leases and the domains can be
+        probed as soon as they are created.
+        """
+        if not tf_utils.declares_variable(self.tf_file, 'domain_ips'):
+            return
+        ips = [TerraformEnv.static_ip(self.net_octet, i)
+               for i in range(self.num_domains())]
+        self.set_var('domain_ips', json.dumps(ips))
+
+    def set_placement(self, cpusets, nodes):
+        """
+        Pin the vCPUs of each domain to its host CPUs and its memory to its
+        NUMA node, if the .tf file supports it (list variables 'cpuset' and
+        'numa_node', one entry per domain). Domains without CPUs or node are
+        unpinned.
+        """
+        self.set_var('cpuset', json.dumps(
+            [placement.format_cpulist(cpus) for cpus in cpusets]))
+        if (tf_utils.declares_variable(self.tf_file, 'numa_node')):
+            self.set_var('numa_node', json.dumps(
+                ['' if node is None else str(node) for node in nodes]))
+
+    def get_cpusets(self):
+        """ Host CPUs of each domain given to set_placement """
+        cpuset = tf_utils.parse_vars(self.vars).get('cpuset')
+        if (not cpuset):
+            return []
+        return [placement.parse_cpulist(cpus) for cpus in json.loads(cpuset)]
+
+    @staticmethod
+    def compute_fingerprint(tf_file, tf_vars, setup_steps=None):
+        """
+        Hash of the .tf file, the user variables and the setup steps.
+        Environments with the same fingerprint can be reused by each other's
+        tests.
+        """
+        fingerprint = tf_utils.fingerprint(tf_file, tf_vars)
+        if (setup_steps):
+            fingerprint = layers.chain_keys(fingerprint, setup_steps)[-1]
+        return fingerprint
+
+    @property
+    def fingerprint(self):
+        return TerraformEnv.compute_fingerprint(self.tf_file, self.user_vars,
+                                                self.setup_steps)
+
+    def registry_info(self):
+        """
+        Information of the environment stored in the registry, including
+        the variables set by qatrfm (see attach).
+        """
+        tf_vars = tf_utils.parse_vars(self.vars)
+        return {'workdir': self.workdir, 'net_octet': self.net_octet,
+                'tf_file': str(self.tf_file),
+                'fingerprint': self.fingerprint,
+                'snapshots': self.snapshots, 'restored': self.restored,
+                'cached_steps': self.cached_steps,
+                'tf_vars': {k: v for k, v in tf_vars.items()
+                            if k in TerraformEnv.STATE_VARS}}
+
+    @classmethod
+    def attach(cls, entry, tf_vars, tf_file, snapshots=False, fast=False,
+               setup_steps=None):
+        """
+        Attach to an environment deployed by a previous run.
+
+        The domains are restored from the terraform state of its working
+        directory and reverted to their snapshots if it has them. The
+        variables set by qatrfm when it was deployed or scaled are set again,
+        so that applying it doesn't replace its domains. Returns None if any
+        of its domains is not running anymore.
+        """
+        env = cls(entry['net_octet'], tf_vars, tf_file, snapshots=snapshots,
+                  basename=entry['basename'], workdir=entry['workdir'],
+                  fast=fast, setup_steps=setup_steps)
+        env.restored = entry.get('restored', [])
+        env.cached_steps = entry.get('cached_steps', 0)
+        for key, value in entry.get('tf_vars', {}).items():
+            env.set_var(key, value)
+        try:
+            env.domains = env.get_domains()
+        except (libutils.TrfmCommandFailed, ValueError, KeyError) as e:
+            cls.logger.warning("Can't read the state of environment {}: {}".
+                               format(env.basename, e))
+            return None
+        if not env.domains or not all(d.is_running() for d in env.domains):
+            cls.logger.warning("Environment {} is not healthy".
+                               format(env.basename))
+            return None
+        for domain in env.domains:
+            if (domain.ip is None):
+                # Running domains already have their lease
+                domain.ip = domain.get_lease_ip()
+        registry.update(env.basename, pid=os.getpid(), **env.registry_info())
+        if (snapshots and entry.get('snapshots')):
+            env.reset()
+        elif (snapshots):
+            env.create_snapshots()
+        cls.logger.success("Reusing environment {}".format(env.basename))
+        return env
+
+    @staticmethod
+    def find_reusable(fingerprint):
+        """
+        Return the registry entries of the environments with the given
+        fingerprint which are not used by any running qatrfm process.
+        """
+        return [e for e in registry.list_entries()
+                if e.get('fingerprint') == fingerprint and
+                registry.workdir_exists(e) and
+                not registry.owner_alive(e)]
 
     def get_domains(self):
         """
@@ -138,6 +446,7 @@ class TerraformEnv(TerraformCmd):
 
         # format of domain_names: ['name1', 'name2']
         # format of domain_ips: [['10.40.1.81'], ['10.40.1.221']]  or [[],[]]
+        # Domains without IP get their DHCP lease later (see wait_for_ready)
         i = 0
         while i < len(domain_names):
             if (domain_ips[i] == []):
@@ -149,6 +458,22 @@ class TerraformEnv(TerraformCmd):
 
         return domains
 
+    def wait_for_domains(self, domains, timeout=300):
+        """
+        Wait until all the given domains are ready.
+
+        Every domain is probed in its own thread, so the total waiting time is
+        the one of the slowest domain instead of the sum of all of them.
+        """
+        self.logger.info("Waiting for domains to be ready...")
+        if not domains:
+            return
+        with ThreadPoolExecutor(max_workers=len(domains)) as executor:
+            futures = [executor.submit(d.wait_for_ready, timeout)
+                       for d in domains]
+            for future in futures:
+                future.result()
+
     def deploy(self):
         """ Deploy Environment
 
@@ -157,51 +482,186 @@ class TerraformEnv(TerraformCmd):
         If snapshots is set to True, after the domains are up, it will create a
         snapshot for each domain in case they are needed to be reverted
         at a certain point of the test flow.
+
+        With templates enabled, the domains are not booted if there is a
+        template for the environment: its saved state is restored instead.
+        Otherwise, a template is created once the domains are ready.
+
+        The setup steps are run before the template and the snapshots are
+        created. The ones already cached as layers are skipped.
         """
 
+        hooks.call('before_deploy', self)
+        if (self.admission):
+            self.admission.admit(self)
+        else:
+            registry.register(self.basename, **self.registry_info())
+        if (self.templates):
+            self.template = TemplateStore(self.fingerprint)
+            if (not self.template.lock(shared=self.template.exists())):
+                self.logger.info("Template in use by another environment")
+                self.template = None
+        restore = (self.template is not None and self.template.exists() and
+                   tf_utils.declares_variable(self.tf_file, 'running'))
+        if (restore):
+            self.set_var('running', 'false')
+            cached = len(self.setup_steps)
+        else:
+            cached = self.use_cached_layers()
+        self.cached_steps = cached
+        self.set_static_ips()
         super().deploy()
+        registry.update(self.basename, **self.registry_info())
 
         self.domains = self.get_domains()
 
-        self.logger.info("Waiting for domains to be ready...")
-        for domain in self.domains:
-            if (domain.ip):
-                domain.wait_for_ip_ready()
-                domain.wait_for_ssh_ready()
-            else:
-                domain.wait_for_qemu_agent_ready()
-
-        if (self.snapshots):
-            self.logger.debug("Creating snapshots of domains...")
+        booted = []
+        if (restore):
+            restored = self.template.restore(self.domains)
+            booted = [d for d in self.domains if d not in restored]
+            self.restored = [d.name for d in restored]
+            registry.update(self.basename, restored=self.restored)
             for domain in self.domains:
                 try:
-                    domain.snapshot(action='create')
-                except libutils.TrfmSnapshotFailed:
-                    sys.exit(-1)
-        self.logger.success("Environment deployed successfully.")
+                    domain.wait_for_ip_lease()
+                except libutils.TrfmDomainTimeout as e:
+                    self.logger.warning(e)
 
-    def reset(self):
-        """ Reverts the domains to their initial snapshots """
+        self.wait_for_domains(self.domains)
+        self.run_setup(cached)
+        # The domains which couldn't be restored miss the setup steps
+        self.apply_setup(self.setup_steps, booted)
 
-        self.logger.info("Reseting the Terraform Environment...")
-        if (not self.snapshots):
-            # Nothing to reset
+        if (self.template is not None and not restore):
+            try:
+                self.template.capture(self.domains)
+            except libutils.TrfmCommandFailed as e:
+                self.logger.warning("Failed to create template:\n{}".
+                                    format(e))
+
+        if (self.snapshots):
+            try:
+                self.create_snapshots()
+            except libutils.TrfmSnapshotFailed:
+                sys.exit(-1)
+        self.logger.success("Environment deployed successfully.")
+        hooks.call('after_deploy', self)
+
+    def scale(self, num_domains, timeout=300):
+        """
+        Change the number of domains of a deployed environment.
+
+        Terraform is applied again with the new 'num_domains': only the new
+        domains are created (and waited for in parallel), or only the last
+        ones are destroyed. The Domain objects of the domains which are kept
+        don't change. The new domains get the setup steps and snapshots of
+        the environment. With admission control, it waits until the host has
+        room for the new footprint.
+        """
+        current = len(self.domains)
+        if (num_domains == current):
             return
-        for domain in self.domains:
+        if (not tf_utils.declares_variable(self.tf_file, 'num_domains')):
+            raise libutils.TrfmDeployError(
+                "The .tf file doesn't declare the variable 'num_domains'")
+        if (self.restored):
+            raise libutils.TrfmDeployError(
+                "Environments restored from a template can't be scaled")
+        self.logger.info("Scaling environment {} from {} to {} domains...".
+                         format(self.basename, current, num_domains))
+        self.set_var('num_domains', num_domains)
+        if (self.admission):
             try:
-                domain.snapshot(action='revert')
-                time.sleep(5)
-            except libutils.TrfmSnapshotFailed as e:
-                shutil.rmtree(self.workdir)
-                raise(e)
+                self.admission.resize(self)
+            except libutils.TrfmDeployError:
+                self.set_var('num_domains', current)
+                raise
+        removed = self.domains[num_domains:]
+        if (self.snapshots):
+            # Domains with snapshots can't be undefined
+            for domain in removed:
+                domain.snapshot(action='delete')
+        self.set_static_ips()
+        self.apply()
+        registry.update(self.basename, **self.registry_info())
+
+        names = [d.name for d in self.domains]
+        new = [d for d in self.get_domains() if d.name not in names]
+        self.domains = self.domains[:num_domains] + new
+        self.wait_for_domains(new, timeout)
+        self.apply_setup(self.setup_steps[self.cached_steps:], new)
+        if (self.snapshots):
+            for domain in new:
+                domain.snapshot(action='create')
+        self.logger.success("Environment {} has {} domains".format(
+            self.basename, len(self.domains)))
+
+    def create_snapshots(self):
+        self.logger.debug("Creating snapshots of domains...")
+        for domain in self.domains:
+            domain.snapshot(action='create')
+
+    def fast_clean(self):
+        """
+        Destroys the libvirt resources of the environment directly.
+
+        All the resources follow the 'qatrfm-<type>-<basename>' naming
+        convention, so they can be removed in parallel through libvirt
+        without refreshing the terraform state. Returns False if it failed,
+        the .tf file doesn't follow the convention or no resource was found:
+        'terraform destroy' is needed then.
+        """
+        if (not tf_utils.follows_naming_convention(self.tf_file)):
+            self.logger.warning("The resources of {} don't follow the naming "
+                                "convention, using terraform destroy".
+                                format(self.tf_file))
+            return False
+        self.logger.info("Removing libvirt resources of {}...".
+                         format(self.basename))
+        try:
+            resources = teardown.find_resources(self.basename)
+            if self.basename not in resources:
+                self.logger.warning("No libvirt resources found for {}, "
+                                    "using terraform destroy".
+                                    format(self.basename))
+                return False
+            teardown.destroy_resources(resources[self.basename])
+        except (libutils.TrfmCommandFailed,
+                libutils.TrfmCommandTimeout) as e:
+            self.logger.warning("Fast clean failed, falling back to "
+                                "terraform destroy:\n{}".format(e))
+            return False
+        shutil.rmtree(self.workdir)
+        self.logger.success("Environment clean")
+        return True
 
     def clean(self):
         """ Destroys the Terraform environment """
+        hooks.call('before_clean', self)
+        if (self.fast and self.fast_clean()):
+            self._release()
+            return
         if (self.snapshots):
             for domain in self.domains:
                 try:
                     domain.snapshot(action='delete')
                 except libutils.TrfmSnapshotFailed as e:
+                    if (not domain.exists()):
+                        # Already removed by a partial fast clean
+                        continue
                     shutil.rmtree(self.workdir)
                     raise(e)
+        if (self.restored):
+            # The restored domains have the UUID of the template domains,
+            # terraform doesn't know them
+            teardown.destroy_resources({'domains': self.restored,
+                                        'volumes': [], 'networks': []})
         super().clean()
+        self._release()
+
+    def _release(self):
+        registry.unregister(self.basename)
+        self.release_octet()
+        if (self.template is not None):
+            self.template.release()
+        hooks.call('after_clean', self)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Guest command executor
+
+Runs many commands at the same time inside a domain through the qemu agent.
+Each command is started with 'guest-exec' right away and a single thread
+per domain polls the status of all the outstanding processes, waiting less
+between polls while processes are finishing and more while nothing happens.
+"""
+
+import threading
+import time
+
+from concurrent.futures import Future
+
+from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import libutils
+from qatrfm.utils import qemu_agent_utils as qau
+
+
+class GuestProcess(object):
+    """ Handle of a command running in a domain """
+
+    def __init__(self, executor, cmd, pid, timeout):
+        """Initialize GuestProcess object."""
+        self.executor = executor
+        self.cmd = cmd
+        self.pid = pid
+        self.deadline = time.monotonic() + timeout
+        self.future = Future()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """
+        Wait for the command and return [retcode, output] like execute_cmd
+        (stderr is returned as output if the command failed). Raises
+        TrfmCommandTimeout if it didn't finish in time and CancelledError if
+        it was cancelled.
+        """
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """ Stop waiting for the command and kill it in the domain """
+        return self.executor.cancel(self)
+
+
+class GuestExecutor(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, domain, min_interval=0.2, max_interval=2):
+        """Initialize GuestExecutor object."""
+        self.domain = domain
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.processes = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def _exec(self, cmd):
+        cmd = cmd.replace('"', '\\"').replace('\n', '\\n')
+        out_json = libutils.execute_bash_cmd(
+            qau.generate_guest_exec_str(self.domain.name, cmd))
+        return qau.get_pid(out_json)
+
+    def submit(self, cmd, timeout=300):
+        """ Start a command in the domain and return its GuestProcess """
+        if not self.domain.check_qemu_agent():
+            raise libutils.TrfmQemuAgentNotReady("Qemu-agent is not running "
+                                                 "on the domain")
+        pid = self._exec(cmd)
+        self.logger.debug("The command '{}' has PID={}".format(cmd, pid))
+        process = GuestProcess(self, cmd, pid, timeout)
+        with self.lock:
+            self.processes.append(process)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return process
+
+    def _kill(self, process):
+        try:
+            self._exec('kill -TERM {}'.format(process.pid))
+        except libutils.TrfmCommandFailed as e:
+            self.logger.warning("Failed to kill PID {} on domain {}: {}".
+                                format(process.pid, self.domain.name, e))
+
+    def cancel(self, process):
+        with self.lock:
+            if process not in self.processes or process.future.done():
+                return False
+            self.processes.remove(process)
+            process.future.cancel()
+        self._kill(process)
+        return True
+
+    def _finish(self, process, result=None, exception=None):
+        with self.lock:
+            if process in self.processes:
+                self.processes.remove(process)
+            if process.future.done():
+                # Cancelled meanwhile
+                return
+            if exception is not None:
+                process.future.set_exception(exception)
+            else:
+                process.future.set_result(result)
+
+    def _poll(self, process):
+        """ Returns True if the process is not outstanding anymore """
+        out_json = libutils.execute_bash_cmd(
+            qau.generate_guest_exec_status(self.domain.name, process.pid))
+        if qau.process_is_exited(out_json):
+            retcode = qau.get_ret_code(out_json)
+            if retcode != 0:
+                output = qau.get_output(out_json, 'err-data')
+            else:
+                output = qau.get_output(out_json)
+            self.domain._print_log(process.cmd, retcode, output)
+            self._finish(process, result=[retcode, output])
+            return True
+        if time.monotonic() > process.deadline:
+            self.logger.error("The command '{}' on the domain '{}' timed out.".
+                              format(process.cmd, self.domain.name))
+            self._kill(process)
+            self._finish(process, exception=libutils.TrfmCommandTimeout(
+                process.cmd))
+            return True
+        return False
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self.lock:
+                processes = list(self.processes)
+                if not processes:
+                    self.thread = None
+                    return
+            finished = False
+            for process in processes:
+                if process.future.done():
+                    continue
+                try:
+                    finished |= self._poll(process)
+                except Exception as e:
+                    self._finish(process, exception=e)
+                    finished = True
+            if finished:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+            if self.wakeup.wait(interval):
+                # New command submitted, poll again soon
+                self.wakeup.clear()
+                interval = self.min_interval
+
+    def shutdown(self):
+        """ Cancel all the outstanding commands """
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            process.cancel()
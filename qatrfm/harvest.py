@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Artifact harvest
+
+Plugin which collects files of the domains (logs, cores, ...) when each
+test finishes, before its domains are reverted or removed. The files are
+read straight from the disks of the domains with libguestfs while they are
+paused, so it works even if the guest hung or lost its network. The files
+of all the domains used by a test are stored in <output_dir>/<test>.tar.gz,
+under a directory per domain and with their full path.
+"""
+
+import shutil
+import tarfile
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from qatrfm.hooks import TrfmPlugin
+from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import libutils
+from qatrfm.utils import virsh_utils as vu
+
+
+def target_dir(path, target):
+    """
+    Directory under 'target' where a file of the domain is copied, so that
+    it keeps its full path.
+    """
+    return Path(target) / str(Path(path).parent).lstrip('/')
+
+
+def generate_glob_expand_str(disk, patterns):
+    """ guestfish command listing the paths matching the patterns """
+    return 'guestfish --ro -a {} -i {}'.format(disk, ' : '.join(
+        ["glob-expand '{}'".format(pattern) for pattern in patterns]))
+
+
+def generate_copy_out_str(disk, copies):
+    """ guestfish command copying [(path, directory), ...] from a disk """
+    return 'guestfish --ro -a {} -i {}'.format(disk, ' : '.join(
+        ["copy-out '{}' {}".format(path, directory)
+         for path, directory in copies]))
+
+
+class HarvestPlugin(TrfmPlugin):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, output_dir, patterns=None, max_workers=4):
+        """
+        Initialize HarvestPlugin object. 'patterns' are the paths or globs
+        collected after every test, on top of the 'artifacts' of the test.
+        """
+        self.output_dir = Path(output_dir)
+        self.patterns = list(patterns or [])
+        self.max_workers = max_workers
+
+    def _copy_out(self, disk, patterns, target):
+        output = libutils.execute_bash_cmd(
+            generate_glob_expand_str(disk, patterns), timeout=600)
+        # Directories are listed with a trailing slash
+        paths = sorted(set(line.strip().rstrip('/')
+                           for line in output.splitlines() if line.strip()))
+        if not paths:
+            return
+        copies = [(p, target_dir(p, target)) for p in paths]
+        for _, directory in copies:
+            directory.mkdir(parents=True, exist_ok=True)
+        libutils.execute_bash_cmd(generate_copy_out_str(disk, copies),
+                                  timeout=600)
+
+    def _harvest_domain(self, domain, patterns, target):
+        disk = domain.get_disk_path()
+        # Flush the guest file systems if the agent still answers
+        frozen = False
+        try:
+            if (domain.check_qemu_agent()):
+                try:
+                    libutils.execute_bash_cmd(
+                        vu.generate_domfsfreeze_str(domain.name))
+                    frozen = True
+                except libutils.TrfmCommandFailed:
+                    pass
+            libutils.execute_bash_cmd(vu.generate_suspend_str(domain.name))
+            try:
+                self._copy_out(disk, patterns, target)
+            finally:
+                libutils.execute_bash_cmd(
+                    vu.generate_resume_str(domain.name))
+        finally:
+            if (frozen):
+                libutils.execute_bash_cmd(
+                    vu.generate_domfsthaw_str(domain.name),
+                    exit_on_failure=False)
+
+    def harvest(self, name, domains, patterns):
+        """
+        Collect the files matching 'patterns' from the domains, all of them
+        at the same time, into <output_dir>/<name>.tar.gz
+        """
+        workdir = tempfile.mkdtemp()
+        try:
+            def run(domain):
+                try:
+                    self._harvest_domain(domain, patterns,
+                                         Path(workdir) / domain.name)
+                except (libutils.TrfmCommandFailed,
+                        libutils.TrfmCommandTimeout) as e:
+                    self.logger.warning("Failed to harvest domain {}:\n{}".
+                                        format(domain.name, e))
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(run, domains))
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            archive = self.output_dir / '{}.tar.gz'.format(name)
+            with tarfile.open(str(archive), 'w:gz') as tar:
+                for domain in domains:
+                    if (Path(workdir) / domain.name).is_dir():
+                        tar.add(str(Path(workdir) / domain.name),
+                                arcname=domain.name)
+            self.logger.info("Artifacts of '{}' stored in {}".format(
+                name, archive))
+        finally:
+            shutil.rmtree(workdir)
+
+    def after_test(self, test, exit_code):
+        patterns = self.patterns + list(getattr(test, 'artifacts', None) or [])
+        if not patterns or not test.env.domains:
+            return
+        self.harvest(test.name, test.env.domains, patterns)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Lifecycle hooks
+
+Plugins can be registered to be called before and after the main steps of
+the life of an environment and its tests (deploy, test, reset, clean).
+A plugin inherits from TrfmPlugin and overrides the hooks it needs.
+"""
+
+from qatrfm.utils.logger import QaTrfmLogger
+
+logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+_plugins = []
+
+
+class TrfmPlugin(object):
+
+    def before_deploy(self, env):
+        pass
+
+    def after_deploy(self, env):
+        pass
+
+    def before_test(self, test):
+        pass
+
+    def after_test(self, test, exit_code):
+        pass
+
+    def before_reset(self, env):
+        pass
+
+    def after_reset(self, env):
+        pass
+
+    def before_clean(self, env):
+        pass
+
+    def after_clean(self, env):
+        pass
+
+
+def register_plugin(plugin):
+    _plugins.append(plugin)
+
+
+def unregister_plugin(plugin):
+    _plugins.remove(plugin)
+
+
+def call(hook, *args):
+    """
+    Call a hook of all the registered plugins. A failing plugin doesn't stop
+    the test flow, its error is only logged.
+    """
+    for plugin in list(_plugins):
+        try:
+            getattr(plugin, hook)(*args)
+        except Exception as e:
+            logger.error("Plugin {} failed in {}: {}".format(
+                type(plugin).__name__, hook, e))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Run journal
+
+Append-only record of what happens during a run, one JSON event per line:
+    - env_deployed: an environment is ready (tf_file, basename, workdir,
+      net_octet, snapshots)
+    - env_released: an environment is being removed
+    - test_finished: a test ended (test, tf_file, exit_code)
+Every event is flushed to disk when it is recorded, so a run which crashes
+or is interrupted can be resumed from its journal: the environments which
+are still alive are reused and the tests which already passed are skipped.
+"""
+
+import json
+import os
+import threading
+import time
+
+from pathlib import Path
+
+from qatrfm.testcase import TrfmTestCase
+from qatrfm.utils.logger import QaTrfmLogger
+
+
+def test_id(test):
+    """ Identifier of a test case class in the journal """
+    return '{}.{}'.format(test.__module__, test.__name__)
+
+
+def load(path):
+    """ Return the events of a journal, ignoring a truncated last line """
+    events = []
+    try:
+        lines = Path(path).read_text().splitlines()
+    except FileNotFoundError:
+        return events
+    for line in lines:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            pass
+    return events
+
+
+def passed_tests(events):
+    """ Tests whose last run finished successfully """
+    outcomes = {}
+    for e in events:
+        if e['event'] == 'test_finished':
+            outcomes[e['test']] = e['exit_code']
+    return set(t for t, exit_code in outcomes.items()
+               if exit_code == TrfmTestCase.EX_OK)
+
+
+def live_environments(events):
+    """
+    Last environment deployed for each .tf file which was not released,
+    as {tf_file: event}.
+    """
+    live = {}
+    for e in events:
+        if e['event'] == 'env_deployed':
+            live[e['tf_file']] = e
+        elif e['event'] == 'env_released':
+            live = {tf_file: d for tf_file, d in live.items()
+                    if d['basename'] != e['basename']}
+    return live
+
+
+class RunJournal(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, path, append=False):
+        """
+        Initialize RunJournal object. A new journal is started unless
+        'append' is True (resumed run).
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if (append and self.path.is_file()):
+            self._trim()
+        self.file = open(str(self.path), 'a' if append else 'w')
+        self.lock = threading.Lock()
+
+    def _trim(self):
+        """
+        Remove the last line if it was truncated by an interrupted run, so
+        that the next event doesn't end up on the same line.
+        """
+        data = self.path.read_bytes()
+        if data and not data.endswith(b'\n'):
+            os.truncate(str(self.path), data.rfind(b'\n') + 1)
+
+    def record(self, event, **fields):
+        fields.update({'event': event, 'time': time.time()})
+        with self.lock:
+            self.file.write(json.dumps(fields) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def env_deployed(self, tf_file, env):
+        self.record('env_deployed', tf_file=str(tf_file),
+                    basename=env.basename, workdir=env.workdir,
+                    net_octet=env.net_octet, snapshots=env.snapshots)
+
+    def env_released(self, env):
+        self.record('env_released', basename=env.basename)
+
+    def test_finished(self, tf_file, test, exit_code):
+        self.record('test_finished', tf_file=str(tf_file),
+                    test=test_id(test), exit_code=exit_code)
+
+    def close(self):
+        self.file.close()
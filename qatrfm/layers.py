@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Provisioning layer cache
+
+The setup of an environment is a list of steps run on all its domains. Each
+step is identified by a key chained from the key of the previous step (the
+first one from the base image), like the layers of a container image. After
+a step succeeds, the disk of the first domain is captured as a qcow2 layer
+named after its key. The next environments with the same base image and
+the same first steps boot from the layer of the longest cached prefix and
+only run the remaining steps.
+
+A step is a command or a dict like the ones of Domain.execute_batch, or a
+dict {'put': <local file>, 'path': <remote path>} to copy a file into the
+domains.
+"""
+
+import hashlib
+import json
+import os
+
+from pathlib import Path
+
+from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import libutils
+from qatrfm.utils import tf_utils
+from qatrfm.utils import virsh_utils as vu
+
+LAYERS_DIR = '/var/lib/libvirt/images/qatrfm-layers'
+
+
+def _identity(value):
+    if Path(value).is_file():
+        return tf_utils.file_identity(value)
+    return value
+
+
+def chain_keys(base, steps):
+    """
+    Return the key of each step. The key of a step depends on the base
+    (e.g. the image) and all the steps before it. The files copied by 'put'
+    steps are identified by their path, size and modification time.
+    """
+    keys = []
+    h = hashlib.sha256(_identity(str(base)).encode('utf-8'))
+    for step in steps:
+        if isinstance(step, dict) and 'put' in step:
+            step = dict(step, put=_identity(step['put']))
+        h = hashlib.sha256(
+            h.hexdigest().encode('utf-8') +
+            json.dumps(step, sort_keys=True).encode('utf-8'))
+        keys.append(h.hexdigest())
+    return keys
+
+
+class LayerCache(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, directory=LAYERS_DIR, budget=50 * 2**30):
+        """
+        Initialize LayerCache object. The least recently used layers are
+        removed when the size of the cache exceeds 'budget' bytes.
+        """
+        self.directory = Path(directory)
+        self.budget = budget
+
+    def path(self, key):
+        return str(self.directory / '{}.qcow2'.format(key))
+
+    def lookup(self, keys):
+        """
+        Return how many of the steps with the given keys are cached, i.e.
+        the length of the longest prefix with a layer, and mark its layer as
+        used.
+        """
+        for i in reversed(range(len(keys))):
+            layer = Path(self.path(keys[i]))
+            if layer.is_file():
+                os.utime(str(layer))
+                return i + 1
+        return 0
+
+    def capture(self, key, domain):
+        """
+        Store the disk of a running domain as the layer 'key'. Its file
+        systems are frozen through the qemu agent while the disk is copied,
+        so that the layer is consistent.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        disk = domain.get_disk_path()
+        part = self.path(key) + '.part'
+        self.logger.debug("Capturing layer {} from {}".format(key,
+                                                              domain.name))
+        libutils.execute_bash_cmd(vu.generate_domfsfreeze_str(domain.name))
+        try:
+            libutils.execute_bash_cmd(
+                'qemu-img convert -U -O qcow2 {} {}'.format(disk, part),
+                timeout=1000)
+        finally:
+            libutils.execute_bash_cmd(vu.generate_domfsthaw_str(domain.name))
+        os.rename(part, self.path(key))
+        self.evict(keep=[key])
+
+    def evict(self, keep=()):
+        """ Remove the least recently used layers until the budget is met """
+        layers = []
+        for layer in self.directory.glob('*.qcow2'):
+            try:
+                stat = layer.stat()
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+            layers.append((stat.st_mtime, stat.st_size, layer))
+        total = sum(size for _, size, _ in layers)
+        for _, size, layer in sorted(layers, key=lambda x: x[0]):
+            if total <= self.budget:
+                break
+            if layer.stem in keep:
+                continue
+            self.logger.debug("Evicting layer {}".format(layer.stem))
+            try:
+                layer.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
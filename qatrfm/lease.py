@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Domain leasing
+
+Tests which declare how many domains they need (see
+TrfmTestCase.domains_required) don't need the whole environment. The
+domains of the environment are leased to them in disjoint subsets, so that
+several tests can run at the same time against the same environment.
+"""
+
+import threading
+
+from qatrfm.environment import BaseEnv
+from qatrfm.utils.logger import QaTrfmLogger
+
+
+class LeasedEnv(BaseEnv):
+    """
+    View of an environment restricted to the domains leased to a test.
+
+    Everything else (workdir, basename, snapshots, ...) is taken from the
+    environment. reset() and the telemetry only affect the leased domains.
+    """
+
+    def __init__(self, env, domains):
+        """Initialize LeasedEnv object."""
+        self.env = env
+        self.domains = domains
+        self.sampler = None
+
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+
+
+class DomainPool(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, env):
+        """Initialize DomainPool object."""
+        self.env = env
+        self.free = list(env.domains)
+        self.condition = threading.Condition()
+
+    def acquire(self, count):
+        """ Wait until 'count' domains are free and lease them """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.free) >= count)
+            domains, self.free = self.free[:count], self.free[count:]
+        self.logger.debug("Leased domains {}".format(
+            ",".join([d.name for d in domains])))
+        return LeasedEnv(self.env, domains)
+
+    def release(self, leased):
+        """
+        Give the domains back to the pool, reverting them to their initial
+        snapshots first if the environment has them.
+        """
+        try:
+            leased.reset()
+        finally:
+            with self.condition:
+                self.free.extend(leased.domains)
+                self.condition.notify_all()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Container backend
+
+Environment and domains backed by systemd-nspawn containers instead of
+libvirt domains, for tests which only need an isolated userspace with
+networking. They expose the same surface as TerraformEnv and Domain
+(deploy, reset, clean, execute_cmd, execute_ssh_cmd, execute_cmd_async,
+wait_for_pattern, wait_for_condition, transfer_file, snapshot), so the
+same test cases can run on both backends.
+
+The variable 'image' is a directory with the root file system shared by all
+the containers. Each container sees it through its own overlay, whose upper
+directory is its whole state: snapshots are copies of it. The containers
+are not booted, so they start in well under a second, and they are
+connected to a bridge with the network 10.X.0.0/24 like the libvirt ones.
+"""
+
+import os
+import select
+import shutil
+import string
+import subprocess
+import random
+import tempfile
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from qatrfm import hooks
+from qatrfm.domain import Domain
+from qatrfm.environment import BaseEnv, TerraformEnv
+from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import libutils
+from qatrfm.utils import nspawn_utils as nu
+from qatrfm.utils import registry
+from qatrfm.utils import tf_utils
+
+
+class ContainerProcess(object):
+    """
+    Handle of a command running in a container, with the same interface as
+    GuestProcess. A thread per command waits for it.
+    """
+
+    def __init__(self, domain, cmd, timeout):
+        """Initialize ContainerProcess object."""
+        self.domain = domain
+        self.cmd = cmd
+        self.future = Future()
+        self.lock = threading.Lock()
+        self.popen = subprocess.Popen(
+            nu.generate_nsenter_args(domain.pid, cmd),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        threading.Thread(target=self._wait, args=(timeout,),
+                         daemon=True).start()
+
+    def _wait(self, timeout):
+        try:
+            stdout, stderr = self.popen.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.domain.logger.error(
+                "The command '{}' on the domain '{}' timed out.".format(
+                    self.cmd, self.domain.name))
+            self.popen.kill()
+            self.popen.communicate()
+            self._finish(exception=libutils.TrfmCommandTimeout(self.cmd))
+            return
+        retcode = self.popen.returncode
+        output = (stderr if retcode != 0 else stdout).decode('utf-8')
+        self.domain._print_log(self.cmd, retcode, output, type='nsenter')
+        self._finish(result=[retcode, output])
+
+    def _finish(self, result=None, exception=None):
+        with self.lock:
+            if self.future.done():
+                # Cancelled meanwhile
+                return
+            if exception is not None:
+                self.future.set_exception(exception)
+            else:
+                self.future.set_result(result)
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """ Same as GuestProcess.result() """
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """ Stop waiting for the command and kill it """
+        with self.lock:
+            if self.future.done():
+                return False
+            self.future.cancel()
+        if self.popen.poll() is None:
+            self.popen.kill()
+        return True
+
+
+class NspawnDomain(Domain):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+    # There is no qemu agent, see execute_cmd_async
+    executor_class = None
+
+    def __init__(self, name, rootfs, workdir, zone, ip=None, gateway=None):
+        """Initialize NspawnDomain object."""
+        super().__init__(name, ip)
+        self.rootfs = rootfs
+        self.zone = zone
+        self.gateway = gateway
+        self.path = Path(workdir) / name
+        self.root = self.path / 'root'
+        self.process = None
+        self.pid = None
+
+    def _mount(self):
+        for d in ('upper', 'work', 'root'):
+            (self.path / d).mkdir(parents=True, exist_ok=True)
+        libutils.execute_bash_cmd(nu.generate_overlay_mount_str(
+            self.rootfs, self.path / 'upper', self.path / 'work', self.root))
+
+    def start(self, timeout=30):
+        """ Start the container and configure its network """
+        self._mount()
+        log = open(str(self.path / 'nspawn.log'), 'a')
+        self.process = subprocess.Popen(
+            nu.generate_nspawn_str(self.name, self.root, self.zone),
+            shell=True, stdout=log, stderr=subprocess.STDOUT,
+            start_new_session=True)
+        log.close()
+
+        def registered():
+            if self.process.poll() is not None:
+                raise libutils.TrfmDeployError(
+                    "Container {} exited, see {}".format(
+                        self.name, self.path / 'nspawn.log'))
+            output = libutils.execute_bash_cmd(
+                nu.generate_machine_leader_str(self.name),
+                exit_on_failure=False).strip()
+            if output.isdigit() and output != '0':
+                self.pid = int(output)
+                return True
+            return False
+
+        if not libutils.wait_for(registered, timeout, interval=0.05,
+                                 max_interval=0.5):
+            raise libutils.TrfmDomainTimeout(
+                "Container {} didn't start".format(self.name))
+        if self.ip is not None:
+            self.execute_cmd(nu.generate_guest_network_cmd(self.ip,
+                                                           self.gateway))
+
+    def stop(self):
+        """ Stop the container and unmount its root file system """
+        if self.process is not None:
+            libutils.execute_bash_cmd(
+                nu.generate_machine_terminate_str(self.name),
+                exit_on_failure=False)
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+            self.pid = None
+        if self.root.is_mount():
+            libutils.execute_bash_cmd(nu.generate_umount_str(self.root))
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def wait_for_ready(self, timeout=300):
+        # Started containers are ready
+        pass
+
+    def execute_cmd(self, cmd, timeout=300, exit_on_failure=True):
+        """
+        Execute a command in the namespaces of the container.
+
+        Same behaviour as Domain.execute_cmd: returns [retcode, output]
+        (stderr if the command failed) and raises TrfmCommandFailed or
+        TrfmCommandTimeout if 'exit_on_failure' is True.
+        """
+        self.logger.debug("execute_cmd '{}'".format(cmd))
+        try:
+            p = subprocess.run(nu.generate_nsenter_args(self.pid, cmd),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.logger.error("The command '{}' on the domain '{}' timed out.".
+                              format(cmd, self.name))
+            if (exit_on_failure):
+                raise libutils.TrfmCommandTimeout
+            return None
+        if (p.returncode != 0):
+            output = p.stderr.decode('utf-8')
+            self._print_log(cmd, p.returncode, output, type='nsenter')
+            if (exit_on_failure):
+                raise libutils.TrfmCommandFailed(output)
+        else:
+            output = p.stdout.decode('utf-8')
+            self._print_log(cmd, p.returncode, output, type='nsenter')
+        return [p.returncode, output]
+
+    def execute_ssh_cmd(self, cmd, timeout=300, exit_on_failure=True):
+        """ Containers don't need SSH, the command is run like execute_cmd """
+        ret = self.execute_cmd(cmd, timeout, exit_on_failure)
+        if ret is None:
+            return [-1, '']
+        return ret
+
+    def execute_cmd_async(self, cmd, timeout=300):
+        """
+        Start a command in the namespaces of the container without waiting
+        for it. Returns a ContainerProcess, used like the GuestProcess
+        returned by Domain.execute_cmd_async.
+        """
+        self.logger.debug("execute_cmd_async '{}'".format(cmd))
+        return ContainerProcess(self, cmd, timeout)
+
+    def _follow(self, cmd, timeout=300, interval=0.2, max_interval=2):
+        """
+        Same as Domain._follow, but the output of the command is read from
+        its pipe as it is written instead of through a file.
+        """
+        p = subprocess.Popen(nu.generate_nsenter_args(self.pid, cmd),
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        pending = b''
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select(
+                        [p.stdout], [], [], remaining)[0]:
+                    raise libutils.TrfmDomainTimeout(
+                        "Timeout following '{}' on domain {}".format(
+                            cmd, self.name))
+                data = os.read(p.stdout.fileno(), 65536)
+                if not data:
+                    if pending:
+                        yield [pending.decode('utf-8', 'replace')]
+                    return
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                if lines:
+                    yield [line.decode('utf-8', 'replace') for line in lines]
+        finally:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+            p.stdout.close()
+
+    def transfer_file(self, remote_file_path, local_file_path, type='get'):
+        """ Copy a file from/to the container with machinectl """
+        if (type == 'get'):
+            cmd = nu.generate_machine_copy_str(
+                self.name, remote_file_path, local_file_path, type)
+        elif (type == 'put'):
+            cmd = nu.generate_machine_copy_str(
+                self.name, local_file_path, remote_file_path, type)
+        libutils.execute_bash_cmd(cmd)
+
+    def snapshot(self, action):
+        """
+        The state of a container is the upper directory of its overlay.
+        Reverting restarts the container with a copy of the snapshot.
+        """
+        snapshot = self.path / 'snapshot'
+        try:
+            if (action == 'create'):
+                libutils.execute_bash_cmd('cp -a {} {}'.format(
+                    self.path / 'upper', snapshot))
+            elif (action == 'delete'):
+                shutil.rmtree(str(snapshot))
+            elif (action == 'revert'):
+                self.stop()
+                for d in ('upper', 'work'):
+                    shutil.rmtree(str(self.path / d))
+                libutils.execute_bash_cmd('cp -a {} {}'.format(
+                    snapshot, self.path / 'upper'))
+                self.start()
+        except (libutils.TrfmCommandFailed, OSError) as e:
+            self.logger.error("Failed to {} snapshot of domain {}."
+                              .format(action, self.name))
+            raise libutils.TrfmSnapshotFailed(e)
+
+
+class NspawnEnv(BaseEnv):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, net_octet, tf_vars, tf_file, snapshots=False,
+                 setup_steps=None):
+        """
+        Initialize NspawnEnv object.
+
+        The .tf file is only used for the defaults of the variables
+        'num_domains' and 'image', nothing is deployed with terraform.
+        """
+        self.net_octet = net_octet
+        self.tf_file = tf_file
+        self.vars = list(tf_vars)
+        self.snapshots = snapshots
+        self.setup_steps = list(setup_steps or [])
+        letters = string.ascii_lowercase
+        self.basename = ''.join(random.choice(letters) for i in range(10))
+        self.zone = nu.zone_name(net_octet)
+        self.domains = []
+        self.sampler = None
+        self.workdir = tempfile.mkdtemp()
+        self.logger.debug("Using working directory {}".format(self.workdir))
+
+    def _parallel(self, function):
+        """ Call function(domain) for all the domains at the same time """
+        if not self.domains:
+            return
+        with ThreadPoolExecutor(max_workers=len(self.domains)) as executor:
+            for future in [executor.submit(function, d)
+                           for d in self.domains]:
+                future.result()
+
+    def _configure_bridge(self):
+        libutils.execute_bash_cmd(nu.generate_host_bridge_str(
+            self.zone, '10.{}.0.1'.format(self.net_octet)))
+
+    def registry_info(self):
+        """ Information of the environment stored in the registry """
+        return {'workdir': self.workdir, 'net_octet': self.net_octet,
+                'tf_file': str(self.tf_file), 'backend': 'nspawn'}
+
+    def deploy(self):
+        """ Start the containers, run the setup steps and snapshot them """
+        hooks.call('before_deploy', self)
+        # So that 'qatrfm reap' finds the containers if the run crashes
+        registry.register(self.basename, **self.registry_info())
+        self.logger.info("Deploying containers ...")
+        start = time.time()
+        image = tf_utils.get_effective_vars(self.tf_file,
+                                            self.vars).get('image')
+        if image is None or not Path(image).is_dir():
+            raise libutils.TrfmDeployError(
+                "The variable 'image' must be a root file system directory")
+        gateway = '10.{}.0.1'.format(self.net_octet)
+        self.domains = [
+            NspawnDomain('qatrfm-ct-{}-{}'.format(self.basename, i), image,
+                         self.workdir, self.zone,
+                         TerraformEnv.static_ip(self.net_octet, i), gateway)
+            for i in range(self.num_domains())]
+        self._parallel(lambda d: d.start())
+        self._configure_bridge()
+        self.logger.debug("Containers started in {:.2f}s".format(
+            time.time() - start))
+        self.run_setup()
+        if (self.snapshots):
+            self._parallel(lambda d: d.snapshot(action='create'))
+        self.logger.success("Environment deployed successfully.")
+        hooks.call('after_deploy', self)
+
+    def start_telemetry(self, interval=5):
+        self.logger.warning("Telemetry is not supported by containers")
+
+    def stop_telemetry(self, path=None):
+        return []
+
+    def reset(self):
+        """ Reverts the containers to their initial snapshots """
+        self.logger.info("Reseting the containers...")
+        if (not self.snapshots):
+            return
+        hooks.call('before_reset', self)
+        self._parallel(lambda d: d.snapshot(action='revert'))
+        # The bridge is removed when its last container stops
+        self._configure_bridge()
+        hooks.call('after_reset', self)
+
+    def clean(self):
+        """ Stops the containers and removes their files """
+        hooks.call('before_clean', self)
+        self.logger.info("Removing containers...")
+        self._parallel(lambda d: d.stop())
+        shutil.rmtree(self.workdir)
+        registry.unregister(self.basename)
+        self.release_octet()
+        self.logger.success("Environment clean")
+        hooks.call('after_clean', self)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" CPU placement
+
+Dedicates host CPUs to the environments so that their vCPUs don't migrate
+and compete with each other, and keeps their memory in the NUMA node of
+those CPUs. The CPUs held by every live environment are stored in its
+registry entry ('placement'), the admission controller allocates them to
+the new environments under its lock.
+"""
+
+import os
+import re
+
+from pathlib import Path
+
+NODES_DIR = '/sys/devices/system/node'
+
+
+def parse_cpulist(cpulist):
+    """ '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11] """
+    cpus = []
+    for item in cpulist.strip().split(','):
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """ [0, 1, 2, 3, 8] -> '0-3,8' """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(['{}'.format(first) if first == last else
+                     '{}-{}'.format(first, last) for first, last in ranges])
+
+
+def host_topology(nodes_dir=NODES_DIR):
+    """
+    Return the CPUs of each NUMA node of the host: {0: [0, 1], 1: [2, 3]}.
+    Hosts without NUMA information are a single node with all the CPUs.
+    """
+    topology = {}
+    for path in Path(nodes_dir).glob('node*'):
+        match = re.match(r'node(\d+)$', path.name)
+        if not match or not (path / 'cpulist').is_file():
+            continue
+        cpus = parse_cpulist((path / 'cpulist').read_text())
+        if cpus:
+            topology[int(match.group(1))] = cpus
+    if not topology:
+        topology[0] = list(range(os.cpu_count()))
+    return topology
+
+
+def allocate(cores, topology, held):
+    """
+    Choose 'cores' free CPUs (not in 'held') for an environment.
+
+    The CPUs are taken from a single node when possible, the one with the
+    fewest free CPUs which is big enough so that the larger holes are kept
+    for larger environments. Returns {'node': n, 'cpus': [...]}, with node
+    None if the CPUs had to be spread over several nodes, or None if there
+    aren't enough free CPUs.
+    """
+    held = set(held)
+    free = {node: [c for c in cpus if c not in held]
+            for node, cpus in topology.items()}
+    fitting = [node for node in sorted(free) if len(free[node]) >= cores]
+    if fitting:
+        node = min(fitting, key=lambda n: len(free[n]))
+        return {'node': node, 'cpus': free[node][:cores]}
+    spread = [c for node in sorted(free) for c in free[node]]
+    if len(spread) >= cores:
+        return {'node': None, 'cpus': spread[:cores]}
+    return None
+
+
+def node_of(cpus, topology):
+    """ NUMA node of all the given CPUs, None if they are spread or none """
+    nodes = {node for node, node_cpus in topology.items()
+             for cpu in cpus if cpu in node_cpus}
+    if len(nodes) == 1:
+        return nodes.pop()
+    return None
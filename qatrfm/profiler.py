@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Test profiler
+
+Plugin which profiles every test case while it runs. It produces:
+    - <test>.prof: cProfile statistics of the test thread (pstats format)
+    - <test>.folded: sampled stacks in the collapsed format used by
+      flamegraph.pl / speedscope
+and logs how the wall time was split between the qatrfm primitives
+(agent exec, SSH exec, file transfers, sleeps) and the test code itself.
+"""
+
+import collections
+import cProfile
+import linecache
+import sys
+import threading
+import time
+
+from pathlib import Path
+
+from qatrfm.hooks import TrfmPlugin
+from qatrfm.utils.logger import QaTrfmLogger
+
+# (module, function) of the qatrfm primitives
+PRIMITIVES = {
+    ('qatrfm.domain', 'execute_cmd'): 'agent exec',
+    ('qatrfm.domain', 'execute_batch'): 'agent exec',
+    ('qatrfm.domain', 'check_qemu_agent'): 'agent exec',
+    ('qatrfm.domain', 'execute_ssh_cmd'): 'SSH exec',
+    ('qatrfm.domain', 'transfer_file'): 'transfer',
+}
+
+
+class _TestProfile(object):
+
+    def __init__(self, test, thread_id):
+        self.test = test
+        self.thread_id = thread_id
+        self.start = time.time()
+        self.stacks = collections.Counter()
+        self.categories = collections.Counter()
+        self.profile = cProfile.Profile()
+
+
+class ProfilerPlugin(TrfmPlugin):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, output_dir, interval=0.01):
+        """Initialize ProfilerPlugin object."""
+        self.output_dir = Path(output_dir)
+        self.interval = interval
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _classify(frames):
+        """ Attribute a stack (innermost frame first) to a primitive """
+        for frame in frames:
+            key = (frame.f_globals.get('__name__'), frame.f_code.co_name)
+            if key in PRIMITIVES:
+                return PRIMITIVES[key]
+        line = linecache.getline(frames[0].f_code.co_filename,
+                                 frames[0].f_lineno)
+        if 'sleep(' in line:
+            return 'sleep'
+        return 'test code'
+
+    def _sample(self):
+        current = sys._current_frames()
+        with self.lock:
+            profiles = list(self.profiles.values())
+        for p in profiles:
+            frame = current.get(p.thread_id)
+            frames = []
+            run_code = type(p.test).run.__code__
+            while frame is not None:
+                frames.append(frame)
+                if frame.f_code is run_code:
+                    break
+                frame = frame.f_back
+            if not frames:
+                continue
+            p.categories[self._classify(frames)] += 1
+            p.stacks[';'.join('{}:{}'.format(
+                f.f_globals.get('__name__'), f.f_code.co_name)
+                for f in reversed(frames))] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def before_test(self, test):
+        p = _TestProfile(test, threading.get_ident())
+        try:
+            p.profile.enable()
+        except ValueError:
+            # Another profiler is active (e.g. tests running concurrently)
+            p.profile = None
+        with self.lock:
+            self.profiles[id(test)] = p
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def after_test(self, test, exit_code):
+        with self.lock:
+            p = self.profiles.pop(id(test), None)
+            if not self.profiles and self._thread is not None:
+                self._stop.set()
+                thread, self._thread = self._thread, None
+            else:
+                thread = None
+        if thread is not None:
+            thread.join()
+        if p is None:
+            return
+        elapsed = time.time() - p.start
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if p.profile is not None:
+            p.profile.disable()
+            p.profile.dump_stats(
+                str(self.output_dir / '{}.prof'.format(test.name)))
+        with open(str(self.output_dir / '{}.folded'.format(test.name)),
+                  'w') as f:
+            for stack, count in p.stacks.items():
+                f.write('{} {}\n'.format(stack, count))
+
+        total = sum(p.categories.values())
+        if total == 0:
+            return
+        self.logger.info("Time of '{}' ({:.1f}s):\n{}".format(
+            test.name, elapsed, "\n".join([
+                "\t{:<10}: {:7.1f}s ({:.0f}%)".format(
+                    category, elapsed * count / total, 100.0 * count / total)
+                for category, count in p.categories.most_common()])))
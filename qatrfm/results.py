@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Result cache
+
+Remembers which tests passed with which inputs, so that incremental runs
+only run the tests whose inputs changed. The key of a test is a hash of:
+    - the source of its module and of the other modules of its directory
+      (helpers it may import)
+    - the fingerprint of its environment: .tf file, tfvars (with the
+      identity of the files they reference, e.g. images) and setup steps
+    - the backend it runs on
+"""
+
+import hashlib
+import json
+import sys
+import time
+
+from pathlib import Path
+
+from qatrfm.environment import TerraformEnv
+from qatrfm.journal import test_id
+from qatrfm.utils.logger import QaTrfmLogger
+
+CACHE_DIR = str(Path.home() / '.cache' / 'qatrfm' / 'results')
+
+
+class ResultCache(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, directory=CACHE_DIR):
+        """Initialize ResultCache object."""
+        self.directory = Path(directory)
+
+    @staticmethod
+    def key(test, tf_file, tf_vars, backend='libvirt', setup_steps=None):
+        h = hashlib.sha256(test_id(test).encode('utf-8'))
+        module = Path(sys.modules[test.__module__].__file__)
+        for source in sorted(module.parent.glob('*.py')):
+            h.update('\0{}\0'.format(source.name).encode('utf-8'))
+            h.update(source.read_bytes())
+        h.update('\0{}\0{}'.format(backend, TerraformEnv.compute_fingerprint(
+            tf_file, tf_vars, setup_steps)).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self.directory / '{}.json'.format(key)
+
+    def passed(self, key):
+        return self._path(key).is_file()
+
+    def store(self, key, test):
+        """ Remember that the test passed with the inputs of 'key' """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._path(key).write_text(json.dumps(
+            {'test': test_id(test), 'time': time.time()}))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Environment teardown
+
+Destroying an environment is slow and the results of the tests are already
+known at that point, so it can be done in background while the next
+environment is deployed. This module also implements the reaper, which
+removes the libvirt resources (and the containers of the nspawn backend)
+of environments whose owner is gone.
+"""
+
+import fcntl
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import libutils
+from qatrfm.utils import nspawn_utils as nu
+from qatrfm.utils import registry
+from qatrfm.utils import virsh_utils as vu
+
+MOUNTS = '/proc/mounts'
+KINDS = ('machines', 'mounts', 'domains', 'volumes', 'networks')
+
+
+class TeardownWorker(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, max_workers=2):
+        """Initialize TeardownWorker object."""
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+
+    def submit(self, env):
+        """ Schedule the clean up of the environment """
+        self.logger.info("Environment {} will be removed in background".
+                         format(env.basename))
+        self.futures[env.basename] = self.executor.submit(env.clean)
+
+    def wait(self):
+        """
+        Wait for all the scheduled clean ups to finish.
+
+        Returns the list of basenames which couldn't be removed.
+        """
+        failed = []
+        for basename, future in self.futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                self.logger.error("Failed to remove environment {}:\n{}".
+                                  format(basename, e))
+                failed.append(basename)
+        self.futures = {}
+        self.executor.shutdown()
+        return failed
+
+
+def _list_names(cmd, exit_on_failure=True):
+    return vu.get_names(libutils.execute_bash_cmd(
+        cmd, exit_on_failure=exit_on_failure))
+
+
+def _list_mounts():
+    """
+    Overlay mounts which may be the root file system of a container:
+    '<workdir>/qatrfm-ct-<basename>-<i>/root'.
+    """
+    mounts = []
+    for line in Path(MOUNTS).read_text().splitlines():
+        fields = line.split()
+        if (len(fields) > 2 and fields[2] == 'overlay' and
+                Path(fields[1]).name == 'root'):
+            mounts.append(fields[1])
+    return mounts
+
+
+def empty_resources():
+    return {kind: [] for kind in KINDS}
+
+
+def find_resources(basename=None):
+    """
+    Return the libvirt resources and containers created by qatrfm grouped
+    by basename:
+        {'abcdefghij': {'machines': [...], 'mounts': [...],
+                        'domains': [...], 'volumes': [...],
+                        'networks': [...]}}
+    If 'basename' is given, only the resources of that environment.
+    """
+    resources = {}
+    # machinectl is only needed by the nspawn backend
+    listings = [('machines', _list_names(nu.generate_machine_list_str(),
+                                         exit_on_failure=False)),
+                ('mounts', _list_mounts()),
+                ('domains', _list_names(vu.generate_domain_list_str())),
+                ('volumes', _list_names(vu.generate_volume_list_str())),
+                ('networks', _list_names(vu.generate_network_list_str()))]
+    for kind, names in listings:
+        for name in names:
+            # The mounts are named after their container
+            owner = Path(name).parent.name if kind == 'mounts' else name
+            env_basename = vu.get_basename(owner)
+            if (env_basename is None or
+                    (basename is not None and env_basename != basename)):
+                continue
+            env = resources.setdefault(env_basename, empty_resources())
+            env[kind].append(name)
+    return resources
+
+
+def _terminate_machine(machine):
+    libutils.execute_bash_cmd(nu.generate_machine_terminate_str(machine),
+                              exit_on_failure=False)
+
+    def terminated():
+        try:
+            libutils.execute_bash_cmd(
+                nu.generate_machine_leader_str(machine))
+        except libutils.TrfmCommandFailed:
+            return True
+        return False
+
+    if not libutils.wait_for(terminated, 30):
+        raise libutils.TrfmCommandFailed(
+            "The container {} couldn't be stopped".format(machine))
+
+
+def _umount(mount):
+    libutils.execute_bash_cmd(nu.generate_umount_str(mount))
+
+
+def _destroy_domain(domain):
+    # Undefining a running domain makes it transient and destroying it
+    # removes it completely. Undefine fails for domains which are already
+    # transient.
+    libutils.execute_bash_cmd(vu.generate_domain_undefine_str(domain),
+                              exit_on_failure=False)
+    libutils.execute_bash_cmd(vu.generate_domain_destroy_str(domain),
+                              exit_on_failure=False)
+    try:
+        libutils.execute_bash_cmd(vu.generate_domstate_str(domain))
+    except libutils.TrfmCommandFailed:
+        return
+    raise libutils.TrfmCommandFailed(
+        "The domain {} couldn't be removed".format(domain))
+
+
+def _delete_volume(volume):
+    libutils.execute_bash_cmd(vu.generate_volume_delete_str(volume))
+
+
+def _destroy_network(network):
+    libutils.execute_bash_cmd(vu.generate_network_destroy_str(network),
+                              exit_on_failure=False)
+    libutils.execute_bash_cmd(vu.generate_network_undefine_str(network))
+
+
+def destroy_resources(resources, max_workers=8):
+    """
+    Remove the given libvirt resources and containers directly, without
+    terraform.
+
+    Containers go before their root file systems and domains before the
+    volumes and networks they use. The resources of each type are removed
+    in parallel.
+    """
+    phases = [(_terminate_machine, resources.get('machines', [])),
+              (_umount, resources.get('mounts', [])),
+              (_destroy_domain, resources.get('domains', [])),
+              (_delete_volume, resources.get('volumes', [])),
+              (_destroy_network, resources.get('networks', []))]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for action, names in phases:
+            for future in [executor.submit(action, n) for n in names]:
+                future.result()
+
+
+def _release_octet(net_octet):
+    """ Remove the lock file of a network octet if nobody holds it """
+    lock_path = Path(registry.LOCKS_DIR) / str(net_octet)
+    if not lock_path.is_file():
+        return
+    with open(str(lock_path), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        lock_path.unlink()
+
+
+def reap_environment(basename, resources):
+    entry = registry.get_entry(basename)
+    destroy_resources(resources)
+    if entry is not None:
+        if entry.get('workdir'):
+            shutil.rmtree(entry['workdir'], ignore_errors=True)
+        if entry.get('net_octet') is not None:
+            _release_octet(entry['net_octet'])
+    registry.unregister(basename)
+
+
+def find_orphans():
+    """
+    Return the resources of the environments which are not registered, whose
+    working directory was removed or whose owner process is gone.
+    """
+    resources = find_resources()
+    for entry in registry.list_entries():
+        resources.setdefault(entry['basename'], empty_resources())
+    return {basename: r for basename, r in resources.items()
+            if registry.is_orphan(registry.get_entry(basename))}
+
+
+def reap(max_workers=4, dry_run=False):
+    """
+    Remove all the orphan environments of the host in parallel.
+
+    Returns the list of basenames which couldn't be removed.
+    """
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+    orphans = find_orphans()
+    for basename, resources in orphans.items():
+        logger.info("Orphan environment {}: {}".format(
+            basename, ", ".join(name for kind in KINDS
+                                for name in resources[kind])))
+    if dry_run or not orphans:
+        return []
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {basename: executor.submit(reap_environment, basename, r)
+                   for basename, r in orphans.items()}
+        for basename, future in futures.items():
+            try:
+                future.result()
+                logger.success("Environment {} removed".format(basename))
+            except (libutils.TrfmCommandFailed,
+                    libutils.TrfmCommandTimeout) as e:
+                logger.error("Failed to remove environment {}:\n{}".
+                             format(basename, e))
+                failed.append(basename)
+    return failed
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Resource telemetry
+
+Samples the counters of the domains (vCPU time, balloon, block and network
+I/O) and the load of the host while a test runs. It helps telling apart a
+slow guest (CPU starved, swapping, waiting for disk) from a slow framework.
+"""
+
+import collections
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+from pathlib import Path
+
+from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import virsh_utils as vu
+
+COLUMNS = ['time', 'domain', 'cpu_time', 'balloon_current', 'balloon_rss',
+           'block_rd_bytes', 'block_wr_bytes', 'net_rx_bytes', 'net_tx_bytes',
+           'host_load1', 'host_mem_available', 'host_swap_used']
+
+
+def _sum_counters(stats, prefix, suffix):
+    """ Sum e.g. block.0.rd.bytes + block.1.rd.bytes """
+    return sum(v for k, v in stats.items()
+               if k.startswith(prefix) and k.endswith(suffix))
+
+
+def host_stats():
+    """ Return the 1 min load, available RAM and used swap (KiB) """
+    meminfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            fields = line.split()
+            meminfo[fields[0].rstrip(':')] = int(fields[1])
+    swap_used = meminfo.get('SwapTotal', 0) - meminfo.get('SwapFree', 0)
+    return (os.getloadavg()[0], meminfo.get('MemAvailable', 0), swap_used)
+
+
+class TelemetrySampler(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, domains, interval=5, capacity=10000):
+        """
+        Initialize TelemetrySampler object.
+
+        Only the last 'capacity' samples are kept.
+        """
+        self.domains = [d.name for d in domains]
+        self.interval = interval
+        self.samples = collections.deque(maxlen=capacity)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """ Take one sample of every domain and of the host """
+        now = time.time()
+        load1, mem_available, swap_used = host_stats()
+        cmd = vu.generate_domstats_str(self.domains)
+        try:
+            # Not using libutils.execute_bash_cmd on purpose: it would log
+            # every line of every sample.
+            output = subprocess.check_output(
+                shlex.split(cmd), stderr=subprocess.DEVNULL,
+                timeout=self.interval + 10).decode('utf-8')
+        except (subprocess.SubprocessError, OSError) as e:
+            self.logger.debug("Failed to get domain stats: {}".format(e))
+            return
+        for domain, stats in vu.get_domstats(output).items():
+            self.samples.append((
+                now, domain, stats.get('cpu.time', 0),
+                stats.get('balloon.current', 0), stats.get('balloon.rss', 0),
+                _sum_counters(stats, 'block.', '.rd.bytes'),
+                _sum_counters(stats, 'block.', '.wr.bytes'),
+                _sum_counters(stats, 'net.', '.rx.bytes'),
+                _sum_counters(stats, 'net.', '.tx.bytes'),
+                load1, mem_available, swap_used))
+
+    def _run(self):
+        self.sample()
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def columns(self):
+        """ Return the samples in columnar format: {column: [values]} """
+        return {c: [s[i] for s in self.samples]
+                for i, c in enumerate(COLUMNS)}
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(self.columns()))
+
+    def summary(self):
+        """
+        Summarize the samples per domain: average vCPU usage (percentage of
+        one host CPU), I/O rates, peak balloon RSS, plus the peak host load
+        and swap usage.
+        """
+        lines = []
+        per_domain = collections.OrderedDict()
+        for s in self.samples:
+            per_domain.setdefault(s[1], []).append(s)
+        for domain, samples in per_domain.items():
+            first, last = samples[0], samples[-1]
+            elapsed = last[0] - first[0]
+            if elapsed <= 0:
+                continue
+            lines.append(
+                "{}: cpu {:.1f}%, disk r/w {:.1f}/{:.1f} KiB/s, "
+                "net rx/tx {:.1f}/{:.1f} KiB/s, max rss {} KiB".format(
+                    domain, (last[2] - first[2]) / elapsed / 1e7,
+                    (last[5] - first[5]) / elapsed / 1024,
+                    (last[6] - first[6]) / elapsed / 1024,
+                    (last[7] - first[7]) / elapsed / 1024,
+                    (last[8] - first[8]) / elapsed / 1024,
+                    max(s[4] for s in samples)))
+        if self.samples:
+            lines.append("host: max load {:.2f}, max swap used {} KiB".format(
+                max(s[9] for s in self.samples),
+                max(s[11] for s in self.samples)))
+        return lines
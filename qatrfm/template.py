@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Boot-once environment templates
+
+The first environment of a given fingerprint (.tf file + variables) boots
+its domains as usual. Once they are ready, their memory and device state
+is saved with 'virsh save' and their disks are flattened into the template
+directory. The next environments with the same fingerprint don't boot their
+domains: their disks become overlays of the template disks and the saved
+state is restored into them, so they are ready in a few seconds.
+
+libvirt only restores a saved state with the UUID and MAC addresses it
+was saved with, so the domains defined by terraform are redefined with
+them, keeping their name, disk and networks. A UUID can only be used by one
+domain at a time: the domains of other environments using the same
+template are booted as usual, as are the ones which can't be restored.
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+from pathlib import Path
+
+from qatrfm.utils.logger import QaTrfmLogger
+from qatrfm.utils import libutils
+from qatrfm.utils import virsh_utils as vu
+
+TEMPLATES_DIR = '/var/lib/libvirt/images/qatrfm-templates'
+
+
+class TemplateStore(object):
+
+    logger = QaTrfmLogger.getQatrfmLogger(__name__)
+
+    def __init__(self, fingerprint, directory=TEMPLATES_DIR):
+        """Initialize TemplateStore object."""
+        self.path = Path(directory) / fingerprint
+        self.lock_file = None
+
+    def exists(self):
+        return (self.path / 'meta.json').is_file()
+
+    def lock(self, shared=False):
+        """
+        Take the template for the current environment until release() is
+        called. Environments restoring the template share it, the one
+        creating it needs it alone. Returns False if it can't be taken.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        lock_file = open(str(self.path / 'lock'), 'a')
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(lock_file, mode | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _save_file(self, i):
+        return str(self.path / 'domain-{}.save'.format(i))
+
+    def _disk_file(self, i):
+        return str(self.path / 'domain-{}.qcow2'.format(i))
+
+    def capture(self, domains):
+        """
+        Save the state and disk of the given (ready) domains. Each domain is
+        stopped while its disk is copied and then restored, so the
+        environment can be used right after.
+        """
+        self.logger.info("Creating template {}...".format(self.path.name))
+        for i, domain in enumerate(domains):
+            disk = domain.get_disk_path()
+            libutils.execute_bash_cmd(
+                vu.generate_save_str(domain.name, self._save_file(i)))
+            try:
+                libutils.execute_bash_cmd(
+                    'qemu-img convert -O qcow2 {} {}'.format(
+                        disk, self._disk_file(i)), timeout=1000)
+            finally:
+                libutils.execute_bash_cmd(
+                    vu.generate_restore_str(self._save_file(i)))
+        meta = {'domains': [d.name for d in domains], 'created': time.time()}
+        (self.path / 'meta.json').write_text(json.dumps(meta))
+        self.logger.success("Template {} created".format(self.path.name))
+
+    def _restore_xml(self, saved, new, disk):
+        """
+        Domain XML of the saved state adapted to the domain defined by
+        terraform ('new'): its name, disk and networks. The UUID and MAC
+        addresses are part of the saved state and can't be changed.
+        """
+        saved.find('name').text = new.find('name').text
+        saved.find("devices/disk[@device='disk']/source").set('file', disk)
+        interfaces = "devices/interface[@type='network']"
+        for old, fresh in zip(saved.findall(interfaces),
+                              new.findall(interfaces)):
+            old.find('source').set('network',
+                                   fresh.find('source').get('network'))
+        return saved
+
+    def _conflict(self, domain, saved):
+        """
+        Return why the saved state can't be restored into the domain, or
+        None if it can: the domain must not be running and the UUID of the
+        template domain must not be used by any other domain.
+        """
+        state = libutils.execute_bash_cmd(
+            vu.generate_domstate_str(domain.name)).strip()
+        if (state != 'shut off'):
+            return "the domain is {}".format(state)
+        uuid = saved.find('uuid').text
+        try:
+            owner = libutils.execute_bash_cmd(
+                vu.generate_domname_str(uuid)).strip()
+        except libutils.TrfmCommandFailed:
+            return None
+        return "the UUID {} of the template is used by {}".format(uuid, owner)
+
+    def _define(self, xml):
+        with tempfile.NamedTemporaryFile('w', suffix='.xml') as f:
+            f.write(xml)
+            f.flush()
+            libutils.execute_bash_cmd(vu.generate_define_str(f.name))
+
+    def _boot(self, domain):
+        libutils.execute_bash_cmd(vu.generate_domain_start_str(domain.name))
+        return False
+
+    def _restore_domain(self, i, domain):
+        """
+        Restore the saved state of the template domain 'i' into 'domain'.
+
+        The domain defined by terraform is replaced by one with the same
+        name, disk and networks but the UUID and MAC addresses of the
+        template domain, as libvirt requires. Returns False if it could not
+        be restored: the domain of terraform is then booted from its own
+        disk.
+        """
+        new_xml = libutils.execute_bash_cmd(
+            vu.generate_dumpxml_str(domain.name))
+        saved = ET.fromstring(libutils.execute_bash_cmd(
+            vu.generate_save_image_dumpxml_str(self._save_file(i))))
+        conflict = self._conflict(domain, saved)
+        if (conflict is not None):
+            self.logger.warning("Can't restore domain {}: {}".format(
+                domain.name, conflict))
+            return self._boot(domain)
+        disk = domain.get_disk_path()
+        xml = ET.tostring(
+            self._restore_xml(saved, ET.fromstring(new_xml), disk),
+            encoding='unicode')
+        backup = disk + '.qatrfm-orig'
+        os.rename(disk, backup)
+        try:
+            libutils.execute_bash_cmd(
+                'qemu-img create -f qcow2 -F qcow2 -b {} {}'.format(
+                    self._disk_file(i), disk))
+            libutils.execute_bash_cmd(
+                vu.generate_domain_undefine_str(domain.name))
+            self._define(xml)
+            with tempfile.NamedTemporaryFile('w', suffix='.xml') as f:
+                f.write(xml)
+                f.flush()
+                libutils.execute_bash_cmd(
+                    vu.generate_restore_str(self._save_file(i), f.name))
+        except libutils.TrfmCommandFailed as e:
+            self.logger.warning("Failed to restore domain {}:\n{}".format(
+                domain.name, e))
+            os.replace(backup, disk)
+            libutils.execute_bash_cmd(
+                vu.generate_domain_undefine_str(domain.name),
+                exit_on_failure=False)
+            self._define(new_xml)
+            return self._boot(domain)
+        os.remove(backup)
+        self.refresh_network(domain, saved)
+        return True
+
+    def restore(self, domains):
+        """
+        Restore the saved state of the template domains into the freshly
+        defined (not started) domains of an environment. The domains which
+        can't be restored are booted instead. Returns the restored domains.
+        """
+        self.logger.info("Restoring domains from template {}...".
+                         format(self.path.name))
+        return [domain for i, domain in enumerate(domains)
+                if self._restore_domain(i, domain)]
+
+    def refresh_network(self, domain, xml):
+        """
+        The restored guest still has the network configuration of the
+        template environment. Flapping the links from the host makes its
+        DHCP client request a new lease on the new network. The guest clock
+        is also synchronized if the qemu agent is available.
+        """
+        for mac in xml.findall("devices/interface/mac"):
+            for state in ('down', 'up'):
+                libutils.execute_bash_cmd(vu.generate_domif_setlink_str(
+                    domain.name, mac.get('address'), state))
+        domain.ip = None
+        libutils.execute_bash_cmd(vu.generate_domtime_sync_str(domain.name),
+                                  exit_on_failure=False)
@@ -26,6 +26,23 @@ class TrfmTestCase(object):
     EX_FAILURE = os.EX_SOFTWARE
     """execution failed in some step"""
 
+    domains_required = None
+    """number of domains used by the test, None if it needs all of them.
+    Tests declaring it can run at the same time against disjoint subsets of
+    the domains of the environment, which 'self.env.domains' is limited to.
+    """
+
+    setup_steps = None
+    """list of setup steps run on the domains before the test (see
+    qatrfm.layers). The steps shared by all the tests of an environment are
+    run once at deploy time and can be cached as disk layers.
+    """
+
+    artifacts = None
+    """list of paths or globs of files of the domains collected into
+    <results-dir>/artifacts/<test>.tar.gz when the test finishes.
+    """
+
     def __init__(self, env, name, description=None):
         """Initialize Testcase object."""
         self.env = env
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import pytest
+
+from pathlib import Path
+from unittest import mock
+
+from qatrfm import admission
+from qatrfm import placement
+from qatrfm.admission import AdmissionController, estimate_footprint
+from qatrfm.environment import TerraformEnv
+from qatrfm.utils import libutils
+from qatrfm.utils import registry
+
+
+class TestAdmission(object):
+    """ Test admission control """
+
+    BASEDIR = Path(__file__).resolve().parents[2]
+    DEFAULT_TF = BASEDIR / 'qatrfm' / 'config' / 'default.tf'
+    CUSTOM_TF = BASEDIR / 'examples' / 'custom' / 'custom.tf'
+    CAPACITY = {'ram': 8192, 'cores': 4}
+
+    def test_footprint_defaults(self):
+        assert estimate_footprint(self.DEFAULT_TF, ['image=foo']) == \
+            {'ram': 1024, 'cores': 1}
+
+    def test_footprint_tfvars(self):
+        tf_vars = ['num_domains=3', 'ram=2048', 'cores=2']
+        assert estimate_footprint(self.DEFAULT_TF, tf_vars) == \
+            {'ram': 6144, 'cores': 6}
+
+    def test_footprint_custom(self):
+        assert estimate_footprint(self.CUSTOM_TF, []) == \
+            {'ram': 4096, 'cores': 4}
+
+    def test_fits(self):
+        controller = AdmissionController(mem_overcommit=1.0,
+                                         cpu_overcommit=2.0)
+        footprint = {'ram': 4096, 'cores': 4}
+        assert controller.fits(footprint, {'ram': 4096, 'cores': 4},
+                               self.CAPACITY)
+        assert not controller.fits(footprint, {'ram': 6144, 'cores': 1},
+                                   self.CAPACITY)
+        assert not controller.fits(footprint, {'ram': 1024, 'cores': 5},
+                                   self.CAPACITY)
+
+    def test_fits_alone(self):
+        controller = AdmissionController()
+        footprint = {'ram': 65536, 'cores': 64}
+        assert controller.fits(footprint, {'ram': 0, 'cores': 0},
+                               self.CAPACITY)
+
+    @pytest.fixture
+    def host(self, tmp_path, monkeypatch):
+        """ Host of CAPACITY with the registry in tmp_path """
+        monkeypatch.setattr(registry, 'LOCKS_DIR', str(tmp_path))
+        monkeypatch.setattr(registry, 'REGISTRY_DIR', str(tmp_path / 'envs'))
+        monkeypatch.setattr(admission, 'host_capacity',
+                            lambda: self.CAPACITY)
+        monkeypatch.setattr(AdmissionController, 'live_entries',
+                            lambda self: registry.list_entries())
+
+    def test_resize(self, host):
+        controller = AdmissionController(cpu_overcommit=1.0, timeout=0)
+        env = mock.Mock(basename='aaaaaaaaaa', tf_file=self.DEFAULT_TF,
+                        vars=['image=foo', 'num_domains=2'])
+        registry.register('aaaaaaaaaa', reservation={'ram': 512, 'cores': 1})
+        registry.register('bbbbbbbbbb', reservation={'ram': 1024, 'cores': 2})
+        # The old reservation of the environment itself doesn't count
+        controller.resize(env)
+        assert registry.get_entry('aaaaaaaaaa')['reservation'] == \
+            {'ram': 2048, 'cores': 2}
+        env.vars = ['image=foo', 'num_domains=3']
+        with pytest.raises(libutils.TrfmDeployError):
+            controller.resize(env)
+        assert registry.get_entry('aaaaaaaaaa')['reservation'] == \
+            {'ram': 2048, 'cores': 2}
+
+    def test_admit_pin_cpus(self, host, tmp_path, monkeypatch):
+        monkeypatch.setattr(placement, 'host_topology',
+                            lambda: {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]})
+        controller = AdmissionController(timeout=0, pin_cpus=True)
+        registry.register('bbbbbbbbbb', reservation={'ram': 512, 'cores': 1},
+                          placement={'node': 0, 'cpus': [0]})
+        env = TerraformEnv(1, ['image=foo', 'cores=2'], str(self.DEFAULT_TF),
+                           basename='aaaaaaaaaa', workdir=str(tmp_path))
+        controller.admit(env)
+        assert registry.get_entry('aaaaaaaaaa')['placement'] == \
+            {'node': 0, 'cpus': [1, 2]}
+        assert 'cpuset=["1-2"]' in env.vars
+        assert 'numa_node=["0"]' in env.vars
+        # The first domain keeps its CPUs, the new one gets its own
+        env.set_var('num_domains', 2)
+        controller.resize(env)
+        assert registry.get_entry('aaaaaaaaaa')['placement'] == \
+            {'node': None, 'cpus': [1, 2, 4, 5]}
+        assert 'cpuset=["1-2", "4-5"]' in env.vars
+        assert 'numa_node=["0", "1"]' in env.vars
+        # 4 vCPUs don't fit in the 3 free CPUs: the new domains are unpinned
+        env.set_var('num_domains', 4)
+        controller.resize(env)
+        assert 'cpuset=["1-2", "4-5", "", ""]' in env.vars
+        assert registry.get_entry('aaaaaaaaaa')['placement'] == \
+            {'node': None, 'cpus': [1, 2, 4, 5]}
+        # The removed domains free their CPUs
+        env.set_var('num_domains', 1)
+        controller.resize(env)
+        assert 'cpuset=["1-2"]' in env.vars
+        assert registry.get_entry('aaaaaaaaaa')['placement'] == \
+            {'node': 0, 'cpus': [1, 2]}
+
+    def test_admit_unpinned(self, host, tmp_path, monkeypatch):
+        monkeypatch.setattr(placement, 'host_topology', lambda: {0: [0, 1]})
+        controller = AdmissionController(timeout=0, pin_cpus=True)
+        env = TerraformEnv(1, ['image=foo', 'cores=4'], str(self.DEFAULT_TF),
+                           basename='aaaaaaaaaa', workdir=str(tmp_path))
+        controller.admit(env)
+        assert registry.get_entry('aaaaaaaaaa')['placement'] is None
+        assert 'cpuset=[""]' in env.vars
+        # An unpinned environment stays unpinned
+        env.set_var('num_domains', 2)
+        controller.resize(env)
+        assert registry.get_entry('aaaaaaaaaa')['placement'] is None
+        assert 'cpuset=["", ""]' in env.vars
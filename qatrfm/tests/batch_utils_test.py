@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import subprocess
+
+from qatrfm.utils import batch_utils
+
+
+class TestBatchUtils(object):
+    """ Test the batch runner script """
+
+    STEPS = ['echo "foo\nbar"',
+             {'cmd': "echo 'it''s'; exit 3", 'retcode': 3},
+             {'cmd': 'echo 42', 'output': '^[0-9]+$'},
+             {'cmd': 'false'},
+             'echo never']
+
+    def run(self, steps, stop_on_failure=True):
+        cmd = batch_utils.generate_runner_cmd(steps, stop_on_failure)
+        output = subprocess.check_output(['bash', '-c', cmd]).decode()
+        return batch_utils.parse_runner_output(output, steps)
+
+    def test_stop_on_failure(self):
+        results = self.run(self.STEPS)
+        assert [r['retcode'] for r in results] == [0, 3, 0, 1]
+        assert [r['ok'] for r in results] == [True, True, True, False]
+        assert results[0]['output'] == 'foo\nbar'
+        assert results[1]['output'] == 'its'
+        assert results[2]['output'] == '42'
+        assert results[3]['cmd'] == 'false'
+        assert all(r['duration'] >= 0 for r in results)
+
+    def test_continue_on_failure(self):
+        steps = self.STEPS[3:]
+        results = self.run(steps, stop_on_failure=False)
+        assert [r['ok'] for r in results] == [False, True]
+        assert results[1]['output'] == 'never'
+
+    def test_last_step_failed(self):
+        # check_output raises if the runner doesn't exit with 0
+        results = self.run(['true', 'false'], stop_on_failure=False)
+        assert [r['ok'] for r in results] == [True, False]
+
+    def test_output_expectation(self):
+        results = self.run([{'cmd': 'echo active', 'output': '^active$'},
+                            {'cmd': 'echo failed', 'output': '^active$'}])
+        assert [r['ok'] for r in results] == [True, False]
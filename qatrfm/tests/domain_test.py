@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import base64
+import json
+import pytest
+
+from unittest import mock
+
+from qatrfm.domain import Domain
+from qatrfm.utils import libutils
+
+
+class FakeAgent(object):
+    """ Qemu agent of a domain where a file grows with 'chunks' """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.commands = []
+
+    def __call__(self, cmd, **kwargs):
+        if 'guest-exec-status' in cmd:
+            ret = {'exited': False}
+        elif 'guest-exec' in cmd:
+            self.commands.append(cmd)
+            ret = {'pid': len(self.commands)}
+        elif 'guest-file-open' in cmd:
+            ret = 1000
+        elif 'guest-file-read' in cmd:
+            data = self.chunks.pop(0) if self.chunks else b''
+            ret = {'count': len(data), 'eof': True,
+                   'buf-b64': base64.b64encode(data).decode()}
+        else:
+            ret = {}
+        return json.dumps({'return': ret})
+
+
+class TestDomain(object):
+    """ Test Domain """
+
+    def test_wait_for_pattern(self):
+        agent = FakeAgent([b'starting\nlisten', b'ing on port 80\n'])
+        with mock.patch.object(libutils, 'execute_bash_cmd', agent):
+            match = Domain('vm').wait_for_pattern(
+                '/var/log/app.log', r'listening on port (\d+)', timeout=5)
+            assert match.group(1) == '80'
+            # Only the new lines are followed
+            assert 'tail -n 0 -F /var/log/app.log' in agent.commands[0]
+            # The follower is killed and its output file removed
+            assert 'kill -TERM 1' in agent.commands[1]
+            assert 'rm -f /tmp/qatrfm-follow-' in agent.commands[2]
+
+    def test_wait_for_pattern_timeout(self):
+        agent = FakeAgent([b'starting\n'])
+        with mock.patch.object(libutils, 'execute_bash_cmd', agent):
+            with pytest.raises(libutils.TrfmDomainTimeout):
+                Domain('vm').wait_for_pattern('apache2', 'ready', timeout=0)
+            assert ' -n 0 -f -u apache2' in agent.commands[0]
+
+    def test_wait_for_pattern_from_start(self):
+        agent = FakeAgent([b'ready\n'])
+        with mock.patch.object(libutils, 'execute_bash_cmd', agent):
+            Domain('vm').wait_for_pattern('apache2', 'ready', timeout=5,
+                                          from_start=True)
+            assert ' -n all -f -u apache2' in agent.commands[0]
+
+    def test_wait_for_condition(self):
+        agent = FakeAgent([b'inactive\n@@QATRFM-CONDITION@@ 3\n',
+                           b'active\n@@QATRFM-CONDITION@@ 0\n'])
+        with mock.patch.object(libutils, 'execute_bash_cmd', agent):
+            ret = Domain('vm').wait_for_condition(
+                'systemctl is-active apache2',
+                lambda retcode, output: output == 'active', timeout=5)
+            assert ret == [0, 'active']
+
+    def ready_domain(self, leases, agent, network=True):
+        domain = Domain('qatrfm-vm-abcdefghij-0')
+        domain.has_network = mock.Mock(return_value=network)
+        domain.get_lease_ip = mock.Mock(side_effect=leases)
+        domain.check_qemu_agent = mock.Mock(side_effect=agent)
+        domain._wait_for_agent_event = mock.Mock()
+        domain.wait_for_ip_ready = mock.Mock()
+        domain.wait_for_ssh_ready = mock.Mock()
+        return domain
+
+    def test_wait_for_ready_lease(self):
+        # The lease appears after booting for a while, even if the qemu
+        # agent answers before
+        domain = self.ready_domain([None, None, '10.1.0.50'], [True] * 3)
+        domain.wait_for_ready(timeout=10)
+        assert domain.ip == '10.1.0.50'
+        assert domain.get_lease_ip.call_count == 3
+        domain.check_qemu_agent.assert_not_called()
+        domain.wait_for_ssh_ready.assert_called_once_with(10)
+
+    def test_wait_for_ready_agent_only(self):
+        domain = self.ready_domain([], [False, True], network=False)
+        domain.wait_for_ready(timeout=10)
+        assert domain.ip is None
+        domain.get_lease_ip.assert_not_called()
+        domain.wait_for_ip_ready.assert_not_called()
+
+    def test_wait_for_ready_no_lease(self):
+        domain = self.ready_domain([None], [True])
+        domain.wait_for_ready(timeout=0)
+        assert domain.ip is None
+        domain.wait_for_ip_ready.assert_not_called()
+        domain = self.ready_domain([None], [False])
+        with pytest.raises(libutils.TrfmDomainTimeout):
+            domain.wait_for_ready(timeout=0)
@@ -9,9 +9,14 @@
 
 import pytest
 
+from pathlib import Path
+
 from unittest import mock
 
 from qatrfm.environment import TerraformEnv
+from qatrfm.utils import registry
+
+DEFAULT_TF = Path(__file__).resolve().parents[1] / 'config' / 'default.tf'
 
 
 class TestTerraformEnv(object):
@@ -54,3 +59,113 @@ class TestTerraformEnv(object):
         assert mocked_TerraformEnv_file.tf_file == self.FILENAME
         mock_copy.assert_called_with(
             self.FILENAME, mocked_TerraformEnv_file.workdir + '/env.tf')
+
+    @mock.patch('qatrfm.utils.libutils.execute_bash_cmd',
+                return_value=EXEC_RETURN)
+    @mock.patch('shutil.copy')
+    @mock.patch('tempfile.mkdtemp', return_value=TMP_FOLDER)
+    def test_fingerprint(self, mock_mkdtemp, mock_copy, mock_exec, tmp_path):
+        tf_file = tmp_path / self.FILENAME
+        tf_file.write_text('variable "var1" {}')
+        env1 = TerraformEnv(self.NET_OCTET, self.TFVARS, tf_file)
+        env2 = TerraformEnv(self.NET_OCTET + 1, sorted(self.TFVARS), tf_file)
+        assert env1.basename != env2.basename
+        assert env1.fingerprint == env2.fingerprint
+        env3 = TerraformEnv(self.NET_OCTET, {"var1=other"}, tf_file)
+        assert env1.fingerprint != env3.fingerprint
+        fingerprint = env1.fingerprint
+        tf_file.write_text('variable "var2" {}')
+        assert env1.fingerprint != fingerprint
+
+    @mock.patch('shutil.copy')
+    @mock.patch('tempfile.mkdtemp', return_value=TMP_FOLDER)
+    def test_init_existing_workdir(self, mock_mkdtemp, mock_copy):
+        env = TerraformEnv(self.NET_OCTET, self.TFVARS, self.FILENAME,
+                           basename='abcdefghij', workdir='/tmp/existing')
+        assert env.basename == 'abcdefghij'
+        assert env.workdir == '/tmp/existing'
+        assert 'basename=abcdefghij' in env.tf_vars
+        mock_mkdtemp.assert_not_called()
+        mock_copy.assert_not_called()
+
+    @mock.patch('shutil.copy')
+    @mock.patch('tempfile.mkdtemp', return_value=TMP_FOLDER)
+    def test_static_ips(self, mock_mkdtemp, mock_copy):
+        tf_file = Path(__file__).resolve().parents[1] / 'config' / 'default.tf'
+        env = TerraformEnv(3, {'image=foo', 'num_domains=2'}, tf_file)
+        env.set_static_ips()
+        assert 'domain_ips=["10.3.0.10", "10.3.0.11"]' in env.vars
+        assert '\'domain_ips=["10.3.0.10", "10.3.0.11"]\'' in env.tf_vars
+
+    @mock.patch('qatrfm.utils.registry.update')
+    @mock.patch('shutil.copy')
+    @mock.patch('tempfile.mkdtemp', return_value=TMP_FOLDER)
+    def test_scale(self, mock_mkdtemp, mock_copy, mock_update):
+        tf_file = Path(__file__).resolve().parents[1] / 'config' / 'default.tf'
+        env = TerraformEnv(3, {'image=foo', 'num_domains=2'}, tf_file,
+                           snapshots=True)
+        names = ['qatrfm-vm-{}-{}'.format(env.basename, i) for i in range(3)]
+        env.domains = [mock.Mock() for i in range(2)]
+        for domain, name in zip(env.domains, names):
+            domain.name = name
+        kept = list(env.domains)
+        new = mock.Mock()
+        new.name = names[2]
+        env.apply = mock.Mock()
+        env.wait_for_domains = mock.Mock()
+        env.get_domains = mock.Mock(return_value=[mock.Mock(), mock.Mock(),
+                                                  new])
+        env.get_domains.return_value[0].name = names[0]
+        env.get_domains.return_value[1].name = names[1]
+
+        env.scale(3)
+        assert env.domains == kept + [new]
+        assert 'num_domains=3' in env.vars
+        assert 'domain_ips=["10.3.0.10", "10.3.0.11", "10.3.0.12"]' in \
+            env.vars
+        env.wait_for_domains.assert_called_once_with([new], 300)
+        new.snapshot.assert_called_once_with(action='create')
+
+        env.scale(1)
+        assert env.domains == kept[:1]
+        assert 'num_domains=1' in env.vars
+        kept[1].snapshot.assert_called_once_with(action='delete')
+        new.snapshot.assert_called_with(action='delete')
+        kept[0].snapshot.assert_not_called()
+
+    def test_attach(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(registry, 'REGISTRY_DIR', str(tmp_path / 'envs'))
+        env = TerraformEnv(3, ['image=foo'], DEFAULT_TF,
+                           workdir=str(tmp_path))
+        env.cached_steps = 1
+        env.set_var('image', '/layers/abc.qcow2')
+        env.set_var('running', 'false')
+        env.set_var('num_domains', 2)
+        env.set_placement([[2, 3], []], [1, None])
+        registry.register(env.basename, **env.registry_info())
+        domains = [mock.Mock(), mock.Mock()]
+        with mock.patch.object(TerraformEnv, 'get_domains',
+                               return_value=domains):
+            attached = TerraformEnv.attach(registry.get_entry(env.basename),
+                                           ['image=foo'], DEFAULT_TF)
+        assert attached.domains == domains
+        # The variables set by qatrfm are back, so applying again doesn't
+        # replace the domains
+        assert attached.cached_steps == 1
+        for var in ('image=/layers/abc.qcow2', 'running=false',
+                    'num_domains=2', 'cpuset=["2-3", ""]',
+                    'numa_node=["1", ""]'):
+            assert var in attached.vars
+        assert 'image=foo' not in attached.vars
+
+    @mock.patch('qatrfm.utils.registry.unregister')
+    def test_release_octet(self, mock_unregister, tmp_path):
+        env = TerraformEnv(self.NET_OCTET, self.TFVARS, self.FILENAME,
+                           workdir=str(tmp_path))
+        lock = open(str(tmp_path / 'lock'), 'a')
+        env.octet_lock = lock
+        # The octet is kept until the environment is removed
+        env._release()
+        assert lock.closed
+        assert env.octet_lock is None
+        mock_unregister.assert_called_once_with(env.basename)
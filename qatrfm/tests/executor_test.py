@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import base64
+import json
+import pytest
+import re
+
+from concurrent.futures import CancelledError
+from unittest import mock
+
+from qatrfm.executor import GuestExecutor
+from qatrfm.utils import libutils
+
+
+class FakeAgent(object):
+    """ Answers guest-exec and guest-exec-status like the qemu agent """
+
+    def __init__(self):
+        self.exited = set()
+        self.commands = {}
+        self.calls = []
+
+    def __call__(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        match = re.search(r'"pid": (\d+)', cmd)
+        if match:
+            pid = int(match.group(1))
+            ret = {'exited': pid in self.exited}
+            if pid in self.exited:
+                ret['exitcode'] = 0
+                ret['out-data'] = base64.b64encode(
+                    'out{}'.format(pid).encode()).decode()
+        else:
+            pid = len(self.commands) + 1
+            self.commands[pid] = cmd
+            ret = {'pid': pid}
+        return json.dumps({'return': ret})
+
+
+class TestGuestExecutor(object):
+    """ Test GuestExecutor """
+
+    def executor(self):
+        domain = mock.Mock()
+        domain.name = 'vm'
+        domain.check_qemu_agent.return_value = True
+        return GuestExecutor(domain, min_interval=0.01, max_interval=0.05)
+
+    def test_concurrent_processes(self):
+        agent = FakeAgent()
+        executor = self.executor()
+        with mock.patch.object(libutils, 'execute_bash_cmd', agent):
+            p1 = executor.submit('sleep 10')
+            p2 = executor.submit('echo hi')
+            agent.exited.add(2)
+            assert p2.result(1) == [0, 'out2']
+            assert not p1.done()
+            agent.exited.add(1)
+            assert p1.result(1) == [0, 'out1']
+        # The poller stops when nothing is outstanding
+        assert libutils.wait_for(lambda: executor.thread is None, timeout=1)
+
+    def test_cancel(self):
+        agent = FakeAgent()
+        executor = self.executor()
+        with mock.patch.object(libutils, 'execute_bash_cmd', agent):
+            p = executor.submit('tail -F /var/log/messages')
+            assert p.cancel()
+            with pytest.raises(CancelledError):
+                p.result(1)
+            assert 'kill -TERM 1' in agent.commands[2]
+            assert not p.cancel()
+
+    def test_timeout(self):
+        agent = FakeAgent()
+        executor = self.executor()
+        with mock.patch.object(libutils, 'execute_bash_cmd', agent):
+            p = executor.submit('sleep 10', timeout=0)
+            with pytest.raises(libutils.TrfmCommandTimeout):
+                p.result(1)
+            assert 'kill -TERM 1' in agent.commands[2]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import fnmatch
+import re
+import tarfile
+
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from qatrfm.harvest import HarvestPlugin, target_dir
+from qatrfm.testcase import TrfmTestCase
+from qatrfm.utils import libutils
+
+
+class LogsTest(TrfmTestCase):
+    artifacts = ['/var/log/app/*/x.log']
+
+
+GUEST_FILES = ['/root/core.1', '/var/log/app/a/x.log', '/var/log/app/b/x.log']
+
+
+def fake_bash(cmd, **kwargs):
+    """ guestfish listing and copying GUEST_FILES, virsh succeeding """
+    patterns = re.findall(r"glob-expand '([^']*)'", cmd)
+    if patterns:
+        return ''.join(f + '\n' for f in GUEST_FILES
+                       if any(fnmatch.fnmatch(f, p) for p in patterns))
+    for path, directory in re.findall(r"copy-out '([^']*)' (\S+)", cmd):
+        (Path(directory) / Path(path).name).write_text(path)
+    return ''
+
+
+class TestHarvest(object):
+    """ Test the harvest plugin """
+
+    def test_target_dir(self):
+        assert target_dir('/var/log/messages', '/t') == Path('/t/var/log')
+        assert target_dir('/var/log/a/x.log', '/t') == Path('/t/var/log/a')
+        assert target_dir('/core', '/t') == Path('/t')
+
+    def test_after_test(self, tmp_path):
+        domains = [mock.Mock(), mock.Mock()]
+        for i, d in enumerate(domains):
+            d.name = 'vm{}'.format(i)
+            d.get_disk_path.return_value = '/disks/vm{}.qcow2'.format(i)
+            d.check_qemu_agent.return_value = (i == 0)
+        test = LogsTest(mock.Mock(domains=domains), 'LogsTest')
+        plugin = HarvestPlugin(tmp_path, ['/root/core.*'])
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=fake_bash) as mock_exec:
+            plugin.after_test(test, test.EX_OK)
+        cmds = [c[0][0] for c in mock_exec.call_args_list]
+        # Only the domain with agent is frozen, both are paused and resumed
+        assert len([c for c in cmds if 'domfsfreeze' in c]) == 1
+        assert len([c for c in cmds if 'domfsthaw' in c]) == 1
+        assert len([c for c in cmds if ' suspend ' in c]) == 2
+        assert len([c for c in cmds if ' resume ' in c]) == 2
+        with tarfile.open(str(tmp_path / 'LogsTest.tar.gz')) as tar:
+            names = tar.getnames()
+        assert 'vm0/root/core.1' in names
+        # Files with the same name keep their own path
+        assert 'vm1/var/log/app/a/x.log' in names
+        assert 'vm1/var/log/app/b/x.log' in names
+
+    def test_thaw_if_suspend_fails(self, tmp_path):
+        domain = mock.Mock()
+        domain.name = 'vm0'
+        domain.check_qemu_agent.return_value = True
+        plugin = HarvestPlugin(tmp_path)
+
+        def suspend_fails(cmd, **kwargs):
+            if ' suspend ' in cmd:
+                raise libutils.TrfmCommandFailed('error')
+            return ''
+
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=suspend_fails) as mock_exec:
+            with pytest.raises(libutils.TrfmCommandFailed):
+                plugin._harvest_domain(domain, ['/core'], tmp_path)
+        assert 'domfsthaw' in mock_exec.call_args_list[-1][0][0]
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+from unittest import mock
+
+from qatrfm import journal
+from qatrfm.testcase import TrfmTestCase
+
+
+class Passing(TrfmTestCase):
+    pass
+
+
+class Failing(TrfmTestCase):
+    pass
+
+
+class TestRunJournal(object):
+    """ Test RunJournal """
+
+    def env(self, basename):
+        return mock.Mock(basename=basename, workdir='/tmp/' + basename,
+                         net_octet=3, snapshots=False)
+
+    def test_resume_state(self, tmp_path):
+        path = tmp_path / 'journal.jsonl'
+        run = journal.RunJournal(path)
+        run.env_deployed('a.tf', self.env('aaaa'))
+        run.env_deployed('b.tf', self.env('bbbb'))
+        run.test_finished('a.tf', Passing, TrfmTestCase.EX_OK)
+        run.test_finished('a.tf', Failing, TrfmTestCase.EX_FAILURE)
+        run.env_released(self.env('aaaa'))
+        run.close()
+        # Interrupted while writing an event
+        with open(str(path), 'a') as f:
+            f.write('{"event": "test_fin')
+
+        events = journal.load(path)
+        assert len(events) == 5
+        assert journal.passed_tests(events) == {journal.test_id(Passing)}
+        live = journal.live_environments(events)
+        assert list(live.keys()) == ['b.tf']
+        assert live['b.tf']['workdir'] == '/tmp/bbbb'
+
+    def test_new_run_truncates(self, tmp_path):
+        path = tmp_path / 'journal.jsonl'
+        journal.RunJournal(path).env_released(self.env('aaaa'))
+        journal.RunJournal(path, append=True).env_released(self.env('bbbb'))
+        assert len(journal.load(path)) == 2
+        journal.RunJournal(path).env_released(self.env('cccc'))
+        assert len(journal.load(path)) == 1
+
+    def test_resume_after_truncated_line(self, tmp_path):
+        path = tmp_path / 'journal.jsonl'
+        run = journal.RunJournal(path)
+        run.env_released(self.env('aaaa'))
+        run.close()
+        # The previous run was killed while writing an event
+        with open(str(path), 'a') as f:
+            f.write('{"event": "env_rel')
+        journal.RunJournal(path, append=True).env_released(self.env('bbbb'))
+        assert [e['basename'] for e in journal.load(path)] == \
+            ['aaaa', 'bbbb']
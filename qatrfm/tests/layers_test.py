@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import os
+
+from qatrfm.layers import LayerCache, chain_keys
+
+
+class TestLayers(object):
+    """ Test the provisioning layer cache """
+
+    STEPS = ['zypper -n in apache2', {'put': '/nonexistent', 'path': '/a'},
+             {'cmd': 'systemctl start apache2', 'retcode': 0}]
+
+    def test_chain_keys(self):
+        keys = chain_keys('image.qcow2', self.STEPS)
+        assert len(set(keys)) == 3
+        # A key only depends on the steps before it
+        assert chain_keys('image.qcow2', self.STEPS[:2]) == keys[:2]
+        assert chain_keys('other.qcow2', self.STEPS)[0] != keys[0]
+        assert chain_keys('image.qcow2', ['true'] + self.STEPS[1:])[1] != \
+            keys[1]
+
+    def test_lookup_longest_prefix(self, tmp_path):
+        cache = LayerCache(str(tmp_path))
+        keys = chain_keys('image.qcow2', self.STEPS)
+        assert cache.lookup(keys) == 0
+        open(cache.path(keys[0]), 'w').close()
+        open(cache.path(keys[1]), 'w').close()
+        assert cache.lookup(keys) == 2
+
+    def test_evict_least_recently_used(self, tmp_path):
+        cache = LayerCache(str(tmp_path), budget=25)
+        for i, key in enumerate(['a', 'b', 'c']):
+            with open(cache.path(key), 'w') as f:
+                f.write('x' * 10)
+            os.utime(cache.path(key), (i, i))
+        # 'a' is used again
+        os.utime(cache.path('a'), (5, 5))
+        cache.evict(keep=['b'])
+        assert sorted(p.stem for p in tmp_path.glob('*.qcow2')) == ['a', 'b']
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import pytest
+import threading
+
+from unittest import mock
+
+from qatrfm.lease import DomainPool
+from qatrfm.utils import libutils
+
+
+class TestDomainPool(object):
+    """ Test DomainPool """
+
+    def env(self, snapshots=False):
+        domains = [mock.Mock() for i in range(4)]
+        for i, d in enumerate(domains):
+            d.name = 'vm{}'.format(i)
+        return mock.Mock(domains=domains, snapshots=snapshots)
+
+    def test_disjoint_leases(self):
+        env = self.env()
+        pool = DomainPool(env)
+        leased1 = pool.acquire(1)
+        leased2 = pool.acquire(3)
+        assert leased1.domains == env.domains[:1]
+        assert leased2.domains == env.domains[1:]
+        assert leased1.workdir == env.workdir
+        assert pool.free == []
+        pool.release(leased1)
+        assert pool.free == env.domains[:1]
+
+    def test_acquire_waits(self):
+        pool = DomainPool(self.env())
+        leased = pool.acquire(3)
+        acquired = threading.Event()
+        thread = threading.Thread(
+            target=lambda: acquired.set() if pool.acquire(2) else None)
+        thread.start()
+        assert not acquired.wait(0.1)
+        pool.release(leased)
+        thread.join(1)
+        assert acquired.is_set()
+
+    @mock.patch('time.sleep')
+    def test_release_reverts_leased_domains(self, mock_sleep):
+        env = self.env(snapshots=True)
+        pool = DomainPool(env)
+        leased = pool.acquire(2)
+        pool.release(leased)
+        for d in env.domains[:2]:
+            d.snapshot.assert_called_once_with(action='revert')
+        for d in env.domains[2:]:
+            d.snapshot.assert_not_called()
+
+    @mock.patch('shutil.rmtree')
+    @mock.patch('time.sleep')
+    def test_release_revert_failed(self, mock_sleep, mock_rmtree):
+        env = self.env(snapshots=True)
+        env.domains[0].snapshot.side_effect = \
+            libutils.TrfmSnapshotFailed('failed')
+        pool = DomainPool(env)
+        leased = pool.acquire(2)
+        with pytest.raises(libutils.TrfmSnapshotFailed):
+            pool.release(leased)
+        # The environment is still used by other tests, its owner cleans it
+        mock_rmtree.assert_not_called()
+        assert pool.free == env.domains[2:] + env.domains[:2]
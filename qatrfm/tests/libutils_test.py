@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import socket
+
+from unittest import mock
+
+from qatrfm.utils import libutils
+
+
+class TestLibutils(object):
+    """ Test libutils """
+
+    def test_wait_for_backoff(self):
+        results = iter([False, False, False, True])
+        waiter = mock.Mock()
+        assert libutils.wait_for(lambda: next(results), timeout=60,
+                                 interval=1, max_interval=3, waiter=waiter)
+        assert [c[0][0] for c in waiter.call_args_list] == [1, 2, 3]
+
+    def test_wait_for_timeout(self):
+        assert not libutils.wait_for(lambda: False, timeout=0.2,
+                                     interval=0.05)
+
+    def test_tcp_port_is_open(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        assert libutils.tcp_port_is_open('127.0.0.1', port)
+        server.close()
+        assert not libutils.tcp_port_is_open('127.0.0.1', port)
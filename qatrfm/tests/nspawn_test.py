@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import pytest
+import subprocess
+import time
+
+from unittest import mock
+
+from qatrfm.nspawn import NspawnDomain
+from qatrfm.utils import libutils
+
+
+class TestNspawnDomain(object):
+    """ Test NspawnDomain """
+
+    def domain(self, workdir):
+        d = NspawnDomain('qatrfm-ct-abcdefghij-0', '/rootfs', str(workdir),
+                         'qatrfm1', '10.1.0.10', '10.1.0.1')
+        d.pid = 1234
+        return d
+
+    @mock.patch('subprocess.run')
+    def test_execute_cmd(self, mock_run, tmp_path):
+        mock_run.return_value = subprocess.CompletedProcess(
+            [], 0, stdout=b'hello\n', stderr=b'')
+        d = self.domain(tmp_path)
+        assert d.execute_cmd('echo hello') == [0, 'hello\n']
+        args = mock_run.call_args[0][0]
+        assert args[:3] == ['nsenter', '--target', '1234']
+        assert args[-1] == 'echo hello'
+
+    @mock.patch('subprocess.run')
+    def test_execute_cmd_failed(self, mock_run, tmp_path):
+        mock_run.return_value = subprocess.CompletedProcess(
+            [], 1, stdout=b'', stderr=b'error')
+        d = self.domain(tmp_path)
+        assert d.execute_ssh_cmd('false', exit_on_failure=False) == \
+            [1, 'error']
+        with pytest.raises(libutils.TrfmCommandFailed):
+            d.execute_cmd('false')
+
+    def test_transfer_file(self, tmp_path):
+        d = self.domain(tmp_path)
+        assert d.executor is None
+        with mock.patch.object(libutils, 'execute_bash_cmd') as mock_exec:
+            d.transfer_file('/etc/app.conf', '/tmp/local.conf', type='put')
+            d.transfer_file('/etc/app.conf', '/tmp/back.conf')
+        cmds = [c[0][0] for c in mock_exec.call_args_list]
+        # machinectl resolves the paths inside the container
+        assert cmds == [
+            'machinectl copy-to qatrfm-ct-abcdefghij-0 /tmp/local.conf '
+            '/etc/app.conf',
+            'machinectl copy-from qatrfm-ct-abcdefghij-0 /etc/app.conf '
+            '/tmp/back.conf']
+
+    @mock.patch('qatrfm.utils.nspawn_utils.generate_nsenter_args',
+                lambda pid, cmd: ['bash', '-c', cmd])
+    def test_execute_cmd_async(self, tmp_path):
+        d = self.domain(tmp_path)
+        process = d.execute_cmd_async('echo hello')
+        assert process.result(10) == [0, 'hello\n']
+        assert d.execute_cmd_async('echo error >&2; exit 3').result(10) == \
+            [3, 'error\n']
+        with pytest.raises(libutils.TrfmCommandTimeout):
+            d.execute_cmd_async('sleep 10', timeout=0.1).result(10)
+        process = d.execute_cmd_async('sleep 10')
+        assert process.cancel()
+        assert process.done()
+        process.popen.wait(10)
+
+    @mock.patch('qatrfm.utils.nspawn_utils.generate_nsenter_args',
+                lambda pid, cmd: ['bash', '-c', cmd])
+    def test_wait_for(self, tmp_path):
+        d = self.domain(tmp_path)
+        log = tmp_path / 'app.log'
+        log.write_text('starting\n')
+        match = d.wait_for_pattern(str(log), r'st(\w+)ing', timeout=10,
+                                   from_start=True)
+        assert match.group(1) == 'art'
+        flag = tmp_path / 'flag'
+        d.execute_cmd_async('sleep 0.3; touch {}'.format(flag))
+        start = time.monotonic()
+        assert d.wait_for_condition('test -f {}'.format(flag), timeout=10,
+                                    interval=0.1)[0] == 0
+        assert time.monotonic() - start < 5
+        with pytest.raises(libutils.TrfmDomainTimeout):
+            d.wait_for_pattern(str(log), 'never', timeout=0.5)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+from qatrfm import placement
+
+
+class TestPlacement(object):
+    """ Test CPU placement """
+
+    TOPOLOGY = {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+
+    def test_cpulist(self):
+        assert placement.parse_cpulist('0-3,8,10-11\n') == \
+            [0, 1, 2, 3, 8, 10, 11]
+        assert placement.format_cpulist([8, 0, 1, 2, 3, 10, 11]) == \
+            '0-3,8,10-11'
+
+    def test_host_topology(self, tmp_path):
+        for node, cpulist in (('node0', '0-1'), ('node1', '2-3')):
+            (tmp_path / node).mkdir()
+            (tmp_path / node / 'cpulist').write_text(cpulist + '\n')
+        (tmp_path / 'possible').write_text('0-1\n')
+        assert placement.host_topology(str(tmp_path)) == \
+            {0: [0, 1], 1: [2, 3]}
+        assert list(placement.host_topology(str(tmp_path / 'none'))) == [0]
+
+    def test_allocate_single_node(self):
+        # Best fit: node 1 has fewer free CPUs but enough
+        assert placement.allocate(2, self.TOPOLOGY, [4, 5]) == \
+            {'node': 1, 'cpus': [6, 7]}
+        assert placement.allocate(3, self.TOPOLOGY, [4, 5]) == \
+            {'node': 0, 'cpus': [0, 1, 2]}
+
+    def test_allocate_spread_or_unpinned(self):
+        assert placement.allocate(3, self.TOPOLOGY, [0, 1, 4, 5]) == \
+            {'node': None, 'cpus': [2, 3, 6]}
+        assert placement.allocate(5, self.TOPOLOGY, [0, 1, 4, 5]) is None
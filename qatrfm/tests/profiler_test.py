@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import time
+
+from unittest import mock
+
+from qatrfm import hooks
+from qatrfm.domain import Domain
+from qatrfm.profiler import ProfilerPlugin
+from qatrfm.testcase import TrfmTestCase
+
+
+class SleepyTest(TrfmTestCase):
+
+    def run(self):
+        time.sleep(0.2)
+        self.env.domains[0].execute_cmd('true')
+        return self.EX_OK
+
+
+def slow_agent(self, cmd, timeout=300, exit_on_failure=True):
+    time.sleep(0.2)
+    return [0, '']
+
+
+class TestProfiler(object):
+    """ Test the profiler plugin """
+
+    @mock.patch.object(Domain, 'execute_cmd', slow_agent)
+    def test_profile(self, tmp_path):
+        env = mock.Mock(domains=[Domain('vm')])
+        test = SleepyTest(env, 'SleepyTest')
+        plugin = ProfilerPlugin(tmp_path, interval=0.005)
+        hooks.register_plugin(plugin)
+        try:
+            hooks.call('before_test', test)
+            test.run()
+            hooks.call('after_test', test, test.EX_OK)
+        finally:
+            hooks.unregister_plugin(plugin)
+        assert (tmp_path / 'SleepyTest.prof').is_file()
+        folded = (tmp_path / 'SleepyTest.folded').read_text()
+        assert 'profiler_test:run;profiler_test:slow_agent' in folded
+        assert not plugin.profiles
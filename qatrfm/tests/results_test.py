@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import importlib.util
+import sys
+
+from qatrfm.results import ResultCache
+
+SOURCE = '''
+from qatrfm.testcase import TrfmTestCase
+
+
+class MyTest(TrfmTestCase):
+    pass
+'''
+
+
+class TestResultCache(object):
+    """ Test ResultCache """
+
+    def load(self, tmp_path, monkeypatch, source=SOURCE):
+        path = tmp_path / 'my_test.py'
+        path.write_text(source)
+        spec = importlib.util.spec_from_file_location('my_test', str(path))
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        # Removed from sys.modules when the test finishes
+        monkeypatch.setitem(sys.modules, 'my_test', mod)
+        return mod.MyTest
+
+    def test_key(self, tmp_path, monkeypatch):
+        tf_file = tmp_path / 'env.tf'
+        tf_file.write_text('variable "image" {}')
+        image = tmp_path / 'image.qcow2'
+        image.write_text('disk')
+        tfvars = ['image={}'.format(image)]
+        test = self.load(tmp_path, monkeypatch)
+        key = ResultCache.key(test, tf_file, tfvars)
+        assert ResultCache.key(test, tf_file, tfvars) == key
+        assert ResultCache.key(test, tf_file, tfvars, 'nspawn') != key
+        assert ResultCache.key(test, tf_file, tfvars + ['ram=2048']) != key
+        (tmp_path / 'helpers.py').write_text('X = 1')
+        assert ResultCache.key(test, tf_file, tfvars) != key
+        key = ResultCache.key(test, tf_file, tfvars)
+        image.write_text('new disk')
+        assert ResultCache.key(test, tf_file, tfvars) != key
+
+    def test_store(self, tmp_path, monkeypatch):
+        test = self.load(tmp_path, monkeypatch)
+        cache = ResultCache(str(tmp_path / 'cache'))
+        assert not cache.passed('abc')
+        cache.store('abc', test)
+        assert cache.passed('abc')
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import pytest
+
+from pathlib import Path
+from unittest import mock
+
+from qatrfm import teardown
+from qatrfm.environment import TerraformEnv
+from qatrfm.utils import libutils
+
+DEFAULT_TF = Path(__file__).parent.parent / 'config' / 'default.tf'
+
+DOMAINS = 'qatrfm-vm-abcdefghij-0\nqatrfm-vm-abcdefghij-1\n' \
+    'qatrfm-vm-klmnopqrst-0\nother-vm\n'
+VOLUMES = ' Name                               Path\n' \
+    '-----------------------------------------------\n' \
+    ' qatrfm-vdisk-abcdefghij-0.qcow2    /images/0.qcow2\n' \
+    ' sles.qcow2                         /images/sles.qcow2\n'
+NETWORKS = 'default\nqatrfm-net-abcdefghij\n'
+MACHINES = 'qatrfm-ct-uvwxyzabcd-0 container systemd-nspawn - - -\n'
+MOUNTS = 'overlay /tmp/tmpab12/qatrfm-ct-uvwxyzabcd-0/root overlay rw 0 0\n' \
+    'overlay /var/lib/docker/overlay2/1234/merged overlay rw 0 0\n'
+
+
+class FakeVirsh(object):
+    """ virsh of a host with two environments """
+
+    def __init__(self, removable=True):
+        self.removable = removable
+        self.cmds = []
+
+    def __call__(self, cmd, exit_on_failure=True, **kwargs):
+        self.cmds.append(cmd)
+        if cmd.startswith('machinectl list'):
+            return MACHINES
+        if cmd.startswith('machinectl show') and self.removable:
+            raise libutils.TrfmCommandFailed('no machine')
+        if ' list ' in cmd:
+            return DOMAINS
+        if ' vol-list ' in cmd:
+            return VOLUMES
+        if ' net-list ' in cmd:
+            return NETWORKS
+        if ' domstate ' in cmd and self.removable:
+            raise libutils.TrfmCommandFailed('domain not found')
+        return ''
+
+
+@pytest.fixture(autouse=True)
+def mounts(tmp_path_factory, monkeypatch):
+    path = tmp_path_factory.mktemp('proc') / 'mounts'
+    path.write_text(MOUNTS)
+    monkeypatch.setattr(teardown, 'MOUNTS', str(path))
+
+
+class TestTeardown(object):
+    """ Test the direct removal of libvirt resources and containers """
+
+    def test_find_resources(self):
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=FakeVirsh()):
+            resources = teardown.find_resources()
+            assert sorted(resources) == ['abcdefghij', 'klmnopqrst',
+                                         'uvwxyzabcd']
+            assert resources['abcdefghij'] == {
+                'machines': [], 'mounts': [],
+                'domains': ['qatrfm-vm-abcdefghij-0',
+                            'qatrfm-vm-abcdefghij-1'],
+                'volumes': ['qatrfm-vdisk-abcdefghij-0.qcow2'],
+                'networks': ['qatrfm-net-abcdefghij']}
+            # Containers of the nspawn backend
+            assert resources['uvwxyzabcd'] == {
+                'machines': ['qatrfm-ct-uvwxyzabcd-0'],
+                'mounts': ['/tmp/tmpab12/qatrfm-ct-uvwxyzabcd-0/root'],
+                'domains': [], 'volumes': [], 'networks': []}
+            assert list(teardown.find_resources('klmnopqrst')) == \
+                ['klmnopqrst']
+            assert teardown.find_resources('zzzzzzzzzz') == {}
+
+    def test_destroy_resources(self):
+        virsh = FakeVirsh()
+        resources = {'domains': ['qatrfm-vm-abcdefghij-0'],
+                     'volumes': ['qatrfm-vdisk-abcdefghij-0.qcow2'],
+                     'networks': ['qatrfm-net-abcdefghij']}
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=virsh):
+            teardown.destroy_resources(resources)
+        actions = [cmd.split()[3] for cmd in virsh.cmds]
+        # Domains go before the volumes and networks they use
+        assert actions == ['undefine', 'destroy', 'domstate', 'vol-delete',
+                           'net-destroy', 'net-undefine']
+
+    def test_destroy_containers(self):
+        virsh = FakeVirsh()
+        resources = {'machines': ['qatrfm-ct-uvwxyzabcd-0'],
+                     'mounts': ['/tmp/tmpab12/qatrfm-ct-uvwxyzabcd-0/root']}
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=virsh):
+            teardown.destroy_resources(resources)
+        # The container is stopped before its root file system is unmounted
+        assert virsh.cmds == [
+            'machinectl terminate qatrfm-ct-uvwxyzabcd-0',
+            'machinectl show qatrfm-ct-uvwxyzabcd-0 --property=Leader '
+            '--value',
+            'umount /tmp/tmpab12/qatrfm-ct-uvwxyzabcd-0/root']
+
+    def test_destroy_resources_failed(self):
+        resources = {'domains': ['qatrfm-vm-abcdefghij-0'], 'volumes': [],
+                     'networks': []}
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=FakeVirsh(removable=False)):
+            with pytest.raises(libutils.TrfmCommandFailed):
+                teardown.destroy_resources(resources)
+
+
+class TestFastClean(object):
+    """ Test TerraformEnv.fast_clean """
+
+    def env(self, tmp_path, tf_file=DEFAULT_TF, basename='abcdefghij'):
+        return TerraformEnv(1, [], str(tf_file), basename=basename,
+                            workdir=str(tmp_path), fast=True)
+
+    def test_fast_clean(self, tmp_path):
+        env = self.env(tmp_path)
+        virsh = FakeVirsh()
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=virsh):
+            assert env.fast_clean()
+        assert not tmp_path.exists()
+        removed = [cmd.split()[4] for cmd in virsh.cmds
+                   if ' undefine ' in cmd or ' vol-delete ' in cmd]
+        assert 'qatrfm-vm-abcdefghij-1' in removed
+        assert 'qatrfm-vm-klmnopqrst-0' not in removed
+
+    def test_fast_clean_not_found(self, tmp_path):
+        env = self.env(tmp_path, basename='zzzzzzzzzz')
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=FakeVirsh()):
+            assert not env.fast_clean()
+        assert tmp_path.exists()
+
+    def test_fast_clean_naming_convention(self, tmp_path):
+        tf_file = tmp_path / 'custom.tf'
+        tf_file.write_text('variable "basename" {}\n'
+                           'resource "libvirt_domain" "vm" {\n'
+                           '  name = "my-vm-${var.basename}"\n'
+                           '}\n')
+        env = self.env(tmp_path, tf_file)
+        with mock.patch.object(libutils, 'execute_bash_cmd') as mock_exec:
+            assert not env.fast_clean()
+        mock_exec.assert_not_called()
+
+    def test_fast_clean_failed(self, tmp_path):
+        env = self.env(tmp_path)
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=FakeVirsh(removable=False)):
+            assert not env.fast_clean()
+        assert tmp_path.exists()
+
+    def test_clean_fallback(self, tmp_path):
+        env = TerraformEnv(1, [], str(DEFAULT_TF), basename='abcdefghij',
+                           workdir=str(tmp_path), fast=True, snapshots=True)
+        removed, kept = mock.Mock(), mock.Mock()
+        removed.snapshot.side_effect = libutils.TrfmSnapshotFailed('gone')
+        removed.exists.return_value = False
+        env.domains = [removed, kept]
+        # The fast clean removed the first domain before failing
+        with mock.patch.object(env, 'fast_clean', return_value=False), \
+                mock.patch.object(libutils, 'execute_bash_cmd',
+                                  return_value='') as mock_exec, \
+                mock.patch('qatrfm.utils.registry.unregister'):
+            env.clean()
+        kept.snapshot.assert_called_once_with(action='delete')
+        assert 'terraform destroy' in mock_exec.call_args[0][0]
+        assert not tmp_path.exists()
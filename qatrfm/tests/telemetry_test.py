@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import json
+import subprocess
+
+from unittest import mock
+
+from qatrfm import telemetry
+from qatrfm.telemetry import COLUMNS, TelemetrySampler
+from qatrfm.utils import virsh_utils as vu
+
+DOMSTATS = """Domain: 'qatrfm-vm-abcdefghij-0'
+  state.state=1
+  cpu.time={cpu}
+  balloon.current=1048576
+  balloon.rss={rss}
+  block.count=2
+  block.0.name=vda
+  block.0.rd.bytes={rd}
+  block.0.wr.bytes=0
+  block.1.name=vdb
+  block.1.rd.bytes=1024
+  block.1.wr.bytes={wr}
+  net.count=1
+  net.0.name=vnet0
+  net.0.rx.bytes={rx}
+  net.0.tx.bytes=2048
+
+Domain: 'qatrfm-vm-abcdefghij-1'
+  cpu.time=5000000000
+  balloon.rss=2048
+
+"""
+
+
+def domstats(cpu, rss, rd, wr, rx):
+    return DOMSTATS.format(cpu=cpu, rss=rss, rd=rd, wr=wr,
+                           rx=rx).encode('utf-8')
+
+
+class TestTelemetry(object):
+    """ Test the resource telemetry """
+
+    def test_get_domstats(self):
+        stats = vu.get_domstats(domstats(1, 2, 3, 4, 5).decode('utf-8'))
+        assert sorted(stats) == ['qatrfm-vm-abcdefghij-0',
+                                 'qatrfm-vm-abcdefghij-1']
+        vm0 = stats['qatrfm-vm-abcdefghij-0']
+        assert vm0['cpu.time'] == 1
+        assert vm0['block.1.rd.bytes'] == 1024
+        assert vm0['net.0.rx.bytes'] == 5
+        # Names are not counters
+        assert 'block.0.name' not in vm0
+        assert stats['qatrfm-vm-abcdefghij-1'] == \
+            {'cpu.time': 5000000000, 'balloon.rss': 2048}
+
+    def sampler(self, outputs, capacity=10000):
+        domains = [mock.Mock(), mock.Mock()]
+        domains[0].name = 'qatrfm-vm-abcdefghij-0'
+        domains[1].name = 'qatrfm-vm-abcdefghij-1'
+        sampler = TelemetrySampler(domains, interval=1, capacity=capacity)
+        times = [100.0 + 10 * i for i in range(len(outputs))]
+        with mock.patch.object(telemetry, 'host_stats',
+                               side_effect=[(0.5, 4096, 0), (2.5, 1024, 512),
+                                            (1.0, 2048, 256)]), \
+                mock.patch('time.time', side_effect=times), \
+                mock.patch('subprocess.check_output', side_effect=outputs):
+            for _ in outputs:
+                sampler.sample()
+        return sampler
+
+    def test_sample(self):
+        sampler = self.sampler([domstats(0, 100, 1024, 0, 0)])
+        assert len(sampler.samples) == 2
+        assert sampler.samples[0] == (
+            100.0, 'qatrfm-vm-abcdefghij-0', 0, 1048576, 100,
+            2048, 0, 0, 2048, 0.5, 4096, 0)
+        # Missing counters are 0
+        assert sampler.samples[1][2:9] == (5000000000, 0, 2048, 0, 0, 0, 0)
+
+    def test_sample_failed(self):
+        sampler = self.sampler([subprocess.TimeoutExpired('virsh', 11)])
+        assert len(sampler.samples) == 0
+        assert sampler.summary() == []
+
+    def test_ring_buffer(self):
+        outputs = [domstats(i, 100, 0, 0, 0) for i in range(3)]
+        sampler = self.sampler(outputs, capacity=4)
+        # Only the last samples are kept, the oldest ones are dropped
+        assert len(sampler.samples) == 4
+        assert [s[0] for s in sampler.samples] == [110.0, 110.0, 120.0, 120.0]
+
+    def test_columns(self, tmp_path):
+        outputs = [domstats(0, 100, 0, 0, 0), domstats(1, 200, 0, 0, 0)]
+        sampler = self.sampler(outputs)
+        columns = sampler.columns()
+        assert list(columns) == COLUMNS
+        assert columns['time'] == [100.0, 100.0, 110.0, 110.0]
+        assert columns['balloon_rss'] == [100, 2048, 200, 2048]
+        assert columns['host_load1'] == [0.5, 0.5, 2.5, 2.5]
+        sampler.save(tmp_path / 'telemetry' / 'test.json')
+        assert json.loads((tmp_path / 'telemetry' / 'test.json').
+                          read_text()) == columns
+
+    def test_summary(self):
+        # 10 seconds: 5 s of CPU, 10 KiB read, 20 KiB written, 40 KiB rx
+        outputs = [domstats(0, 100, 0, 0, 0),
+                   domstats(5 * 10**9, 300, 10 * 1024, 20 * 1024, 40 * 1024)]
+        sampler = self.sampler(outputs)
+        assert sampler.summary() == [
+            "qatrfm-vm-abcdefghij-0: cpu 50.0%, disk r/w 1.0/2.0 KiB/s, "
+            "net rx/tx 4.0/0.0 KiB/s, max rss 300 KiB",
+            "qatrfm-vm-abcdefghij-1: cpu 0.0%, disk r/w 0.0/0.0 KiB/s, "
+            "net rx/tx 0.0/0.0 KiB/s, max rss 2048 KiB",
+            "host: max load 2.50, max swap used 512 KiB"]
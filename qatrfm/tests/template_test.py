@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import json
+import re
+import xml.etree.ElementTree as ET
+
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from qatrfm.template import TemplateStore
+from qatrfm.utils import libutils
+
+DOMAIN_XML = """<domain type='kvm'>
+  <name>{name}</name>
+  <uuid>{uuid}</uuid>
+  <devices>
+    <disk type='file' device='disk'><source file='{disk}'/></disk>
+    <interface type='network'>
+      <mac address='{mac}'/><source network='{network}'/>
+    </interface>
+  </devices>
+</domain>"""
+
+
+class FakeVirsh(object):
+    """
+    virsh and qemu-img of a host with a fresh domain 'vm'. Like libvirt, a
+    saved state is only restored with the UUID and MAC addresses it was
+    saved with, and a name or UUID can't be used by two domains.
+    """
+
+    def __init__(self, disk, state='shut off', owner=None, restore_ok=True):
+        self.disk = disk
+        self.state = state
+        self.restore_ok = restore_ok
+        self.defined = {'vm': DOMAIN_XML.format(
+            name='vm', uuid='1111', disk=disk, mac='52:54:00:11:11:11',
+            network='vm-net')}
+        if owner is not None:
+            self.defined[owner] = self.saved_xml()
+        self.restored_xml = None
+
+    @staticmethod
+    def saved_xml():
+        return DOMAIN_XML.format(
+            name='tmpl', uuid='0000', disk='/tmpl.qcow2',
+            mac='52:54:00:00:00:00', network='tmpl-net')
+
+    @staticmethod
+    def identity(xml):
+        root = ET.fromstring(xml)
+        return (root.find('name').text, root.find('uuid').text,
+                [m.get('address') for m in root.iter('mac')])
+
+    def add(self, xml):
+        name, uuid, _ = self.identity(xml)
+        for other, other_xml in self.defined.items():
+            if (other == name) != (self.identity(other_xml)[1] == uuid):
+                raise libutils.TrfmCommandFailed(
+                    "domain '{}' is already defined with uuid {}".format(
+                        other, self.identity(other_xml)[1]))
+        self.defined[name] = xml
+
+    def restore(self, xml):
+        # virDomainDefCheckABIStability
+        _, saved_uuid, saved_macs = self.identity(self.saved_xml())
+        _, uuid, macs = self.identity(xml)
+        if uuid != saved_uuid:
+            raise libutils.TrfmCommandFailed(
+                "Target domain uuid {} does not match source {}".format(
+                    uuid, saved_uuid))
+        if macs != saved_macs:
+            raise libutils.TrfmCommandFailed(
+                "Target network card mac does not match source")
+        if not self.restore_ok:
+            raise libutils.TrfmCommandFailed('restore failed')
+        self.add(xml)
+        self.restored_xml = xml
+
+    def __call__(self, cmd, exit_on_failure=True, **kwargs):
+        try:
+            return self.run(cmd)
+        except libutils.TrfmCommandFailed:
+            if exit_on_failure:
+                raise
+            return ''
+
+    def run(self, cmd):
+        xml_file = re.search(r' (?:--xml |define )(\S+)', cmd)
+        if xml_file:
+            xml_file = Path(xml_file.group(1)).read_text()
+        if ' save-image-dumpxml ' in cmd:
+            return self.saved_xml()
+        if ' dumpxml ' in cmd:
+            return self.defined[cmd.split()[-1]]
+        if ' domstate ' in cmd:
+            return self.state + '\n'
+        if ' domname ' in cmd:
+            for name, xml in self.defined.items():
+                if self.identity(xml)[1] == cmd.split()[-1]:
+                    return name + '\n'
+            raise libutils.TrfmCommandFailed('domain not found')
+        if ' undefine ' in cmd:
+            del self.defined[cmd.split()[4]]
+        elif ' define ' in cmd:
+            self.add(xml_file)
+        elif ' restore ' in cmd and xml_file:
+            self.restore(xml_file)
+        elif cmd.startswith('qemu-img create'):
+            Path(cmd.split()[-1]).write_text('overlay')
+        elif cmd.startswith('qemu-img convert'):
+            Path(cmd.split()[-1]).write_text('template')
+        return ''
+
+
+class TestTemplate(object):
+    """ Test the environment templates """
+
+    @pytest.fixture
+    def domain(self, tmp_path):
+        disk = tmp_path / 'vm.qcow2'
+        disk.write_text('original')
+        domain = mock.Mock()
+        domain.name = 'vm'
+        domain.get_disk_path.return_value = str(disk)
+        return domain
+
+    def run(self, virsh, function, *args):
+        with mock.patch.object(libutils, 'execute_bash_cmd',
+                               side_effect=virsh) as mock_exec:
+            result = function(*args)
+        return result, [c[0][0] for c in mock_exec.call_args_list]
+
+    def test_capture(self, tmp_path, domain):
+        store = TemplateStore('fp', str(tmp_path / 'templates'))
+        assert store.lock()
+        virsh = FakeVirsh(domain.get_disk_path())
+        _, cmds = self.run(virsh, store.capture, [domain])
+        assert store.exists()
+        meta = json.loads((store.path / 'meta.json').read_text())
+        assert meta['domains'] == ['vm']
+        assert Path(store._disk_file(0)).read_text() == 'template'
+        # The domain is saved and restored around the copy of its disk
+        assert ' save vm ' in cmds[0]
+        assert cmds[1].startswith('qemu-img convert')
+        assert ' restore ' in cmds[2]
+        # Other environments can't use it while it is being created
+        assert not TemplateStore('fp', str(tmp_path / 'templates')).lock(
+            shared=True)
+
+    def test_lock_shared(self, tmp_path):
+        first = TemplateStore('fp', str(tmp_path))
+        second = TemplateStore('fp', str(tmp_path))
+        assert first.lock(shared=True)
+        assert second.lock(shared=True)
+        assert not TemplateStore('fp', str(tmp_path)).lock()
+        first.release()
+        second.release()
+
+    def test_restore(self, tmp_path, domain):
+        store = TemplateStore('fp', str(tmp_path / 'templates'))
+        virsh = FakeVirsh(domain.get_disk_path())
+        restored, cmds = self.run(virsh, store.restore, [domain])
+        assert restored == [domain]
+        # The domain keeps the identity of the saved state and gets the
+        # name, disk and network of the domain of terraform
+        assert virsh.identity(virsh.restored_xml) == \
+            ('vm', '0000', ['52:54:00:00:00:00'])
+        assert virsh.defined['vm'] == virsh.restored_xml
+        assert 'network="vm-net"' in virsh.restored_xml
+        assert domain.get_disk_path() in virsh.restored_xml
+        assert not any(' start ' in c for c in cmds)
+        assert Path(domain.get_disk_path()).read_text() == 'overlay'
+        assert not Path(domain.get_disk_path() + '.qatrfm-orig').exists()
+
+    @pytest.mark.parametrize('conflict', [{'state': 'running'},
+                                          {'owner': 'other'}])
+    def test_restore_conflict(self, tmp_path, domain, conflict):
+        store = TemplateStore('fp', str(tmp_path / 'templates'))
+        virsh = FakeVirsh(domain.get_disk_path(), **conflict)
+        restored, cmds = self.run(virsh, store.restore, [domain])
+        assert restored == []
+        # The domain of terraform is booted from its own disk
+        assert not any(' restore ' in c or 'qemu-img' in c for c in cmds)
+        assert cmds[-1].endswith(' start vm')
+        assert virsh.identity(virsh.defined['vm'])[1] == '1111'
+        assert Path(domain.get_disk_path()).read_text() == 'original'
+
+    def test_restore_fallback(self, tmp_path, domain):
+        store = TemplateStore('fp', str(tmp_path / 'templates'))
+        virsh = FakeVirsh(domain.get_disk_path(), restore_ok=False)
+        restored, cmds = self.run(virsh, store.restore, [domain])
+        assert restored == []
+        # The domain of terraform and its disk are back and it is booted
+        assert virsh.identity(virsh.defined['vm'])[1] == '1111'
+        assert Path(domain.get_disk_path()).read_text() == 'original'
+        assert cmds[-1].endswith(' start vm')
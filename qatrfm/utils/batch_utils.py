@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Batch of commands
+
+Generates a bash script which runs a list of commands inside a domain in
+one go and reports the exit code, output and timing of each one, so that
+a long sequence of commands costs a single round trip.
+"""
+
+import base64
+
+MARKER = '@@QATRFM-STEP@@'
+
+RUNNER = r'''__qatrfm_step() {
+    local start end out rc ok=1
+    start=$(date +%s.%N)
+    out=$(bash -c "$(echo "$2" | base64 -d)" 2>&1)
+    rc=$?
+    end=$(date +%s.%N)
+    [ "$rc" -eq "$3" ] || ok=0
+    if [ -n "$4" ]; then
+        printf '%s' "$out" | grep -qE "$(echo "$4" | base64 -d)" || ok=0
+    fi
+    echo "@@QATRFM-STEP@@ $1 $rc $ok $start $end" \
+         "$(printf '%s' "$out" | base64 -w0)"
+    [ "$ok" -eq 1 ]
+}
+'''
+
+
+def _b64(s):
+    return base64.b64encode(s.encode('utf-8')).decode('ascii')
+
+
+def normalize_steps(steps):
+    """
+    A step is either a command string or a dict:
+        {'cmd': 'systemctl start foo',
+         'retcode': 0,            # expected exit code, 0 by default
+         'output': 'active'}      # optional extended regex (grep -E)
+    """
+    result = []
+    for step in steps:
+        if isinstance(step, str):
+            step = {'cmd': step}
+        result.append({'cmd': step['cmd'],
+                       'retcode': step.get('retcode', 0),
+                       'output': step.get('output')})
+    return result
+
+
+def generate_runner_script(steps, stop_on_failure=True):
+    script = RUNNER
+    for i, step in enumerate(normalize_steps(steps)):
+        pattern = _b64(step['output']) if step['output'] else ''
+        script += "__qatrfm_step {} {} {} '{}'".format(
+            i, _b64(step['cmd']), step['retcode'], pattern)
+        script += ' || exit 0\n' if stop_on_failure else '\n'
+    # The results of the steps are reported in the output, the runner
+    # itself always succeeds
+    return script + 'exit 0\n'
+
+
+def generate_runner_cmd(steps, stop_on_failure=True):
+    """ One line command which decodes and runs the runner script """
+    script = generate_runner_script(steps, stop_on_failure)
+    return 'echo {} | base64 -d | bash'.format(_b64(script))
+
+
+def parse_runner_output(output, steps):
+    """
+    Return a list with the result of every executed step:
+        {'cmd': ..., 'retcode': 0, 'output': '...', 'duration': 0.12,
+         'ok': True}
+    Steps which didn't run because of a previous failure are not included.
+    """
+    steps = normalize_steps(steps)
+    results = []
+    for line in output.splitlines():
+        fields = line.split(' ')
+        if fields[0] != MARKER or len(fields) < 6:
+            continue
+        index = int(fields[1])
+        encoded = fields[6] if len(fields) > 6 else ''
+        results.append({
+            'cmd': steps[index]['cmd'],
+            'retcode': int(fields[2]),
+            'ok': fields[3] == '1',
+            'duration': float(fields[5]) - float(fields[4]),
+            'output': base64.b64decode(encoded).decode('utf-8')})
+    return results
@@ -7,9 +7,13 @@
 # notice and this notice are preserved.  This file is offered as-is,
 # without any warranty.
 
+import errno
 import os
+import select
 import signal
+import socket
 import subprocess
+import time
 from threading import Timer
 
 from qatrfm.utils.logger import QaTrfmLogger
@@ -70,3 +74,43 @@ def execute_bash_cmd(cmd, timeout=300, exit_on_failure=True, cwd=os.getcwd()):
     if (retcode != 0 and exit_on_failure):
         raise TrfmCommandFailed(output)
     return output
+
+
+def wait_for(condition, timeout=300, interval=0.5, max_interval=5,
+             waiter=time.sleep):
+    """
+    Poll 'condition' until it returns True or 'timeout' seconds pass.
+
+    Between two polls 'waiter' is called with the number of seconds to wait.
+    That interval starts at 'interval' and doubles after every miss up to
+    'max_interval'. A waiter which returns earlier when something relevant
+    happens (e.g. a libvirt event) lets the condition be checked right away.
+    Returns True if the condition was met, False on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if condition():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        waiter(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+
+def tcp_port_is_open(ip, port, timeout=1):
+    """ Check with a non-blocking connect if ip:port accepts connections """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setblocking(False)
+    try:
+        err = s.connect_ex((ip, port))
+        if err not in (0, errno.EINPROGRESS):
+            return False
+        _, writable, _ = select.select([], [s], [], timeout)
+        if not writable:
+            return False
+        return s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+    except OSError:
+        return False
+    finally:
+        s.close()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+# The network zone of an environment is the bridge 'vz-<zone>' on the host,
+# interface names are limited to 15 characters.
+ZONE_PREFIX = 'qatrfm'
+
+
+def zone_name(net_octet):
+    return '{}{}'.format(ZONE_PREFIX, net_octet)
+
+
+def generate_overlay_mount_str(lower, upper, work, root):
+    return ('mount -t overlay overlay -o lowerdir={},upperdir={},workdir={} '
+            '{}'.format(lower, upper, work, root))
+
+
+def generate_umount_str(root):
+    return 'umount {}'.format(root)
+
+
+def generate_nspawn_str(machine, root, zone):
+    # Not booted: the container only runs a placeholder process, commands
+    # are executed in its namespaces with nsenter.
+    return ('systemd-nspawn --quiet --register=yes --machine={} '
+            '--directory={} --network-zone={} --as-pid2 sleep infinity'.
+            format(machine, root, zone))
+
+
+def generate_machine_leader_str(machine):
+    return 'machinectl show {} --property=Leader --value'.format(machine)
+
+
+def generate_machine_list_str():
+    return 'machinectl list --no-legend'
+
+
+def generate_machine_terminate_str(machine):
+    return 'machinectl terminate {}'.format(machine)
+
+
+def generate_machine_copy_str(machine, source, destination, type='get'):
+    # The paths in the container are resolved in its own root, absolute
+    # symbolic links don't point to the files of the host.
+    action = 'copy-from' if type == 'get' else 'copy-to'
+    return 'machinectl {} {} {} {}'.format(action, machine, source,
+                                           destination)
+
+
+def generate_nsenter_args(pid, cmd):
+    return ['nsenter', '--target', str(pid), '--mount', '--uts', '--ipc',
+            '--net', '--pid', '--root', '--wd', '--', 'bash', '-c', cmd]
+
+
+def generate_host_bridge_str(zone, ip):
+    return ('ip addr replace {}/24 dev vz-{} && ip link set vz-{} up'.
+            format(ip, zone, zone))
+
+
+def generate_guest_network_cmd(ip, gateway):
+    return ('ip link set host0 up && ip addr replace {}/24 dev host0 && '
+            'ip route replace default via {}'.format(ip, gateway))
@@ -29,6 +29,26 @@ def generate_guest_ping_str(domain):
             '\'{{ \"execute\": \"guest-ping\"}}\''.format(domain))
 
 
+def generate_guest_file_open_str(domain, path, mode='r'):
+    return ('virsh -c qemu:///system qemu-agent-command --domain {} --cmd '
+            '\'{{ \"execute\": \"guest-file-open\", \"arguments\":'
+            ' {{ \"path\": \"{}\", \"mode\": \"{}\" }}}}\''.format(
+                domain, path, mode))
+
+
+def generate_guest_file_read_str(domain, handle, count=65536):
+    return ('virsh -c qemu:///system qemu-agent-command --domain {} --cmd '
+            '\'{{ \"execute\": \"guest-file-read\", \"arguments\":'
+            ' {{ \"handle\": {}, \"count\": {} }}}}\''.format(
+                domain, handle, count))
+
+
+def generate_guest_file_close_str(domain, handle):
+    return ('virsh -c qemu:///system qemu-agent-command --domain {} --cmd '
+            '\'{{ \"execute\": \"guest-file-close\", \"arguments\":'
+            ' {{ \"handle\": {} }}}}\''.format(domain, handle))
+
+
 def get_pid(str):
     return json.loads(str)["return"]["pid"]
 
@@ -51,3 +71,13 @@ def get_output(str, field='out-data'):
     except Exception:
         pass
     return output
+
+
+def get_file_handle(str):
+    return json.loads(str)["return"]
+
+
+def get_file_data(str):
+    """ Returns the data read by 'guest-file-read' and if EOF was reached """
+    ret = json.loads(str)["return"]
+    return base64.b64decode(ret.get("buf-b64", "")), ret["eof"]
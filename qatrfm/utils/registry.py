@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Registry of environments
+
+Every environment deployed on the host is recorded in a small JSON file
+named after its basename. It allows other qatrfm processes to know which
+environments are alive, who owns them and where their working directory is.
+"""
+
+import json
+import os
+import time
+
+from pathlib import Path
+
+LOCKS_DIR = '/tmp/qatrfm'
+REGISTRY_DIR = LOCKS_DIR + '/envs'
+
+
+def _entry_path(basename):
+    return Path(REGISTRY_DIR) / '{}.json'.format(basename)
+
+
+def _write_entry(entry):
+    Path(REGISTRY_DIR).mkdir(parents=True, exist_ok=True)
+    path = _entry_path(entry['basename'])
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(entry))
+    os.replace(str(tmp), str(path))
+
+
+def register(basename, **info):
+    """ Record a new environment owned by the current process """
+    entry = {'basename': basename, 'pid': os.getpid(), 'created': time.time()}
+    entry.update(info)
+    _write_entry(entry)
+    return entry
+
+
+def update(basename, **info):
+    """ Update some fields of an existing entry """
+    entry = get_entry(basename)
+    if entry is None:
+        return register(basename, **info)
+    entry.update(info)
+    _write_entry(entry)
+    return entry
+
+
+def unregister(basename):
+    try:
+        _entry_path(basename).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def get_entry(basename):
+    try:
+        return json.loads(_entry_path(basename).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def list_entries():
+    entries = []
+    if not Path(REGISTRY_DIR).is_dir():
+        return entries
+    for path in sorted(Path(REGISTRY_DIR).glob('*.json')):
+        entry = get_entry(path.stem)
+        if entry is not None:
+            entries.append(entry)
+    return entries
+
+
+def owner_alive(entry):
+    """ Check if the process which registered the environment still runs """
+    try:
+        os.kill(entry['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def workdir_exists(entry):
+    workdir = entry.get('workdir')
+    return bool(workdir) and Path(workdir).is_dir()
+
+
+def is_orphan(entry):
+    """
+    An environment is orphan when its owner process is gone or when its
+    working directory (and so its terraform state) doesn't exist anymore.
+    """
+    if entry is None:
+        return True
+    return not workdir_exists(entry) or not owner_alive(entry)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+
+""" Helpers to inspect .tf files
+
+This is not a full HCL parser. It understands the subset used by qatrfm .tf
+files: variables with literal defaults and resources whose attributes are
+literals or plain '${var.x}' references.
+"""
+
+import hashlib
+import re
+
+from pathlib import Path
+
+# Variables calculated by qatrfm for each environment
+MANAGED_VARS = ('basename', 'net_octet', 'running', 'domain_ips', 'cpuset',
+                'numa_node')
+
+
+def parse_vars(tf_vars):
+    """ Convert a list of 'key=value' strings into a dict """
+    result = {}
+    for v in tf_vars:
+        kv = v.split('=', 1)
+        result[kv[0]] = kv[1]
+    return result
+
+
+def _find_blocks(text, header_regex):
+    """
+    Return (match, body) for every block whose header matches the regex.
+    The body is the text between the opening brace and its matching one.
+    """
+    blocks = []
+    for match in re.finditer(header_regex + r'\s*\{', text):
+        depth = 1
+        i = match.end()
+        while i < len(text) and depth > 0:
+            if text[i] == '{':
+                depth += 1
+            elif text[i] == '}':
+                depth -= 1
+            i += 1
+        blocks.append((match, text[match.end():i - 1]))
+    return blocks
+
+
+def _top_level(body):
+    """ Strip the nested blocks of a body, keeping only its attributes """
+    result = ''
+    depth = 0
+    interpolation = 0
+    for i, c in enumerate(body):
+        if c == '{' and (interpolation or body[i - 1:i] == '$'):
+            interpolation += 1
+        elif c == '}' and interpolation:
+            interpolation -= 1
+        elif c == '{':
+            depth += 1
+            continue
+        elif c == '}':
+            depth -= 1
+            continue
+        if depth == 0:
+            result += c
+    return result
+
+
+def _attributes(body):
+    attrs = {}
+    for match in re.finditer(r'^\s*(\w+)\s*=\s*"?([^"\n]*?)"?\s*$',
+                             _top_level(body), re.MULTILINE):
+        attrs[match.group(1)] = match.group(2)
+    return attrs
+
+
+def get_variable_defaults(text):
+    """ Return {name: default} for the variables declared in a .tf text """
+    defaults = {}
+    for match, body in _find_blocks(text, r'variable\s+"(\w+)"'):
+        defaults[match.group(1)] = _attributes(body).get('default')
+    return defaults
+
+
+def get_resources(text, resource_type):
+    """ Return the top level attributes of every resource of a given type """
+    return [_attributes(body) for _, body in _find_blocks(
+        text, r'resource\s+"{}"\s+"[\w-]+"'.format(resource_type))]
+
+
+def follows_naming_convention(tf_file):
+    """
+    True if all the libvirt resources of a .tf file are named
+    'qatrfm-<type>-${var.basename}[-<suffix>]', so that they can be found
+    through libvirt (see virsh_utils.get_basename).
+    """
+    resources = get_resources(Path(tf_file).read_text(), r'libvirt_\w+')
+    return all(re.match(r'^qatrfm-[a-z]+-\$\{var\.basename\}(?:[-.].*)?$',
+                        r.get('name') or '') for r in resources)
+
+
+def declares_variable(tf_file, name):
+    return name in get_variable_defaults(Path(tf_file).read_text())
+
+
+def get_effective_vars(tf_file, tf_vars):
+    """ Variables of a .tf file after applying the given tf_vars """
+    effective = get_variable_defaults(Path(tf_file).read_text())
+    effective.update(parse_vars(tf_vars))
+    return effective
+
+
+def resolve(value, variables, default=None):
+    """
+    Resolve a literal or a '${var.x}' attribute value into an int.
+    Anything more complex can't be evaluated and 'default' is returned.
+    """
+    if value is None:
+        return default
+    match = re.match(r'^\$\{var\.(\w+)\}$', value)
+    if match:
+        value = variables.get(match.group(1))
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def file_identity(path):
+    """
+    Identity of a file referenced by a variable (e.g. an image). Hashing
+    the contents of big images would be too slow, so its path, size and
+    modification time are used instead.
+    """
+    stat = Path(path).stat()
+    return '{}:{}:{}'.format(Path(path).resolve(), stat.st_size,
+                             stat.st_mtime_ns)
+
+
+def fingerprint(tf_file, tf_vars, ignore=MANAGED_VARS):
+    """
+    Hash of the .tf file contents and the variables given to it. Two
+    environments with the same fingerprint are equivalent. The variables
+    set by qatrfm itself are not taken into account.
+    """
+    h = hashlib.sha256(Path(tf_file).read_bytes())
+    variables = parse_vars(tf_vars)
+    for key in sorted(variables.keys()):
+        if key in ignore:
+            continue
+        value = variables[key]
+        if Path(value).is_file():
+            value = file_identity(value)
+        h.update('\0{}={}'.format(key, value).encode('utf-8'))
+    return h.hexdigest()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 SUSE LLC
+#
+# Copying and distribution of this file, with or without modification,
+# are permitted in any medium without royalty provided the copyright
+# notice and this notice are preserved.  This file is offered as-is,
+# without any warranty.
+
+import re
+
+VIRSH = 'virsh -c qemu:///system'
+
+
+def generate_event_wait_str(domain, event, timeout):
+    return ('{} event --domain {} --event {} --timeout {}'
+            .format(VIRSH, domain, event, int(timeout)))
+
+
+def generate_domifaddr_str(domain, source='lease'):
+    return ('{} domifaddr {} --source {}'.format(VIRSH, domain, source))
+
+
+def get_ipv4_addresses(str):
+    """
+    Parse the output of 'virsh domifaddr'.
+
+    Lines look like:
+        vnet0   52:54:00:1a:2b:3c   ipv4   10.3.0.45/24
+    """
+    return re.findall(r'\sipv4\s+([0-9.]+)/[0-9]+', str)
+
+
+def generate_domain_list_str():
+    return '{} list --all --name'.format(VIRSH)
+
+
+def generate_network_list_str():
+    return '{} net-list --all --name'.format(VIRSH)
+
+
+def generate_volume_list_str(pool='default'):
+    return '{} vol-list --pool {}'.format(VIRSH, pool)
+
+
+def generate_domain_destroy_str(domain):
+    return '{} destroy {}'.format(VIRSH, domain)
+
+
+def generate_domain_undefine_str(domain):
+    return '{} undefine {} --snapshots-metadata'.format(VIRSH, domain)
+
+
+def generate_volume_delete_str(volume, pool='default'):
+    return '{} vol-delete {} --pool {}'.format(VIRSH, volume, pool)
+
+
+def generate_network_destroy_str(network):
+    return '{} net-destroy {}'.format(VIRSH, network)
+
+
+def generate_network_undefine_str(network):
+    return '{} net-undefine {}'.format(VIRSH, network)
+
+
+def get_names(str):
+    """
+    Parse the first column of 'virsh list/net-list --name' or 'vol-list'
+    skipping the table header if there is one.
+    """
+    names = []
+    for line in str.splitlines():
+        fields = line.split()
+        if (not fields or fields[0] == 'Name' or
+                set(fields[0]) == {'-'}):
+            continue
+        names.append(fields[0])
+    return names
+
+
+def get_basename(resource_name):
+    """
+    Return the environment basename of a resource created by qatrfm.
+
+    All the resources follow the 'qatrfm-<type>-<basename>[-<suffix>]'
+    naming convention, e.g. 'qatrfm-vm-abcdefghij-0'.
+    """
+    match = re.match(r'^qatrfm-[a-z]+-([a-z]{10})(?:[-.].*)?$',
+                     resource_name)
+    if match:
+        return match.group(1)
+    return None
+
+
+def generate_domstats_str(domains):
+    return ('{} domstats --raw --cpu-total --balloon --block --interface {}'
+            .format(VIRSH, ' '.join(domains)))
+
+
+def get_domstats(str):
+    """
+    Parse the output of 'virsh domstats --raw':
+        Domain: 'qatrfm-vm-abcdefghij-0'
+          cpu.time=1234
+          block.0.rd.bytes=4096
+
+    into {'qatrfm-vm-abcdefghij-0': {'cpu.time': 1234, ...}}
+    Non numeric values are ignored.
+    """
+    stats = {}
+    current = None
+    for line in str.splitlines():
+        match = re.match(r"^Domain: '(.*)'$", line.strip())
+        if match:
+            current = stats.setdefault(match.group(1), {})
+            continue
+        if current is None or '=' not in line:
+            continue
+        key, value = line.strip().split('=', 1)
+        try:
+            current[key] = int(value)
+        except ValueError:
+            pass
+    return stats
+
+
+def generate_domname_str(uuid):
+    return '{} domname {}'.format(VIRSH, uuid)
+
+
+def generate_domain_start_str(domain):
+    return '{} start {}'.format(VIRSH, domain)
+
+
+def generate_define_str(xml):
+    return '{} define {}'.format(VIRSH, xml)
+
+
+def generate_domstate_str(domain):
+    return '{} domstate {}'.format(VIRSH, domain)
+
+
+def generate_dumpxml_str(domain):
+    return '{} dumpxml {}'.format(VIRSH, domain)
+
+
+def generate_domblklist_str(domain):
+    return '{} domblklist {} --details'.format(VIRSH, domain)
+
+
+def get_disk_paths(str):
+    """
+    Parse the output of 'virsh domblklist --details':
+        Type   Device   Target   Source
+        file   disk     vda      /var/lib/libvirt/images/disk.qcow2
+    """
+    paths = []
+    for line in str.splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[0] == 'file' and fields[1] == 'disk':
+            paths.append(fields[3])
+    return paths
+
+
+def generate_save_str(domain, path):
+    return '{} save {} {}'.format(VIRSH, domain, path)
+
+
+def generate_restore_str(path, xml=None):
+    if xml:
+        return '{} restore {} --xml {}'.format(VIRSH, path, xml)
+    return '{} restore {}'.format(VIRSH, path)
+
+
+def generate_save_image_dumpxml_str(path):
+    return '{} save-image-dumpxml {}'.format(VIRSH, path)
+
+
+def generate_domif_setlink_str(domain, interface, state):
+    return '{} domif-setlink {} {} {}'.format(VIRSH, domain, interface, state)
+
+
+def generate_domtime_sync_str(domain):
+    return '{} domtime {} --now'.format(VIRSH, domain)
+
+
+def generate_domfsfreeze_str(domain):
+    return '{} domfsfreeze {}'.format(VIRSH, domain)
+
+
+def generate_domfsthaw_str(domain):
+    return '{} domfsthaw {}'.format(VIRSH, domain)
+
+
+def generate_suspend_str(domain):
+    return '{} suspend {}'.format(VIRSH, domain)
+
+
+def generate_resume_str(domain):
+    return '{} resume {}'.format(VIRSH, domain)